@@ -107,6 +107,9 @@ function goodToGo(){
     if (runInfo.blocked || runInfo.finished) {
         showSorry(instructions.sorry.noMoreHits_first, instructions.sorry.noMoreHits_later);
         return false
+    } else if (runInfo.studyComplete) {
+        showSorry(instructions.sorry.studyComplete_first, instructions.sorry.studyComplete_later);
+        return false
     } else if (runInfo.maintenance){
         showSorry(instructions.sorry.maintenance_first, instructions.sorry.maintenance_later);
         return false
@@ -442,6 +445,10 @@ function initializeRun() {
     }).then(function (response) {
         console.log("workerData received from Server:", response);
         runInfo = response;
+        if (runInfo.studyComplete) {
+            goodToGo(); // shows the study complete message, there are no images to run
+            return;
+        }
         if (!DEBUG) {
             numTrials = runInfo.images.length;
         }else{
@@ -574,6 +581,10 @@ function finishRun() {
                 $("#keep-playing-button").removeClass("loading");
                 $("#maintenance-message").html("");
             }
+            else if(response["studyComplete"]) {
+                $("#keep-playing-button").removeClass("loading");
+                $("#maintenance-message").html(instructions.endText.studyCompleteText);
+            }
             else if(response["maintenance"]) {
                 $("#keep-playing-button").removeClass("loading");
                 $("#maintenance-message").html(instructions.endText.maintenanceText);
@@ -663,7 +674,8 @@ function otherSubmit(submitUrl){
         timestamp: sessionDataParsed[sessionDataParsed.length - 1].timestamp,
         compensation: config.game_settings.reward.amount * (JSON.parse(sessionStorage.runInSession) + 1),
         medium: state.medium,
-        feedback: $("#feedback-input").val()
+        feedback: $("#feedback-input").val(),
+        assignmentId: sessionStorage.assignmentId
     };
 
     // Submit
@@ -0,0 +1,315 @@
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import numpy as np
+from initializeWorkerSequences import create_sequence, create_track, check_parameters, check_sequence, check_track, \
+    allocate_repeats, find_free_place, distribute_vigs, distribute_first_targets, distribute_first_fillers, FreeSlots, \
+    PlacementError, new_placement_stats, merge_placement_stats
+
+"""
+BENCHMARK THE SEQUENCE GENERATOR
+
+This code deals with timing the hot paths of initializeWorkerSequences.py, so a change to the generator can be checked
+for speed (and for how often it has to search, see search_placement) before tracks are generated with it. It runs offline: the images are
+synthetic integer ids, no stimulus dirs are needed.
+
+For every combination of block size (--scales times the default number of targets, fillers and vigs) and distance
+constraints (--target_dists and --vig_dists, as min:max), it reports:
+- the median time per call (over --rounds rounds) of create_sequence, allocate_repeats (placing the repeats of the
+targets after the first batch, as in create_sequence), find_free_place (finding the places for those targets),
+check_sequence and check_track (a track of --num_blocks blocks)
+- how many repairs (see allocate_repeats) a sequence took, and how often its placement had to be searched (see
+search_placement)
+- how many tracks of --num_blocks blocks create_track makes per second, end to end (selecting the images, building and
+checking the sequences)
+Combinations no sequence can be built for (see check_parameters) are skipped.
+
+The results can be saved as a baseline (json), and compared to a baseline of an earlier version of the generator (run
+with the same arguments on the same machine). The comparison lists the change of every measure, and exits with an error
+if any of them got slower by more than --tolerance:
+python benchmarkSequences.py --save_baseline ./benchmarkBaseline.json
+python benchmarkSequences.py --baseline ./benchmarkBaseline.json
+ """
+
+# Measures where lower is better, the others (tracks_per_second) are better when higher
+TIMED_FUNCTIONS = ["create_sequence", "allocate_repeats", "find_free_place", "check_sequence", "check_track"]
+LOWER_IS_BETTER = TIMED_FUNCTIONS + ["searches_per_sequence", "repairs_per_sequence"]
+
+
+# %% Benchmark functions ----------------------------------------------------------------------------------------------
+
+# region Setting up
+def synthetic_images(num_targets, num_fillers, num_vigs, offset=0):
+    """
+    :param offset: first image id to use (so the blocks of a track get different images)
+    :return: dict with keys ["targets", "fillers", "vigs"] and lists of integer image ids as values
+    """
+    ids = iter(range(offset, offset + num_targets + num_fillers + num_vigs))
+    return {"targets": list(itertools.islice(ids, num_targets)),
+            "fillers": list(itertools.islice(ids, num_fillers)),
+            "vigs": list(itertools.islice(ids, num_vigs))}
+
+
+def prepare_targets(num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets, min_dist_vigs,
+                    max_dist_vigs):
+    """
+    Takes the steps of create_sequence up to the targets after the first batch: places the vigs, the first targets and
+    the first fillers, and picks the temporary places of the remaining targets (see distribute_targets).
+
+    :return: FreeSlots of the available places, FreeSlots of the reserved places, dict of the pairs placed so far,
+    temporary places of the remaining targets
+    """
+    num_places = num_targets * 2 + num_vigs * 2 + num_fillers
+    num_first_targets = min(25, num_targets)
+    places_available = FreeSlots(num_places)
+    placed = {}
+    distribute_vigs(places_available, num_vigs, num_places, min_dist_vigs, max_dist_vigs, placed=placed)
+    distribute_first_targets(places_available, num_first_targets, min_dist_targets, max_dist_targets,
+                             start_phase_length=min_dist_targets, placed=placed)
+    reserved = FreeSlots(num_places, free=False)
+    for place in distribute_first_fillers(places_available, int((float(6) / 10) * num_fillers), num_places):
+        reserved.add(place[0])
+
+    num = num_targets - num_first_targets
+    desired_places = []
+    if num > 0:
+        increment = float(num_places - min_dist_targets) / num
+        desired_places = [random.randint(min_dist_targets, min_dist_targets + round(increment))]
+        for i in range(1, num):
+            desired_places.append(desired_places[i - 1] + round(increment))
+    return places_available, reserved, placed, desired_places
+
+
+# endregion
+
+# region Timing
+def time_calls(setup, call, rounds, number):
+    """
+    Times a function, leaving its setup out.
+
+    :param setup: function returning the arguments of one call (e.g., a fresh FreeSlots for a function changing it)
+    :param call: function to time
+    :param rounds: number of rounds
+    :param number: number of calls per round
+    :return: median over the rounds of the seconds per call
+    """
+    per_call = []
+    for _ in range(rounds):
+        elapsed = 0.0
+        for _ in range(number):
+            arguments = setup()
+            start = time.perf_counter()
+            call(*arguments)
+            elapsed += time.perf_counter() - start
+        per_call.append(elapsed / number)
+    return float(np.median(per_call))
+
+
+def benchmark_point(num_targets, num_fillers, num_vigs, target_dists, vig_dists, num_blocks, num_tracks, rounds, number,
+                    seed):
+    """
+    Runs all benchmarks for one block size and one set of distance constraints.
+
+    :param target_dists: (min_dist_targets, max_dist_targets)
+    :param vig_dists: (min_dist_vigs, max_dist_vigs)
+    :param num_blocks: number of blocks of the tracks (check_track and tracks_per_second)
+    :param num_tracks: number of tracks to time create_track with
+    :return: dict measure -> value (seconds per call for the TIMED_FUNCTIONS)
+    """
+    distances = {"min_dist_targets": target_dists[0], "max_dist_targets": target_dists[1],
+                 "min_dist_vigs": vig_dists[0], "max_dist_vigs": vig_dists[1]}
+    random.seed(seed)
+    np.random.seed(seed)
+    results = {}
+
+    # Building sequences, counting repairs and searches
+    images = synthetic_images(num_targets, num_fillers, num_vigs)
+    stats = new_placement_stats()
+    results["create_sequence"] = time_calls(lambda: (), lambda: create_sequence(images, stats=stats, **distances),
+                                            rounds, number)
+
+    # Placing the targets after the first batch: first their places, then those of their repeats
+    def setup_targets():
+        places_available, reserved, placed, desired_places = prepare_targets(num_targets, num_fillers, num_vigs,
+                                                                             **distances)
+        return places_available, desired_places, reserved, placed
+
+    def find_places(places_available, desired_places, reserved, placed):
+        for x in desired_places:
+            find_free_place(places_available, x)
+
+    def setup_repeats():
+        places_available, desired_places, reserved, placed = setup_targets()
+        first_places = [[find_free_place(places_available, x)] for x in desired_places]
+        return first_places, places_available, reserved, placed
+
+    num_desired = max(num_targets - min(25, num_targets), 1)
+    results["find_free_place"] = time_calls(setup_targets, find_places, rounds, number) / num_desired
+    results["allocate_repeats"] = time_calls(
+        setup_repeats, lambda first_places, places_available, reserved, placed:
+        allocate_repeats(first_places, places_available, target_dists[0], target_dists[1], reserved=reserved,
+                         placed=placed), rounds, number)
+
+    # Checks, of a sequence and of a whole track
+    sequence, types = create_sequence(images, **distances)
+    results["check_sequence"] = time_calls(lambda: (), lambda: check_sequence(sequence, images, **distances), rounds,
+                                           number)
+    block_size = num_targets + num_fillers + num_vigs
+    track_images = [synthetic_images(num_targets, num_fillers, num_vigs, offset=block_i * block_size)
+                    for block_i in range(num_blocks)]
+    track, track_types = zip(*[create_sequence(x, **distances) for x in track_images])
+    results["check_track"] = time_calls(lambda: (), lambda: check_track(track_images, list(track), list(track_types),
+                                                                        **distances), rounds, number)
+
+    # End to end: whole tracks
+    settings = {"seed": seed,
+                "targets_all": [str(x) for x in range(num_blocks * num_targets)],
+                "fillers_all": [str(x) for x in range(num_blocks * (num_fillers + num_vigs))],
+                "separate_fillers": True,
+                "num_blocks": num_blocks,
+                "num_targets": num_targets,
+                "num_fillers": num_fillers,
+                "num_vigs": num_vigs,
+                "target_dir": "targets",
+                "filler_dir": "fillers",
+                "clustering": False}
+    settings.update(distances)
+    start = time.perf_counter()
+    for worker in range(num_tracks):
+        merge_placement_stats(stats, create_track(worker, settings)[2])
+    results["tracks_per_second"] = num_tracks / (time.perf_counter() - start)
+
+    results["searches_per_sequence"] = stats["searches"] / stats["sequences"]
+    results["repairs_per_sequence"] = stats["repairs"] / stats["sequences"]
+    return results
+
+
+def run_benchmarks(args):
+    """
+    :param args: parsed command line arguments
+    :return: dict point name -> results (see benchmark_point)
+    """
+    benchmarks = {}
+    for scale, target_dists, vig_dists in itertools.product(args.scales, args.target_dists, args.vig_dists):
+        num_targets, num_fillers, num_vigs = (max(1, round(x * scale))
+                                              for x in (args.num_targets, args.num_fillers, args.num_vigs))
+        target_dists = parse_dists(target_dists)
+        vig_dists = parse_dists(vig_dists)
+        name = point_name(num_targets, num_fillers, num_vigs, target_dists, vig_dists)
+        try:
+            check_parameters(num_targets, num_fillers, num_vigs, *target_dists, *vig_dists)
+        except PlacementError as e:
+            print("skipping ", name, ": ", e)
+            continue
+        benchmarks[name] = benchmark_point(num_targets, num_fillers, num_vigs, target_dists, vig_dists,
+                                           args.num_blocks, args.num_tracks, args.rounds, args.number, args.seed)
+        print_point(name, benchmarks[name])
+    return benchmarks
+
+
+def parse_dists(text):
+    """
+    :param text: "min:max"
+    :return: (min, max) as ints
+    """
+    low, high = text.split(":")
+    return int(low), int(high)
+
+
+def point_name(num_targets, num_fillers, num_vigs, target_dists, vig_dists):
+    return ("targets=" + str(num_targets) + " fillers=" + str(num_fillers) + " vigs=" + str(num_vigs) +
+            " target_dists=" + str(target_dists[0]) + ":" + str(target_dists[1]) +
+            " vig_dists=" + str(vig_dists[0]) + ":" + str(vig_dists[1]))
+
+
+# endregion
+
+# region Reporting
+def print_point(name, results):
+    print(name)
+    for function in TIMED_FUNCTIONS:
+        print("    ", function, ": ", round(results[function] * 1e6, 1), " us per call")
+    print("    searches per sequence: ", round(results["searches_per_sequence"], 4), ", repairs per sequence: ",
+          round(results["repairs_per_sequence"], 3))
+    print("    tracks per second: ", round(results["tracks_per_second"], 2))
+
+
+def compare(benchmarks, baseline, tolerance):
+    """
+    Prints the change of every measure relative to the baseline.
+
+    :param benchmarks: dict point name -> results, of this run
+    :param baseline: dict point name -> results, of the baseline run
+    :param tolerance: relative slowdown that counts as a regression (e.g., 0.2 for 20%)
+    :return: list of the regressions found, as text
+    """
+    regressions = []
+    for name in benchmarks:
+        if name not in baseline:
+            print("not in the baseline: ", name)
+            continue
+        print(name)
+        for measure in TIMED_FUNCTIONS + ["tracks_per_second"]:
+            old = baseline[name].get(measure)
+            new = benchmarks[name][measure]
+            if not old:
+                continue
+            slowdown = new / old - 1 if measure in LOWER_IS_BETTER else old / new - 1
+            flag = ""
+            if slowdown > tolerance:
+                flag = "  SLOWER"
+                regressions.append(name + " " + measure + ": " + str(round(100 * slowdown, 1)) + "% slower")
+            print("    ", measure, ": ", round(100 * (new / old - 1), 1), "%", flag)
+        print("    searches per sequence: ", round(baseline[name].get("searches_per_sequence", 0), 4), " -> ",
+              round(benchmarks[name]["searches_per_sequence"], 4), ", repairs per sequence: ",
+              round(baseline[name]["repairs_per_sequence"], 3), " -> ",
+              round(benchmarks[name]["repairs_per_sequence"], 3))
+    return regressions
+
+
+# endregion
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_targets', type=int, default=60, help='number of targets in a block at scale 1')
+    parser.add_argument('--num_fillers', type=int, default=57, help='number of fillers in a block at scale 1')
+    parser.add_argument('--num_vigs', type=int, default=19, help='number of vigilance images in a block at scale 1')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 1, 2], help='block sizes to benchmark, as '
+                                                                                     'multiples of the numbers above')
+    parser.add_argument('--target_dists', type=str, nargs='+', default=["35:140", "20:80", "50:200"],
+                        help='min:max distances between target and repeat to benchmark')
+    parser.add_argument('--vig_dists', type=str, nargs='+', default=["1:4", "2:8"], help='min:max distances between '
+                                                                                        'vig and repeat to benchmark')
+    parser.add_argument('--num_blocks', type=int, default=8, help='number of blocks per track')
+    parser.add_argument('--num_tracks', type=int, default=20, help='number of tracks to time create_track with')
+    parser.add_argument('--rounds', type=int, default=5, help='number of rounds to take the median time over')
+    parser.add_argument('--number', type=int, default=20, help='number of calls per round')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the benchmarks (the same for every run, so runs '
+                                                            'are compared on the same sequences)')
+    parser.add_argument('--save_baseline', type=str, default=None, help='json file to save the results to as a '
+                                                                        'baseline')
+    parser.add_argument('--baseline', type=str, default=None, help='json file of a baseline to compare the results to')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown compared to the baseline that '
+                                                                     'counts as a regression')
+    args = parser.parse_args()
+
+    # %% Benchmark ----------------------------------------------------------------------------------------------------
+    benchmarks = run_benchmarks(args)
+
+    # %% Outputs ------------------------------------------------------------------------------------------------------
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"arguments": vars(args), "benchmarks": benchmarks}, f, indent=1)
+        print("baseline saved to ", args.save_baseline)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(benchmarks, baseline["benchmarks"], args.tolerance)
+        for text in regressions:
+            print("REGRESSION: ", text)
+        sys.exit(1 if regressions else 0)
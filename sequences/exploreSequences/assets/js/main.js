@@ -6,6 +6,7 @@ const state = {
     blockIndex: 0
 };
 let blockInfo = {};
+let manifest = null; // manifest.json written by the generator (see trackManifest.py), null if there is none
 let images = new Array();
 const colors = {
     "target": "blue",
@@ -14,6 +15,7 @@ const colors = {
     "vig": "red",
     "vig repeat": "orange"
 };
+const typeLabels = [null, "target", "target repeat", "filler", "vig", "vig repeat"]; // index = type code in the manifest
 const types = {
     "target": "target",
     "target repeat": "target repeat",
@@ -33,6 +35,32 @@ function getAllIndexes(arr, val) {
     return indexes;
 }
 
+function numTracks() {
+    return manifest !== null ? manifest.tracks.length : config.numWorkers;
+}
+
+function numBlocks() {
+    if (manifest !== null) {
+        return manifest.tracks[state.workerIndex].blocks.length;
+    }
+    return blockInfo.sequences.length;
+}
+
+function trackFileName(workerIndex) {
+    // With a manifest, the tracks are the ones it lists (their ids don't have to be consecutive)
+    if (manifest !== null) {
+        return manifest.tracks[workerIndex].name;
+    }
+    return config.sequencePrefix + String(workerIndex).padStart(5, "0") + ".json";
+}
+
+function trialType(blockIndex, trialIndex) {
+    if (manifest !== null) {
+        return typeLabels[Number(manifest.tracks[state.workerIndex].blocks[blockIndex].codes[trialIndex])];
+    }
+    return blockInfo.types[blockIndex][trialIndex];
+}
+
 function resetOpacity(){
     for (let i = 0; i < images.length; i++){
         images[i].style.opacity = 1;}
@@ -105,7 +133,7 @@ function fillImages(blockIndex){
         const path = blockInfo.sequences[blockIndex][i];
         images[i].src = config.baseUrl+path;
         images[i].style.outline = "solid";
-        images[i].style.outlineColor = colors[blockInfo.types[blockIndex][i]];
+        images[i].style.outlineColor = colors[trialType(blockIndex, i)];
         images[i].style.outlineWidth = "thick";
         images[i].ondblclick = makeOpenImageFunction(i);
         images[i].onclick = makeShowInfoFunction(i)};
@@ -114,7 +142,7 @@ function fillImages(blockIndex){
 //------------------------------------------------------------------------------------------------------------------
 /* INTERACTIVITY */
 function getBlockInfo(workerIndex) {
-    let sequenceFile = config.sequenceDir + "//" + config.sequencePrefix + String(workerIndex).padStart(5, "0") + ".json";
+    let sequenceFile = config.sequenceDir + "//" + trackFileName(workerIndex);
     console.log(sequenceFile);
 
     $.getJSON(sequenceFile).done(function(data){
@@ -145,12 +173,12 @@ function makeShowInfoFunction(trialIndex) {
             images[indices[i]].style.opacity = 0.2;
             console.log("occurence ", i, " ", "trialIndex ", indices[i]);
             console.log("occurence ", i, " ", "file ", blockInfo.sequences[state.blockIndex][indices[i]]);
-            console.log("occurence ", i, " ", "type ", types[blockInfo.types[state.blockIndex][indices[i]]]);
+            console.log("occurence ", i, " ", "type ", types[trialType(state.blockIndex, indices[i])]);
 
             information.innerHTML = information.innerHTML + "occurrence: "+String(i)+"<br>";
             information.innerHTML = information.innerHTML + "trialIndex: "+String(indices[i])+"<br>";
             information.innerHTML = information.innerHTML + "file: "+blockInfo.sequences[state.blockIndex][indices[i]]+"<br>";
-            information.innerHTML = information.innerHTML + "type: "+types[blockInfo.types[state.blockIndex][indices[i]]]+"<br>";
+            information.innerHTML = information.innerHTML + "type: "+types[trialType(state.blockIndex, indices[i])]+"<br>";
             information.innerHTML = information.innerHTML + "<br>";
         }
     }
@@ -182,7 +210,7 @@ function increaseWorkerIndex(){
     resetOpacity();
     $("#workerInfo").html("Worker: "+state.workerIndex);
 
-    if (state.workerIndex == config.numWorkers -1){
+    if (state.workerIndex == numTracks() -1){
         $("#NextWorker").addClass("disabled");
     }
 
@@ -199,7 +227,7 @@ function increaseBlockIndex(){
     resetOpacity();
     $("#sequenceInfo").html("Sequence: "+state.blockIndex);
 
-    if (state.blockIndex == blockInfo.sequences.length -1){
+    if (state.blockIndex == numBlocks() -1){
         $("#NextSequence").addClass("disabled");
     }
     $("#PreviousSequence").removeClass("disabled");
@@ -237,7 +265,13 @@ $(document).ready(function() {
             resetPage();
             arrangePage(blockInfo.sequences[state.blockIndex].length,config.imageSize,config.whiteSpace);
         });
-        getBlockInfo(state.workerIndex);
-        setupButtons();
+        // The manifest tells how many tracks and blocks there are, without it we go by config.numWorkers
+        $.getJSON(config.sequenceDir + "//" + config.manifestFile).done(function(data) {
+            manifest = data;
+            console.log("manifest: ", manifest.tracks.length, " tracks");
+        }).always(function() {
+            getBlockInfo(state.workerIndex);
+            setupButtons();
+        });
     });
 });
@@ -0,0 +1,105 @@
+import os
+import heapq
+import random
+import collections
+
+"""
+BALANCED STIMULUS EXPOSURE
+
+The code deals with choosing the images of every track (see initializeWorkerSequences.py) such that every image ends up
+in about as many tracks as every other one. Drawing the images of every track independently at random gives some images
+many more tracks than others, so it takes many more participants before every image has the minimum number of ratings.
+
+An ExposureScheduler keeps a counter per image (or per cluster, with clustering) in a heap and gives every track the
+images with the lowest counts, ties broken at random. As a track takes k different images at once and they're the k least
+exposed ones, the counts of any two images never differ by more than one after any number of tracks (as long as the
+counts started out that way), so stopping the study early still leaves a balanced set of images.
+
+The counts can be started from the tracks that already exist (see count_exposures), e.g., for a top-up.
+ """
+
+# Type labels of the occurrence that counts as an exposure of the image, and which pool the image belongs to
+EXPOSURE_LABELS = {"target": "targets", "filler": "fillers", "vig": "fillers"}
+
+
+class ExposureScheduler:
+    """
+    Least-exposed-first choice of images, with a counter per image.
+    """
+
+    def __init__(self, names, counts=None, rng=None):
+        """
+        :param names: the (clusters of) images to choose from
+        :param counts: optional dict name -> number of tracks the image already is in
+        :param rng: random.Random to break ties with
+        """
+        self.names = list(names)
+        self.rng = rng if rng is not None else random.Random()
+        counts = counts if counts is not None else {}
+        self.counts = [counts.get(name, 0) for name in self.names]
+        self.heap = [(count, self.rng.random(), i) for i, count in enumerate(self.counts)]
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.names)
+
+    def take(self, num):
+        """
+        Takes the num least exposed images (all different) and counts one more exposure for each of them.
+
+        :param num: number of images
+        :return: list of names, in random order
+        """
+        if num > len(self.heap):
+            raise Exception("cannot take " + str(num) + " images, there are only " + str(len(self.heap)))
+        indices = [heapq.heappop(self.heap)[2] for _ in range(num)]
+        for i in indices:
+            self.counts[i] += 1
+            heapq.heappush(self.heap, (self.counts[i], self.rng.random(), i))
+        self.rng.shuffle(indices)
+        return [self.names[i] for i in indices]
+
+    def spread(self):
+        """
+        :return: (lowest count, highest count)
+        """
+        return min(self.counts), max(self.counts)
+
+
+def schedule_selections(num_tracks, targets, fillers, num_blocks, num_targets, num_fillers, num_vigs):
+    """
+    :param num_tracks: number of tracks to choose images for
+    :param targets: ExposureScheduler for the targets
+    :param fillers: ExposureScheduler for the fillers and vigs (can be the same object as targets)
+    :return: generator of (targets, fillers, vigs) lists, one per track (see create_track)
+    """
+    for _ in range(num_tracks):
+        if fillers is targets:  # one pool, every image used only once per track
+            chosen = targets.take(num_blocks * (num_targets + num_fillers + num_vigs))
+            targets_chosen = chosen[:num_blocks * num_targets]
+            fillers_chosen = chosen[num_blocks * num_targets:]
+        else:
+            targets_chosen = targets.take(num_blocks * num_targets)
+            fillers_chosen = fillers.take(num_blocks * (num_fillers + num_vigs))
+        yield targets_chosen, fillers_chosen[:num_blocks * num_fillers], fillers_chosen[num_blocks * num_fillers:]
+
+
+def count_exposures(tracks, target_dir, filler_dir):
+    """
+    Counts in how many tracks every (cluster of) image(s) is.
+
+    :param tracks: iterable of tracks (dicts with keys "sequences" and "types")
+    :param target_dir: sub-dir of the targets, as it appears in the image paths of the tracks
+    :param filler_dir: sub-dir of the fillers
+    :return: dict with keys "targets" and "fillers", each a Counter name -> number of tracks (the name is the first
+    component of the image path below target_dir or filler_dir, i.e., the cluster with clustering)
+    """
+    counts = {"targets": collections.Counter(), "fillers": collections.Counter()}
+    pool_dirs = {"targets": target_dir, "fillers": filler_dir}
+    for track in tracks:
+        for sequence, types in zip(track["sequences"], track["types"]):
+            for image, label in zip(sequence, types):
+                pool = EXPOSURE_LABELS.get(label)
+                if pool is not None:
+                    counts[pool][os.path.relpath(image, pool_dirs[pool]).split(os.sep)[0]] += 1
+    return counts
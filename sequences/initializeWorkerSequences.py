@@ -5,16 +5,27 @@ import collections
 import json
 import argparse
 import numpy as np
-import copy
+import time
+import multiprocessing
+import itertools
+import functools
+from trackPack import PackWriter, TrackPack, stored_track_ids, read_stored_track
+from stimulusIndex import StimulusIndex
+from exposureScheduler import ExposureScheduler, schedule_selections, count_exposures
+from validateTracks import validate_sequence, validate_track
+from trackFormats import MANIFEST_NAME, TYPE_LABELS, TYPE_CODES
+from trackManifest import track_entry, new_manifest, read_manifest, write_manifest
 
 """
 PRECONSTRUCT MEMORY GAME SEQUENCES
 
 The code deals with preconstructing sequences for the memory game. More precisely, it creates "tracks" that can be 
 assigned to a player of the game. A track consists of multiple sequences (blocks) that define which image a player 
-will see on which trial. Every track is saved as a json file. The number of tracks to be generated is determined by 
-the num_workers argument. This should correspond roughly to how many players you want to participate in the game. Only 
-roughly, cause you can construct more later if you need more. 
+will see on which trial. Every track is saved as a json file (or, with --pack=True, all tracks are saved together in 
+one pack file, see trackPack.py). The number of tracks to be generated is determined by the num_workers argument. This 
+should correspond roughly to how many players you want to participate in the game. Only roughly, cause you can 
+construct more later if you need more: with --top_up=True, the tracks already in track_dir are kept and only the 
+missing ones are generated, numbered after the last one. 
 
 Each json file contains a dictionary with the following keys: - sequences: this is a list of lists. Each sublist 
 represents one block/sequence. The elements in the sublists are paths to images. - types: this a list of lists. Each 
@@ -34,7 +45,14 @@ where repeats are likely to occur) with different ones.
 # %% Sequence building functions --------------------------------------------------------------------------------------
 
 # region Main sequence building function
-def create_sequence(images, min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs):
+class PlacementError(Exception):
+    """
+    Raised when the trials of a sequence can't be placed (with the given parameters).
+    """
+    pass
+
+
+def create_sequence(images, min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs, stats=None):
     """
     Creates one track for the memory game.
 
@@ -43,6 +61,7 @@ def create_sequence(images, min_dist_targets, max_dist_targets, min_dist_vigs, m
     :param max_dist_targets: maximum distance between target and repeat (difference in index)
     :param min_dist_vigs: minimum distance between vig and repeat (difference in index)
     :param max_dist_vigs: max distance between vig and repeat (difference in index)
+    :param stats: optional dict (see new_placement_stats) to add the number of repairs and searches to
     :return: two lists. One with the actual image sequences for one track. The other describing trial types.
     """
 
@@ -52,97 +71,746 @@ def create_sequence(images, min_dist_targets, max_dist_targets, min_dist_vigs, m
     num_vigs = len(images["vigs"])
     num_places = num_targets * 2 + num_vigs * 2 + num_fillers  # number of places (trials) in the sequence
 
+    # Reject parameters no placement can satisfy (all others have one, which search_placement finds if needed)
+    check_parameters(num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets, min_dist_vigs,
+                     max_dist_vigs)
+
     # Some settings (hard-coded)
-    num_first_targets = 25
+    num_first_targets = min(25, num_targets)
     num_first_fillers = int((float(6) / 10) * num_fillers)
-    max_attempts = 10
 
-    success = False
+    sequence = [None] * num_places  # initializing sequence to be filled with images
+    types = [None] * num_places  # initializing list of trial types for this sequence (e.g., "target repeat")
+    places_available = FreeSlots(num_places)  # available places
+    placed = {}  # place -> pair it belongs to, so repairs can shift pairs (see allocate_repeats)
+    reserved = FreeSlots(num_places, free=False)  # places of the first set of fillers (see below)
+    placement_stats = new_placement_stats()
+    # Images are only allocated once all places are known, as repairs can still move pairs around
+
+    try:
+        # Distribute vigilance trials
+        # Need to do these first because range of allowed distances is much smaller
+        vigs_places = distribute_vigs(places_available, num_vigs, num_places, min_dist_vigs, max_dist_vigs,
+                                      placed=placed, stats=placement_stats)
+
+        # Distribute first set of targets
+        # Need to ensure enough target presentations at the start to get at least a few early repeats
+        first_target_places = distribute_first_targets(places_available, num_first_targets, min_dist_targets,
+                                                       max_dist_targets, start_phase_length=min_dist_targets,
+                                                       placed=placed, stats=placement_stats)
+
+        # Distribute first set of fillers
+        # Need to place some fillers in the second half of the sequence to avoid having only repeats there
+        # The places are only reserved for now: a target repeat that doesn't fit anywhere else can still take one
+        first_filler_places = distribute_first_fillers(places_available, num_first_fillers, num_places)
+        for place in first_filler_places:
+            reserved.add(place[0])
+
+        # Distribute remaining targets
+        target_places = distribute_targets(places_available, num_targets - num_first_targets, num_places,
+                                           min_dist_targets, max_dist_targets, start_phase_length=min_dist_targets,
+                                           reserved=reserved, placed=placed, stats=placement_stats)
+
+        # First set of fillers that lost their place to a repeat go with the remaining fillers
+        first_filler_places = [x for x in first_filler_places if x[0] in reserved]
+
+        # Distribute remaining fillers
+        filler_places = distribute_fillers(places_available, num_fillers - len(first_filler_places))
+
+    except PlacementError:
+        # A repeat didn't fit, not even after moving other pairs: search all placements (there is one, see
+        # check_parameters), keeping the places chosen so far where possible. When those lead the search astray (it
+        # usually finds a placement in a couple of steps per place, or not for a long time), search without them
+        preferred = [None] * num_places
+        # Which kind a pair is follows from its distances (if targets and vigs have the same, either one will do)
+        for pair, pair_min_dist, pair_max_dist in placed.values():
+            label = "vig" if (pair_min_dist, pair_max_dist) == (min_dist_vigs, max_dist_vigs) else "target"
+            preferred[pair[0]] = label
+            preferred[pair[1]] = label + " repeat"
+        for place in reserved:
+            preferred[place] = "filler"
+        placement = search_placement(num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets,
+                                     min_dist_vigs, max_dist_vigs, preferred, max_steps=10 * num_places)
+        if placement is None:
+            placement = search_placement(num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets,
+                                         min_dist_vigs, max_dist_vigs)
+        vigs_places, target_places, filler_places = placement
+        first_target_places, target_places = target_places[:num_first_targets], target_places[num_first_targets:]
+        first_filler_places = []
+        placement_stats["searches"] += 1
+
+    # Allocate images
+    allocate_images(sequence, types, images["vigs"], vigs_places, label="vig")
+    allocate_images(sequence, types, images["targets"], first_target_places, label="target")
+    allocate_images(sequence, types, images["targets"][num_first_targets:], target_places, label="target")
+    allocate_images(sequence, types, images["fillers"], first_filler_places, label="filler")
+    allocate_images(sequence, types, images["fillers"][len(first_filler_places):], filler_places, label="filler")
+
+    approved, text = check_sequence(sequence, images, min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs)
+    if not approved:
+        raise Exception(text)
 
-    for i in range(max_attempts):
-        try:
+    if stats is not None:
+        placement_stats["sequences"] = 1
+        placement_stats["attempts"] = 1
+        placement_stats["max_attempts"] = 1
+        merge_placement_stats(stats, placement_stats)
 
-            sequence = [None] * num_places  # initializing sequence to be filled with images
-            types = [None] * num_places  # initializing list of trial types for this sequence (e.g., "target repeat")
-            places_available = list(range(num_places))  # available places
+    return sequence, types
 
-            # Distribute vigilance trials
-            # Need to do these first because range of allowed distances is much smaller
-            vigs_places = distribute_vigs(places_available, num_vigs, num_places, min_dist_vigs, max_dist_vigs)
-            allocate_images(sequence, types, images["vigs"], vigs_places, label="vig")
 
-            # Distribute first set of targets
-            # Need to ensure enough target presentations at the start to get at least a few early repeats
-            first_target_places = distribute_first_targets(places_available, num_first_targets, min_dist_targets,
-                                                           max_dist_targets, start_phase_length=min_dist_targets)
-            allocate_images(sequence, types, images["targets"], first_target_places, label="target")
+def check_parameters(num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets, min_dist_vigs,
+                     max_dist_vigs):
+    """
+    Checks whether a sequence can be built at all with the given parameters. Raises a PlacementError explaining why not
+    if it can't.
 
-            # Distribute first set of fillers
-            # Need to place some fillers in the second half of the sequence to avoid having only repeats there
-            first_filler_places = distribute_first_fillers(places_available, num_first_fillers, num_places)
-            allocate_images(sequence, types, images["fillers"], first_filler_places, label="filler")
+    :param num_targets: number of targets in one sequence (block)
+    :param num_fillers: number of fillers in one sequence
+    :param num_vigs: number of vigilance images in one sequence
+    :param min_dist_targets: minimum distance between target and repeat (difference in index)
+    :param max_dist_targets: maximum distance between target and repeat (difference in index)
+    :param min_dist_vigs: minimum distance between vig and repeat (difference in index)
+    :param max_dist_vigs: max distance between vig and repeat (difference in index)
+    """
+    if min(num_targets, num_fillers, num_vigs) < 0:
+        raise PlacementError("The number of targets, fillers and vigs can't be negative")
+    num_places = num_targets * 2 + num_vigs * 2 + num_fillers
+
+    for label, num, min_dist, max_dist in [("targets", num_targets, min_dist_targets, max_dist_targets),
+                                           ("vigs", num_vigs, min_dist_vigs, max_dist_vigs)]:
+        if num == 0:
+            continue
+        if min_dist < 1:
+            raise PlacementError("The minimum distance for " + label + " must be at least 1 (got " + str(min_dist) +
+                                 ")")
+        if max_dist < min_dist:
+            raise PlacementError("The maximum distance for " + label + " (" + str(max_dist) +
+                                 ") is smaller than the minimum distance (" + str(min_dist) + ")")
+        if min_dist > num_places - 1:
+            raise PlacementError("A sequence only has " + str(num_places) + " places, so no two of them are " +
+                                 str(min_dist) + " (the minimum distance for " + label + ") apart")
+        if num > num_places - min_dist:
+            # The earlier occurrences all have to be at least min_dist places before the end of the sequence
+            raise PlacementError("At most " + str(num_places - min_dist) + " " + label + " can be repeated at least " +
+                                 str(min_dist) + " places later in a sequence of " + str(num_places) + " places, got " +
+                                 str(num))
+        # The first min_dist places only take first occurrences and the last min_dist places only repeats. Only so many
+        # pairs can reach from the ones to the others, all other pairs need (at least) one of the places in between
+        num_spanning = max(0, min(min_dist, 2 * min_dist + max_dist - num_places))
+        if 2 * min_dist <= num_places and num > num_places - 2 * min_dist + num_spanning:
+            raise PlacementError("At most " + str(num_places - 2 * min_dist + num_spanning) + " " + label + " fit in a "
+                                 "sequence of " + str(num_places) + " places when they are repeated " + str(min_dist) +
+                                 " to " + str(max_dist) + " places later, got " + str(num) + ": only " +
+                                 str(num_spanning) + " of them can go from the first " + str(min_dist) +
+                                 " places to the last " + str(min_dist) + ", the others need one of the " +
+                                 str(num_places - 2 * min_dist) + " places in between")
+
+    min_dist = min(min_dist_targets if num_targets > 0 else num_places, min_dist_vigs if num_vigs > 0 else num_places)
+    if num_targets + num_vigs > num_places - min_dist:
+        raise PlacementError("At most " + str(num_places - min_dist) + " targets and vigs together can be repeated at "
+                             "least " + str(min_dist) + " places later in a sequence of " + str(num_places) +
+                             " places, got " + str(num_targets + num_vigs))
+
+    # The counts above can all work out while the distances still don't fit together (e.g., with few fillers to fill the
+    # gaps between first occurrences and repeats): only a search of all placements can tell
+    if not placement_exists(num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets, min_dist_vigs,
+                            max_dist_vigs):
+        raise PlacementError("No sequence of " + str(num_places) + " places has room for " + str(num_targets) +
+                             " targets repeated " + str(min_dist_targets) + " to " + str(max_dist_targets) +
+                             " places later and " + str(num_vigs) + " vigs repeated " + str(min_dist_vigs) + " to " +
+                             str(max_dist_vigs) + " places later, with " + str(num_fillers) + " fillers to fill the "
+                             "gaps. Allow a wider range of distances or use more fillers")
+
+
+@functools.lru_cache(maxsize=None)
+def placement_exists(num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets, min_dist_vigs,
+                     max_dist_vigs):
+    """
+    :return: True if a sequence can be built with the given parameters (see search_placement), remembered per setting
+    """
+    return search_placement(num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets, min_dist_vigs,
+                            max_dist_vigs) is not None
 
-            # Distribute remaining targets
-            target_places = distribute_targets(places_available, num_targets - num_first_targets, num_places,
-                                               min_dist_targets, max_dist_targets, start_phase_length=min_dist_targets)
-            allocate_images(sequence, types, images["targets"][num_first_targets:], target_places, label="target")
 
-            # Distribute remaining fillers
-            filler_places = distribute_fillers(places_available, num_fillers - num_first_fillers)
-            allocate_images(sequence, types, images["fillers"][num_first_fillers:], filler_places, label="filler")
+def new_placement_stats():
+    """
+    :return: dict to collect placement statistics in (see create_sequence)
+    """
+    return {"sequences": 0, "attempts": 0, "max_attempts": 0, "repairs": 0, "searches": 0}
 
-            # Leave attempt loop
-            success = True
-            break  # no need for another attempt if no error was caught
 
-        except Exception as e:
-            print(e)
+def merge_placement_stats(total, stats):
+    """
+    Adds placement statistics (e.g., of one track) to a running total.
+    """
+    for key in ["sequences", "attempts", "repairs", "searches"]:
+        total[key] += stats[key]
+    total["max_attempts"] = max(total["max_attempts"], stats["max_attempts"])
 
-    if not success:
-        raise Exception("Failure! No solution found in " + str(max_attempts) + " attempts!")
 
-    approved, text = check_sequence(sequence, images, min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs)
+# endregion
+
+# region Batch sequence building function
+TYPE_IMAGES = [None, "targets", "targets", "fillers", "vigs", "vigs"]  # which images a type code takes its image from
+
+
+def create_sequences_batch(num_sequences, num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets,
+                           min_dist_vigs, max_dist_vigs, rng=None, chunk_size=10000, max_batch_attempts=3,
+                           stats=None):
+    """
+    Creates many sequences at once, following the same steps as create_sequence, but for all sequences together with
+    numpy instead of one by one (see build_batch). Sequences where a repeat doesn't fit are built again in a (much
+    smaller) batch, and after max_batch_attempts with create_sequence (which repairs the placement).
+
+    :param num_sequences: number of sequences to create
+    :param num_targets: number of targets in one sequence
+    :param num_fillers: number of fillers in one sequence
+    :param num_vigs: number of vigilance images in one sequence
+    :param min_dist_targets: minimum distance between target and repeat (difference in index)
+    :param max_dist_targets: maximum distance between target and repeat (difference in index)
+    :param min_dist_vigs: minimum distance between vig and repeat (difference in index)
+    :param max_dist_vigs: max distance between vig and repeat (difference in index)
+    :param rng: numpy Generator to sample with
+    :param chunk_size: number of sequences built together (limits memory use)
+    :param max_batch_attempts: number of times a sequence is tried in a batch before building it with create_sequence
+    :param stats: optional dict (see new_placement_stats) to add the number of attempts and repairs to
+    :return: two arrays of shape (num_sequences, num_places). Type codes (see TYPE_CODES) and, for every place, the
+    index of the image among the targets, fillers or vigs (see decode_sequence).
+    """
+    check_parameters(num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets, min_dist_vigs,
+                     max_dist_vigs)
+    if rng is None:
+        rng = np.random.default_rng()
+    num_places = num_targets * 2 + num_vigs * 2 + num_fillers
+
+    types = np.zeros((num_sequences, num_places), dtype=np.uint8)
+    slots = np.zeros((num_sequences, num_places), dtype=np.int32)
+    for start in range(0, num_sequences, chunk_size):
+        end = min(start + chunk_size, num_sequences)
+        failed_rows = np.arange(start, end)
+        for attempt in range(1, max_batch_attempts + 1):
+            if len(failed_rows) == 0:
+                break
+            batch_types = np.zeros((len(failed_rows), num_places), dtype=np.uint8)
+            batch_slots = np.zeros((len(failed_rows), num_places), dtype=np.int32)
+            failed = build_batch(batch_types, batch_slots, num_targets, num_fillers, num_vigs, min_dist_targets,
+                                 max_dist_targets, min_dist_vigs, max_dist_vigs, rng)
+            types[failed_rows[~failed]] = batch_types[~failed]
+            slots[failed_rows[~failed]] = batch_slots[~failed]
+            failed_rows = failed_rows[failed]
+
+            if stats is not None:
+                num_built = int((~failed).sum())
+                stats["sequences"] += num_built
+                stats["attempts"] += num_built * attempt
+                if num_built > 0:
+                    stats["max_attempts"] = max(stats["max_attempts"], attempt)
+
+        # Rebuild the ones that still failed one by one (with the global random state set from rng, restored after)
+        if len(failed_rows) > 0:
+            random_state = random.getstate()
+            np_random_state = np.random.get_state()
+            random.seed(int(rng.integers(2 ** 32)))
+            np.random.seed(int(rng.integers(2 ** 32)))
+            images = {key: [(key, i) for i in range(num)] for key, num in
+                      [("targets", num_targets), ("fillers", num_fillers), ("vigs", num_vigs)]}
+            for row in failed_rows:
+                sequence, labels = create_sequence(images, min_dist_targets, max_dist_targets, min_dist_vigs,
+                                                   max_dist_vigs, stats=stats)
+                types[row] = [TYPE_CODES[x] for x in labels]
+                slots[row] = [x[1] for x in sequence]
+            random.setstate(random_state)
+            np.random.set_state(np_random_state)
+
+            if stats is not None:
+                stats["attempts"] += max_batch_attempts * len(failed_rows)
+
+    return types, slots
+
+
+def build_batch(types, slots, num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets, min_dist_vigs,
+                max_dist_vigs, rng):
+    """
+    Fills types and slots (arrays of shape (number of sequences, num_places)) with sequences, taking the same steps as
+    create_sequence. Every step places one item in all sequences at once:
+    - weighted sampling without replacement (vigs) and uniform sampling (fillers, start phase targets) pick the places
+    with the highest random keys (Gumbel top-k for the weighted case)
+    - repeats pick uniformly among the available places at an allowed distance, with masked random keys
+    - the remaining targets take the first available place from their evenly spaced desired place on
+
+    :return: boolean array, True for the sequences where a repeat didn't fit (their rows are left incomplete)
+    """
+    num_sequences, num_places = types.shape
+    rows = np.arange(num_sequences)
+    columns = np.arange(num_places)
+    free = np.ones((num_sequences, num_places), dtype=bool)
+    failed = np.zeros(num_sequences, dtype=bool)
+
+    def take(places, code, slot):
+        free[rows, places] = False
+        types[rows, places] = code
+        slots[rows, places] = slot
+
+    def top_places(keys, num):
+        # places with the highest keys, highest first; keys of places that can't be chosen are -inf
+        if num == 0:
+            return np.zeros((num_sequences, 0), dtype=np.int64)
+        order = np.argpartition(-keys, num - 1, axis=1)[:, :num]
+        order = np.take_along_axis(order, np.argsort(-np.take_along_axis(keys, order, axis=1), axis=1), axis=1)
+        failed[~np.isfinite(keys[rows[:, None], order]).all(axis=1)] = True
+        return order
+
+    # free places padded on both sides, so the places at an allowed distance of every first place are one slice
+    padding = max(max_dist_targets, max_dist_vigs)
+    padded_free = np.zeros((num_sequences, num_places + 2 * padding), dtype=bool)
+
+    def choose_in_windows(subset, first, min_dist, max_dist):
+        # uniformly among all available places at an allowed distance (forward, then backward)
+        width = max_dist - min_dist + 1
+        padded_free[subset, padding:padding + num_places] = free[subset]
+        windows = np.lib.stride_tricks.sliding_window_view(padded_free, width, axis=1)
+        available = np.concatenate([windows[subset, padding + first + min_dist],
+                                    windows[subset, padding + first - max_dist]], axis=1)
+        num_available = available.sum(axis=1)
+        failed[subset[num_available == 0]] = True
+        k = (rng.random(len(subset)) * num_available).astype(np.int64)
+        choice = (np.cumsum(available, axis=1, dtype=np.int16) > k[:, None]).argmax(axis=1)
+        repeat = np.where(choice < width, first + min_dist + choice, first - max_dist + choice - width)
+        return np.clip(repeat, 0, num_places - 1)
+
+    def place_repeats(firsts, min_dist, max_dist, code, first_slot):
+        width = max_dist - min_dist + 1
+        for j in range(firsts.shape[1]):
+            first = firsts[:, j]
+
+            # Rejection sampling: draw any place at an allowed distance, keep it if it's available (still uniform
+            # among the available ones). Sequences that keep drawing unavailable places look at all options at once.
+            repeat = np.zeros(num_sequences, dtype=np.int64)
+            pending = rows
+            for _ in range(16):
+                offset = rng.integers(0, 2 * width, size=len(pending))
+                option = np.where(offset < width, first[pending] + min_dist + offset,
+                                  first[pending] - max_dist + offset - width)
+                accepted = (option >= 0) & (option < num_places)
+                accepted[accepted] = free[pending[accepted], option[accepted]]
+                repeat[pending[accepted]] = option[accepted]
+                pending = pending[~accepted]
+                if len(pending) <= num_sequences // 100:
+                    break
+            if len(pending) > 0:
+                repeat[pending] = choose_in_windows(pending, first[pending], min_dist, max_dist)
+
+            take(repeat, code, first_slot + j)
+
+            # the earlier of the two places is the first occurrence
+            backward = repeat < first
+            types[rows[backward], repeat[backward]] = code - 1
+            types[rows[backward], first[backward]] = code
+
+    # Vigilance trials (weighted sampling without replacement, in sampling order)
+    keys = np.log(vig_weights(num_places))[None, :] + rng.gumbel(size=(num_sequences, num_places))
+    vig_places = top_places(keys, num_vigs)
+    for j in range(num_vigs):
+        take(vig_places[:, j], TYPE_CODES["vig"], j)
+    place_repeats(vig_places, min_dist_vigs, max_dist_vigs, TYPE_CODES["vig repeat"], 0)
+
+    # First set of targets (start phase places in random order, then any other place)
+    num_first_targets = min(25, num_targets)
+    keys = rng.random((num_sequences, num_places)) + (columns <= min_dist_targets)[None, :]
+    keys[~free] = -np.inf
+    first_target_places = top_places(keys, num_first_targets)
+    for j in range(num_first_targets):
+        take(first_target_places[:, j], TYPE_CODES["target"], j)
+    place_repeats(first_target_places, min_dist_targets, max_dist_targets, TYPE_CODES["target repeat"], 0)
+
+    # First set of fillers (second half of the sequence)
+    num_first_fillers = int((float(6) / 10) * num_fillers)
+    keys = np.where(free & (columns >= int(num_places / 2))[None, :], rng.random((num_sequences, num_places)),
+                    -np.inf)
+    first_filler_places = top_places(keys, num_first_fillers)
+    for j in range(num_first_fillers):
+        take(first_filler_places[:, j], TYPE_CODES["filler"], j)
+
+    # Remaining targets (first available place from evenly spaced desired places on, lowest available if none)
+    num_rest = num_targets - num_first_targets
+    if num_rest > 0:
+        increment = round(float(num_places - min_dist_targets) / num_rest)
+        desired = rng.integers(min_dist_targets, min_dist_targets + increment + 1, size=num_sequences)
+        target_places = np.zeros((num_sequences, num_rest), dtype=np.int64)
+        for j in range(num_rest):
+            place = np.minimum(desired + j * increment, num_places - 1)
+            taken = ~free[rows, place] | (desired + j * increment >= num_places)
+            subset = rows[taken]  # only these have to look further
+            later = free[subset] & (columns[None, :] >= (desired[subset] + j * increment)[:, None])
+            place[subset] = np.where(later.any(axis=1), later.argmax(axis=1), free[subset].argmax(axis=1))
+            target_places[:, j] = place
+            take(place, TYPE_CODES["target"], num_first_targets + j)
+        place_repeats(target_places, min_dist_targets, max_dist_targets, TYPE_CODES["target repeat"],
+                      num_first_targets)
+
+    # Remaining fillers (the places left, in order)
+    rank = np.cumsum(free, axis=1) - 1
+    slots[free] = num_first_fillers + rank[free]
+    types[free] = TYPE_CODES["filler"]
+
+    # Every sequence has to hold every image the right number of times
+    expected = {"target": num_targets, "target repeat": num_targets, "filler": num_fillers, "vig": num_vigs,
+                "vig repeat": num_vigs}
+    for label, num in expected.items():
+        failed[(types == TYPE_CODES[label]).sum(axis=1) != num] = True
+    return failed
+
+
+def decode_sequence(type_codes, slots, images):
+    """
+    Turns one row of create_sequences_batch into a sequence like create_sequence returns.
+
+    :param type_codes: type codes of one sequence
+    :param slots: image indices of one sequence
+    :param images: dict with keys: ["targets", "vigs", "fillers"] and values: lists of stimuli to be used
+    :return: two lists. One with the images of the sequence. The other describing trial types.
+    """
+    sequence = [images[TYPE_IMAGES[code]][slot] for code, slot in zip(type_codes.tolist(), slots.tolist())]
+    return sequence, [TYPE_LABELS[code] for code in type_codes.tolist()]
+
+
+# endregion
+
+# region Track building function
+def track_seed(seed, worker):
+    """
+    :param seed: seed of the whole run
+    :param worker: index of the track
+    :return: seed for one track, so a track doesn't depend on which process builds it or on the tracks before it
+    """
+    return int(np.random.SeedSequence([seed, worker]).generate_state(1)[0])
+
+
+def create_track(worker, settings, selection=None):
+    """
+    Creates one track: selects the images for every block, builds the sequences and checks the result.
+
+    :param worker: index of the track
+    :param settings: dict with the image lists and generation parameters (see __main__)
+    :param selection: optional lists of (clusters of) targets, fillers and vigs for the track (e.g., chosen by an
+    ExposureScheduler), drawn at random if None
+    :return: two lists of lists (one per block). One with the image sequences, the other describing trial types. And a
+    dict with placement statistics (see new_placement_stats).
+    """
+    random.seed(track_seed(settings["seed"], worker))
+    np.random.seed(track_seed(settings["seed"], worker))
+    num_blocks = settings["num_blocks"]
+    num_targets = settings["num_targets"]
+    num_fillers = settings["num_fillers"]
+    num_vigs = settings["num_vigs"]
+
+    # region Selecting images
+    # ------------------------
+    if selection is None:
+        # Sample and remove (the free entries are kept in FreeSlots, taking the k-th remaining one doesn't shift a list)
+        targets_all = settings["targets_all"]
+        targets_available = FreeSlots(len(targets_all))
+        if settings["separate_fillers"]:
+            fillers_all = settings["fillers_all"]
+            fillers_available = FreeSlots(len(fillers_all))
+        else:
+            fillers_all = targets_all
+            fillers_available = targets_available  # pointing to the same places
+
+        targets_selected = \
+            [targets_all[targets_available.pop(random.randrange(len(targets_available)))]
+             for _ in range(num_blocks * num_targets)]
+
+        fillers_selected = \
+            [fillers_all[fillers_available.pop(random.randrange(len(fillers_available)))]
+             for _ in range(num_blocks * num_fillers)]
+
+        vigs_selected = \
+            [fillers_all[fillers_available.pop(random.randrange(len(fillers_available)))]
+             for _ in range(num_blocks * num_vigs)]
+    else:
+        targets_selected, fillers_selected, vigs_selected = (list(x) for x in selection)
+
+    # Select one member of each set (subdir), from the stimulus index (see stimulusIndex.py) instead of listing it
+    if settings["clustering"]:
+        target_members = settings["target_members"]
+        filler_members = settings["filler_members"]
+        targets_selected = [os.path.join(x, random.sample(cluster_members(target_members, x), 1)[0])
+                            for x in targets_selected]
+        fillers_selected = [os.path.join(x, random.sample(cluster_members(filler_members, x), 1)[0])
+                            for x in fillers_selected]
+        vigs_selected = [os.path.join(x, random.sample(cluster_members(filler_members, x), 1)[0])
+                         for x in vigs_selected]
+
+    # Add parent dir
+    targets_selected = [os.path.join(settings["target_dir"], x) for x in targets_selected]
+    fillers_selected = [os.path.join(settings["filler_dir"], x) for x in fillers_selected]
+    vigs_selected = [os.path.join(settings["filler_dir"], x) for x in vigs_selected]
+
+    # Chunk the lists in num_blocks chunks
+    targets_selected = [targets_selected[x:x + num_targets] for x in range(0, len(targets_selected), num_targets)]
+    fillers_selected = [fillers_selected[x:x + num_fillers] for x in range(0, len(fillers_selected), num_fillers)]
+    vigs_selected = [vigs_selected[x:x + num_vigs] for x in range(0, len(vigs_selected), num_vigs)]
+
+    # Add everything together such that each chunk has all the images for one block in it
+    images_selected = [{"targets": targets_selected[i],
+                        "fillers": fillers_selected[i],
+                        "vigs": vigs_selected[i]} for i in range(num_blocks)]
+    # endregion
+
+    # region Create sequence
+    # ----------------------
+    # Reorder the images in one track of num_blocks valid sequences
+    track = []  # list of sequences (blocks) for one worker
+    types = []  # describes trial types (e.g., "target repeat")
+    stats = new_placement_stats()
+
+    for sequence_i in range(len(images_selected)):
+        sequence_current, types_current = create_sequence(images_selected[sequence_i], settings["min_dist_targets"],
+                                                          settings["max_dist_targets"], settings["min_dist_vigs"],
+                                                          settings["max_dist_vigs"], stats=stats)
+        track.append(sequence_current)
+        types.append(types_current)
+
+    # endregion
+
+    # region Safety checks
+    # ---------------------
+    # Track level checks, for stimulus clusters too (e.g., to avoid multiple members of the same cluster in one track)
+    approved, text = check_track(images_selected, track, types, clusters=settings["clustering"],
+                                 min_dist_targets=settings["min_dist_targets"],
+                                 max_dist_targets=settings["max_dist_targets"],
+                                 min_dist_vigs=settings["min_dist_vigs"], max_dist_vigs=settings["max_dist_vigs"])
+
     if not approved:
         raise Exception(text)
-    else:
-        print("Success! Solution found after ", i + 1, " attempts.")
 
-    return sequence, types
+    # endregion
+
+    return track, types, stats
+
+
+def cluster_members(members, cluster):
+    """
+    :param members: dict cluster -> sorted members (see StimulusIndex.clusters)
+    :param cluster: name of the cluster
+    :return: sorted members of the cluster
+    """
+    if cluster not in members:
+        raise Exception(cluster + " is not a cluster (subdirectory) of the stimulus directory")
+    return members[cluster]
+
+
+def init_pool(settings):
+    global pool_settings
+    pool_settings = settings
+
+
+def create_track_in_pool(task):
+    worker, selection = task
+    return worker, create_track(worker, pool_settings, selection)
+
+
+def generate_tracks(workers, settings, jobs, selections=None):
+    """
+    Creates tracks, spread over jobs processes. The tracks don't depend on the number of processes (see track_seed).
+
+    :param workers: indices of the tracks to create
+    :param settings: dict with the image lists and generation parameters
+    :param jobs: number of processes
+    :param selections: optional iterable with the selection (see create_track) of every track, in the order of workers.
+    It is consumed in this process, in order, so it can depend on the tracks before (see exposureScheduler.py)
+    :return: generator of (worker, track, types, placement statistics), in the order of workers
+    """
+    tasks = zip(workers, selections if selections is not None else itertools.repeat(None))
+    if jobs <= 1:
+        for worker, selection in tasks:
+            yield (worker,) + create_track(worker, settings, selection)
+        return
+
+    with multiprocessing.Pool(jobs, initializer=init_pool, initargs=(settings,)) as pool:
+        for worker, (track, types, stats) in pool.imap(create_track_in_pool, tasks, chunksize=4):
+            yield worker, track, types, stats
+
+
+def write_json_atomic(data, path):
+    """
+    Writes a json file, via a temporary file so no half-written track is ever left behind.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as fp:
+        json.dump(data, fp)
+    os.replace(tmp_path, path)
+
+
+def lock_track_dir(track_dir):
+    """
+    Makes sure only one generation run writes to a track dir at a time (e.g., a top-up while another one is running).
+
+    :return: path of the lock file, remove it when done
+    """
+    lock_path = os.path.join(track_dir, ".generation.lock")
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        raise Exception("another generation run is writing to " + track_dir + " (remove " + lock_path +
+                        " if that run is no longer going)")
+    with os.fdopen(fd, "w") as f:
+        f.write(str(os.getpid()))
+    return lock_path
+
+
+# endregion
+
+# region Free places
+class FreeSlots:
+    """
+    The places in a sequence that are still available, in sorted order.
+
+    Backed by a Fenwick tree (binary indexed tree) over the places, so counting the free places in a range, finding the
+    k-th free place and taking a place are all O(log(num_places)), instead of scanning (and shifting) a list of places.
+    """
+
+    def __init__(self, num_places, free=True):
+        """
+        :param num_places: total number of places in the sequence
+        :param free: whether all places are available to start with (or none of them)
+        """
+        self.num_places = num_places
+        self.free = bytearray([1 if free else 0]) * num_places
+        self.num_free = num_places if free else 0
+        # tree[i] = number of free places in (i - lowbit(i), i] (1-based)
+        self.tree = [0] + [i & -i if free else 0 for i in range(1, num_places + 1)]
+        self.top_bit = 1 << (num_places.bit_length() - 1) if num_places > 0 else 0
+
+    def __len__(self):
+        return self.num_free
+
+    def __contains__(self, place):
+        return 0 <= place < self.num_places and self.free[place] == 1
+
+    def __iter__(self):
+        return (place for place in range(self.num_places) if self.free[place])
+
+    def remove(self, place):
+        if place not in self:
+            raise ValueError("place " + str(place) + " is not available")
+        self.free[place] = 0
+        self.num_free -= 1
+        self.update(place, -1)
+
+    def add(self, place):
+        if place in self or not 0 <= place < self.num_places:
+            raise ValueError("place " + str(place) + " is already available")
+        self.free[place] = 1
+        self.num_free += 1
+        self.update(place, 1)
+
+    def update(self, place, delta):
+        i = int(place) + 1
+        while i <= self.num_places:
+            self.tree[i] += delta
+            i += i & -i
+
+    def count_below(self, place):
+        """
+        :return: number of free places < place
+        """
+        i = min(max(int(place), 0), self.num_places)
+        count = 0
+        while i > 0:
+            count += self.tree[i]
+            i -= i & -i
+        return count
+
+    def count_range(self, low, high):
+        """
+        :return: number of free places in [low, high]
+        """
+        if high < low:
+            return 0
+        return self.count_below(high + 1) - self.count_below(low)
+
+    def select(self, k):
+        """
+        :param k: rank (0 = the lowest free place)
+        :return: k-th free place
+        """
+        if not 0 <= k < self.num_free:
+            raise IndexError("free place index out of range")
+        position = 0
+        step = self.top_bit
+        while step > 0:
+            next_position = position + step
+            if next_position <= self.num_places and self.tree[next_position] <= k:
+                position = next_position
+                k -= self.tree[next_position]
+            step >>= 1
+        return position  # position + 1 is the 1-based index of the place
+
+    def select_in_range(self, k, low, high):
+        """
+        :return: k-th free place in [low, high]
+        """
+        return self.select(self.count_below(low) + k)
+
+    def pop(self, k):
+        """
+        Takes the k-th free place.
+        """
+        place = self.select(k)
+        self.remove(place)
+        return place
+
+    def range_list(self, low, high):
+        """
+        :return: sorted list of the free places in [low, high]
+        """
+        low = max(low, 0)
+        high = min(high, self.num_places - 1)
+        return [place for place in range(low, high + 1) if self.free[place]]
+
+    def successor(self, place):
+        """
+        :return: lowest free place > place, None if there is none
+        """
+        rank = self.count_below(place + 1)
+        return self.select(rank) if rank < self.num_free else None
 
 
 # endregion
 
 # region Functions selecting places in the sequence
-def distribute_vigs(places_available, num, num_places, min_dist, max_dist):
+def distribute_vigs(places_available, num, num_places, min_dist, max_dist, placed=None, stats=None):
     """
     Chooses places to put vigs
 
-    :param places_available: sorted list of places in the sequence that are still available
+    :param places_available: FreeSlots, places in the sequence that are still available
     :param num: number of places to choose
     :param num_places: total number of places in the sequence (including unavailable ones)
     :param min_dist: minimum distance between first occurrence and repeat (difference in index)
     :param max_dist: maximum distance between first occurrence and repeat (difference in index)
+    :param placed: optional dict of the pairs placed so far (see allocate_repeats)
+    :param stats: optional dict to count repairs in (see allocate_repeats)
     :return: list of chosen places
     """
     # Sampling weights (higher weights for early places)
-    p = np.concatenate([np.repeat(3, 70 / 215 * num_places),
-                        np.repeat(1, 110 / 215 * num_places),
-                        np.repeat(0.3, 35 / 215 * num_places)])
-    p = np.float64(p) / np.sum(p)
+    p = vig_weights(num_places)
 
     # Choose places
-    chosen_places = list(np.random.choice(places_available, num, replace=False, p=p))
+    chosen_places = list(np.random.choice(list(places_available), num, replace=False, p=p))
     for place in chosen_places:
         places_available.remove(place)
     chosen_places = [[x] for x in chosen_places]
 
     # Choose places for repeats
-    chosen_places = allocate_repeats(chosen_places, places_available, min_dist, max_dist)
+    chosen_places = allocate_repeats(chosen_places, places_available, min_dist, max_dist, placed=placed, stats=stats)
 
     return chosen_places
 
 
-def distribute_first_targets(places_available, num, min_dist, max_dist, start_phase_length):
+def distribute_first_targets(places_available, num, min_dist, max_dist, start_phase_length, placed=None, stats=None):
     """
     Chooses places for a first batch of targets
 
@@ -150,17 +818,19 @@ def distribute_first_targets(places_available, num, min_dist, max_dist, start_ph
     of the sequence). This is done to ensure that repeats can happen relatively early in the sequence too and won't
     all be pushed toward the end of the sequence.
 
-    :param places_available: sorted list of places in the sequence that are still available
+    :param places_available: FreeSlots, places in the sequence that are still available
     :param num: number of places to choose
     :param min_dist: minimum distance between first occurrence and repeat (difference in index)
     :param max_dist: maximum distance between first occurrence and repeat (difference in index)
     :param start_phase_length: defines the region that will be considered close enough to the start
+    :param placed: optional dict of the pairs placed so far (see allocate_repeats)
+    :param stats: optional dict to count repairs in (see allocate_repeats)
     :return: list of chosen places
     """
     # Find available start phase places
     start_phase_start = 0
     start_phase_end = start_phase_length
-    start_phase_places = [x for x in places_available if start_phase_start <= x <= start_phase_end]
+    start_phase_places = places_available.range_list(start_phase_start, start_phase_end)
     random.shuffle(start_phase_places)  # not strictly necessary if the images themselves are shuffled
 
     # Choose places
@@ -170,11 +840,11 @@ def distribute_first_targets(places_available, num, min_dist, max_dist, start_ph
         places_available.remove(place)
     # If they run out, pick any other available position
     for i in range(num - len(chosen_places)):
-        chosen_places.append(places_available.pop(random.randrange(len(places_available))))  # pop and append
+        chosen_places.append(places_available.pop(random.randrange(len(places_available))))  # take and append
     chosen_places = [[x] for x in chosen_places]
 
     # Choose places for repeats
-    chosen_places = allocate_repeats(chosen_places, places_available, min_dist, max_dist)
+    chosen_places = allocate_repeats(chosen_places, places_available, min_dist, max_dist, placed=placed, stats=stats)
 
     return chosen_places
 
@@ -186,16 +856,16 @@ def distribute_first_fillers(places_available, num, num_places):
     For a first batch of fillers, places in the second half of the sequence are chosen. This is done to limit the
     predominance of repeat trials late in the sequence.
 
-    :param places_available: sorted list of places in the sequence that are still available
+    :param places_available: FreeSlots, places in the sequence that are still available
     :param num: number of places to choose
     :param num_places: total number of places in the sequence (including unavailable ones)
     :return: list of chosen places
     """
     # Find available places in second half of sequence
-    second_half_places = [x for x in places_available if x >= int(num_places / 2)]
+    second_half_places = places_available.range_list(int(num_places / 2), num_places - 1)
 
     # Choose places
-    chosen_places = np.random.choice(second_half_places, num, replace=False)
+    chosen_places = np.random.choice(second_half_places, min(num, len(second_half_places)), replace=False)
     for place in chosen_places:
         places_available.remove(place)
     chosen_places = [[x] for x in chosen_places]
@@ -203,7 +873,8 @@ def distribute_first_fillers(places_available, num, num_places):
     return chosen_places
 
 
-def distribute_targets(places_available, num, num_places, min_dist, max_dist, start_phase_length):
+def distribute_targets(places_available, num, num_places, min_dist, max_dist, start_phase_length, reserved=None,
+                       placed=None, stats=None):
     """
     Chooses places for targets
 
@@ -211,14 +882,20 @@ def distribute_targets(places_available, num, num_places, min_dist, max_dist, st
     trials of the same type, they are temporarily assigned places at equal intervals. Those temporary places are
     still shifted somewhat later in the function (also to avoid creating a pattern).
 
-    :param places_available: sorted list of places in the sequence that are still available
+    :param places_available: FreeSlots, places in the sequence that are still available
     :param num: number of places to choose
     :param num_places: total number of places in the sequence (including unavailable ones)
     :param min_dist: minimum distance between first occurrence and repeat (difference in index)
     :param max_dist: maximum distance between first occurrence and repeat (difference in index)
     :param start_phase_length: defines the region that will be considered close enough to the start
+    :param reserved: optional FreeSlots, places reserved for fillers that a repeat can take if needed
+    :param placed: optional dict of the pairs placed so far (see allocate_repeats)
+    :param stats: optional dict to count repairs in (see allocate_repeats)
     :return: list of chosen places
     """
+    if num <= 0:
+        return []
+
     # Define increment so we can distribute remaining targets roughly evenly
     increment = float(num_places - start_phase_length) / num  # roughly how far apart to position *different* targets
 
@@ -231,7 +908,8 @@ def distribute_targets(places_available, num, num_places, min_dist, max_dist, st
     chosen_places = [[find_free_place(places_available=places_available, desired_place=x)] for x in chosen_places]
 
     # Choose places for repeats
-    chosen_places = allocate_repeats(chosen_places, places_available, min_dist, max_dist)
+    chosen_places = allocate_repeats(chosen_places, places_available, min_dist, max_dist, reserved=reserved,
+                                     placed=placed, stats=stats)
 
     return chosen_places
 
@@ -242,49 +920,329 @@ def distribute_fillers(places_available, num):
 
     This function is used for those fillers that weren't in the first batch.
 
-    :param places_available: sorted list of places in the sequence that are still available
+    :param places_available: FreeSlots, places in the sequence that are still available
     :param num: number of places to choose
     :return: list of chosen places
     """
-    chosen_places = places_available[:num]
-    chosen_places = [[place] for place in chosen_places]
+    chosen_places = [[places_available.select(k)] for k in range(min(num, len(places_available)))]
     return chosen_places
 
 
-def allocate_repeats(first_places, places_available, min_dist, max_dist):
+def allocate_repeats(first_places, places_available, min_dist, max_dist, reserved=None, placed=None, stats=None):
     """
     Chooses places to for the repeats to go with the chosen first places
 
+    When there is no available place at an allowed distance from a first place, the placement is repaired locally
+    instead of starting the whole sequence over (see repair_repeat).
+
     :param first_places: list of places for the first occurrences
-    :param places_available: sorted list of places in the sequence that are still available
+    :param places_available: FreeSlots, places in the sequence that are still available
     :param min_dist: minimum distance between first occurrence and repeat (difference in index)
     :param max_dist: maximum distance between first occurrence and repeat (difference in index)
+    :param reserved: optional FreeSlots, places reserved for fillers that a repeat can take if needed
+    :param placed: optional dict mapping the places of the pairs placed so far to (pair, min_dist, max_dist), the new
+    pairs are added to it. Repairs can move the pairs in it (the lists are updated in place).
+    :param stats: optional dict, its "repairs" count is increased for every repair
     :return: list of chosen places
     """
 
     for idx in range(len(first_places)):
-        # Looking for places forward in the sequence
-        min_place = first_places[idx][0] + min_dist
-        max_place = first_places[idx][0] + max_dist
-        forward_options = [i for i in places_available if min_place <= i <= max_place]
-
-        # Looking for places backward in the sequence (reversing role of first occurrence and repeat)
-        min_place = first_places[idx][0] - max_dist
-        max_place = first_places[idx][0] - min_dist
-        backward_options = [i for i in places_available if min_place <= i <= max_place]
-
-        # Choose place
-        chosen_place = random.choice(forward_options + backward_options)
+        chosen_place = choose_repeat_place(first_places[idx][0], places_available, min_dist, max_dist)
+        if chosen_place is not None:
+            places_available.remove(chosen_place)
+        else:
+            chosen_place = repair_repeat(first_places[idx], places_available, min_dist, max_dist, reserved, placed)
+            if stats is not None:
+                stats["repairs"] += 1
         first_places[idx].append(chosen_place)
         first_places[idx].sort()
-        places_available.remove(chosen_place)
+        if placed is not None:
+            for place in first_places[idx]:
+                placed[place] = (first_places[idx], min_dist, max_dist)
 
     return first_places
 
 
+def choose_repeat_place(first_place, places, min_dist, max_dist):
+    """
+    Chooses a place at an allowed distance from first_place, forward or backward in the sequence (reversing role of
+    first occurrence and repeat), uniformly among the options. Doesn't take the place.
+
+    :param first_place: place of the first occurrence
+    :param places: FreeSlots to choose from
+    :param min_dist: minimum distance between first occurrence and repeat (difference in index)
+    :param max_dist: maximum distance between first occurrence and repeat (difference in index)
+    :return: chosen place, None if there are no options
+    """
+    # Looking for places forward in the sequence
+    forward_min = first_place + min_dist
+    forward_max = first_place + max_dist
+    num_forward = places.count_range(forward_min, forward_max)
+
+    # Looking for places backward in the sequence
+    backward_min = first_place - max_dist
+    backward_max = first_place - min_dist
+    num_backward = places.count_range(backward_min, backward_max)
+
+    if num_forward + num_backward == 0:
+        return None
+
+    # Choose place (uniformly among the forward options followed by the backward ones)
+    k = random.choice(range(num_forward + num_backward))
+    if k < num_forward:
+        return places.select_in_range(k, forward_min, forward_max)
+    return places.select_in_range(k - num_forward, backward_min, backward_max)
+
+
+def has_options(first_place, places, min_dist, max_dist):
+    """
+    :return: True if places has a place at an allowed distance from first_place (forward or backward)
+    """
+    return places.count_range(first_place + min_dist, first_place + max_dist) + \
+        places.count_range(first_place - max_dist, first_place - min_dist) > 0
+
+
+def repair_repeat(pair, places_available, min_dist, max_dist, reserved=None, placed=None):
+    """
+    Finds a place for a repeat when no available place is at an allowed distance from the first occurrence:
+    1. take a place reserved for a filler, if one is at an allowed distance (that filler goes to a place left over at
+    the end instead), otherwise
+    2. take a place of another pair at an allowed distance, and move that pair to an available place (possibly via a
+    chain of such moves, see shift_pairs), otherwise
+    3. move the first occurrence to an available place that does have an available (or reserved) place at an allowed
+    distance.
+
+    :param pair: list holding the place of the first occurrence, updated if it is moved
+    :param places_available: FreeSlots, places in the sequence that are still available
+    :param min_dist: minimum distance between first occurrence and repeat (difference in index)
+    :param max_dist: maximum distance between first occurrence and repeat (difference in index)
+    :param reserved: optional FreeSlots, places reserved for fillers
+    :param placed: optional dict of the pairs placed so far (see allocate_repeats)
+    :return: chosen place (taken)
+    """
+    pools = [places_available] if reserved is None else [places_available, reserved]
+
+    # 1. Take a reserved place
+    if reserved is not None:
+        chosen_place = choose_repeat_place(pair[0], reserved, min_dist, max_dist)
+        if chosen_place is not None:
+            reserved.remove(chosen_place)
+            return chosen_place
+
+    # 2. Shift other pairs
+    if placed is not None:
+        chosen_place = shift_pairs(pair[0], places_available, min_dist, max_dist, placed)
+        if chosen_place is not None:
+            return chosen_place
+
+    # 3. Move the first occurrence
+    places_available.add(pair[0])
+    candidates = [place for place in places_available
+                  if any(has_options(place, pool, min_dist, max_dist) for pool in pools)]
+    if len(candidates) == 0:
+        places_available.remove(pair[0])
+        raise PlacementError("No two places left that are between " + str(min_dist) + " and " + str(max_dist) +
+                             " apart")
+    pair[0] = random.choice(candidates)
+    places_available.remove(pair[0])
+
+    for pool in pools:
+        chosen_place = choose_repeat_place(pair[0], pool, min_dist, max_dist)
+        if chosen_place is not None:
+            pool.remove(chosen_place)
+            return chosen_place
+
+
+def shift_pairs(first_place, places_available, min_dist, max_dist, placed, max_pairs=1000):
+    """
+    Frees a place at an allowed distance from first_place by moving already placed pairs: a pair with a place q in
+    range gives q up and moves that occurrence to an available place, or in turn to a place of yet another pair, and
+    so on (breadth-first search for the shortest such chain, i.e., an augmenting path). Every moved pair keeps its
+    other occurrence and stays within its own allowed distances.
+
+    :param first_place: place of the first occurrence that needs a repeat
+    :param places_available: FreeSlots, places in the sequence that are still available
+    :param min_dist: minimum distance between first occurrence and repeat (difference in index)
+    :param max_dist: maximum distance between first occurrence and repeat (difference in index)
+    :param placed: dict mapping the places of the pairs placed so far to (pair, min_dist, max_dist), updated
+    :param max_pairs: maximum number of pairs to look at
+    :return: freed place (taken), None if no chain was found
+    """
+    def places_in_range(place, low, high):
+        return [x for x in list(range(place - high, place - low + 1)) + list(range(place + low, place + high + 1))
+                if x in placed]
+
+    def shift(place, new_place):
+        # Move every pair along the chain ending at place one step, starting at the end
+        places_available.remove(new_place)
+        while place is not None:
+            entry = placed.pop(place)
+            entry[0][entry[0].index(place)] = new_place
+            entry[0].sort()
+            placed[new_place] = entry
+            new_place = place
+            place = parent[place]
+        return new_place
+
+    parent = {}  # place of a pair -> place of the pair that would move into it (None: first_place's repeat)
+    visited_pairs = set()
+    queue = collections.deque([(None, first_place, min_dist, max_dist)])
+    while queue and len(visited_pairs) < max_pairs:
+        previous_place, anchor_place, anchor_min_dist, anchor_max_dist = queue.popleft()
+        for place in places_in_range(anchor_place, anchor_min_dist, anchor_max_dist):
+            pair, pair_min_dist, pair_max_dist = placed[place]
+            if id(pair) in visited_pairs:
+                continue
+            visited_pairs.add(id(pair))
+            parent[place] = previous_place
+
+            # The pair gives up place and keeps its other occurrence
+            other_place = pair[0] if pair[1] == place else pair[1]
+            if has_options(other_place, places_available, pair_min_dist, pair_max_dist):
+                return shift(place, choose_repeat_place(other_place, places_available, pair_min_dist,
+                                                        pair_max_dist))
+            queue.append((place, other_place, pair_min_dist, pair_max_dist))
+
+    return None
+
+
+# endregion
+
+# region Searching all placements
+def search_placement(num_targets, num_fillers, num_vigs, min_dist_targets, max_dist_targets, min_dist_vigs,
+                     max_dist_vigs, preferred=None, max_steps=None):
+    """
+    Places all trials of a sequence by backtracking: place by place from the start of the sequence, every place gets a
+    first occurrence, a repeat or a filler, and a choice is only undone when the rest of the sequence can't be filled
+    after it. Unlike the placement in create_sequence, it finds a placement whenever there is one.
+
+    The repeats of targets (and of vigs) follow the order of their first occurrences (any placement can be reordered
+    like that), so a place only has to choose between at most five options: tried in the order of preferred, then the
+    repeat that has to come first, the first occurrences (of the kind with the longest minimum distance first) and the
+    filler. Choices that leave no room for what is still to come (see no_room) and states that were a dead end before
+    are skipped. A setting that fits usually takes a couple of steps per place, ruling out one where the distances only
+    just don't fit (e.g., a long fixed distance for targets and hardly any fillers) can take long.
+
+    :param num_targets: number of targets in one sequence (block)
+    :param num_fillers: number of fillers in one sequence
+    :param num_vigs: number of vigilance images in one sequence
+    :param min_dist_targets: minimum distance between target and repeat (difference in index)
+    :param max_dist_targets: maximum distance between target and repeat (difference in index)
+    :param min_dist_vigs: minimum distance between vig and repeat (difference in index)
+    :param max_dist_vigs: max distance between vig and repeat (difference in index)
+    :param preferred: optional list with the trial type label (see TYPE_LABELS) to try first for every place, or None
+    :param max_steps: optional number of choices to make before giving up
+    :return: places of the vigs, targets (lists of [first, repeat]) and fillers (lists of [place]), None if there is no
+    placement (or no placement was found in max_steps)
+    """
+    num_places = num_targets * 2 + num_vigs * 2 + num_fillers
+    distances = {"target": (min_dist_targets, max_dist_targets), "vig": (min_dist_vigs, max_dist_vigs)}
+    num_left = {"target": num_targets, "vig": num_vigs, "filler": num_fillers}  # first occurrences and fillers to place
+    waiting = {"target": collections.deque(), "vig": collections.deque()}  # first occurrences waiting for their repeat
+    kinds = sorted(waiting, key=lambda x: -distances[x][0])
+    labels = [None] * num_places
+    repeated = []  # first occurrences that got their repeat, in order (to undo)
+    dead_ends = set()
+
+    def state(place):
+        return place, tuple(waiting["target"]), tuple(waiting["vig"]), num_left["target"], num_left["vig"]
+
+    def no_room(place):
+        # Every trial still to place has a range of places it can go to. Too many of them must end before a place,
+        # or start after one: no placement of the rest of the sequence
+        ends = [min(x + distances[kind][1], num_places - 1) for kind in kinds for x in waiting[kind]]
+        starts = [max(x + distances[kind][0], place) for kind in kinds for x in waiting[kind]]
+        for kind in kinds:
+            ends += [num_places - 1 - distances[kind][0]] * num_left[kind]
+            starts += [place + distances[kind][0]] * num_left[kind]
+        ends.sort()
+        starts.sort(reverse=True)
+        return any(end < place + i for i, end in enumerate(ends)) or \
+            any(start > num_places - 1 - i for i, start in enumerate(starts))
+
+    def options(place):
+        if state(place) in dead_ends or no_room(place):
+            return []
+        due = [kind for kind in kinds if waiting[kind] and waiting[kind][0] + distances[kind][1] <= place]
+        if len(due) > 1:
+            return []  # two repeats that can't wait any longer
+        if len(due) == 1:
+            return [due[0] + " repeat"]
+        repeats = sorted([kind for kind in kinds if waiting[kind] and waiting[kind][0] + distances[kind][0] <= place],
+                         key=lambda x: waiting[x][0] + distances[x][1])
+        choices = [kind + " repeat" for kind in repeats] + \
+            [kind for kind in kinds if num_left[kind] > 0 and place + distances[kind][0] < num_places] + \
+            (["filler"] if num_left["filler"] > 0 else [])
+        if preferred is not None and preferred[place] in choices:
+            choices.remove(preferred[place])
+            choices.insert(0, preferred[place])
+        return choices
+
+    def take(place, label, undo=False):
+        kind = label.split(" ")[0]
+        if label.endswith(" repeat"):
+            if undo:
+                waiting[kind].appendleft(repeated.pop())
+            else:
+                repeated.append(waiting[kind].popleft())
+            return
+        num_left[kind] += 1 if undo else -1
+        if kind in waiting:
+            if undo:
+                waiting[kind].pop()
+            else:
+                waiting[kind].append(place)
+
+    place = 0
+    choices = [options(0)]  # options still to try for every place up to place
+    num_steps = 0
+    while place < num_places:
+        if len(choices[-1]) == 0:
+            # Dead end: undo the choice for the place before
+            dead_ends.add(state(place))
+            choices.pop()
+            if place == 0:
+                return None
+            place -= 1
+            take(place, labels[place], undo=True)
+            continue
+        num_steps += 1
+        if max_steps is not None and num_steps > max_steps:
+            return None
+        labels[place] = choices[-1].pop(0)
+        take(place, labels[place])
+        place += 1
+        choices.append(options(place) if place < num_places else [])
+
+    # First occurrences and repeats are paired in order
+    places = {"target": [], "vig": [], "filler": []}
+    unpaired = {"target": collections.deque(), "vig": collections.deque()}
+    for place, label in enumerate(labels):
+        if label.endswith(" repeat"):
+            unpaired[label.split(" ")[0]].popleft().append(place)
+        else:
+            places[label].append([place])
+            if label in unpaired:
+                unpaired[label].append(places[label][-1])
+    return places["vig"], places["target"], places["filler"]
+
+
 # endregion
 
 # region Helper functions
+def vig_weights(num_places):
+    """
+    :param num_places: total number of places in the sequence
+    :return: probability of every place to be chosen for a vig (higher for early places)
+    """
+    num_early = int(70 / 215 * num_places)
+    num_middle = int(110 / 215 * num_places)
+    p = np.concatenate([np.repeat(3, num_early),
+                        np.repeat(1, num_middle),
+                        np.repeat(0.3, num_places - num_early - num_middle)])
+    return np.float64(p) / np.sum(p)
+
+
 def find_free_place(places_available, desired_place):
     """
     Find place in sequence that is available and nearby.
@@ -293,7 +1251,7 @@ def find_free_place(places_available, desired_place):
     desired_place if so. If not, it returns the closest, higher place that is. If there are no higher ones,
     it returns the lowest place in places_available.
 
-    :param places_available: sorted list of places in the sequence that are still available
+    :param places_available: FreeSlots, places in the sequence that are still available
     :param desired_place: place to check
     :return chosen place
     """
@@ -301,13 +1259,10 @@ def find_free_place(places_available, desired_place):
         places_available.remove(desired_place)
         return desired_place
 
-    for k in places_available:
-        if k > desired_place:  # assuming places_available is sorted
-            places_available.remove(k)
-            return k
-
-    chosen_place = min(places_available)
-    places_available.remove(min(places_available))
+    chosen_place = places_available.successor(desired_place)
+    if chosen_place is None:
+        chosen_place = places_available.select(0)
+    places_available.remove(chosen_place)
     return chosen_place
 
 
@@ -332,113 +1287,37 @@ def allocate_images(sequence, types, images, places, label):
 # endregion
 
 # region Validation functions
-def get_distances(sequence):
+def check_sequence(sequence, images, min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs):
     """
-    Get distance between two occurrences of each unique element in sequence
+    Sequence level checks (see validateTracks.py).
 
-    Returns 0 if it only occurs once, returns the distance between the last two occurrences if element occurs more
-    than twice 0 if only occurs once
-
-    :param sequence: list
-    :return: dictionary with (element, distance) as key, value pairs
+    :return: (True if the sequence is valid, description of all violations)
     """
-    distances = dict((s, {}) for s in set(sequence))
-    for i in range(len(sequence)):
-        distances[sequence[i]]["distance"] = i - distances[sequence[i]].get("last index", i)
-        distances[sequence[i]]["last index"] = i
-    return {key: value["distance"] for (key, value) in distances.items()}  # dropping "last index" field
+    violations = validate_sequence(sequence, images, min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs)
+    if violations:
+        return False, "; ".join(violations)
+    return True, "All good"
 
 
-def get_occurrences(track):
+def check_track(images, track, types, clusters=False, **distances):
     """
-    Get indices of occurrences of each unique element in two-level nested list (track)
-
-    Returns 0 if it only occurs once, returns the distance between the last two occurrences if element occurs more
-    than twice 0 if only occurs once
+    Track level checks (see validateTracks.py), for the clusters of the images too if clusters is True.
 
-    :param track: two-level nested list (assumes each first order list element is a list itself)
-    :return: dict
+    :return: (True if the track is valid, description of all violations)
     """
-    track_flat = [item for sublist in track for item in sublist]
-    occurrences = dict((s, {"sequence_index": [], "place_index": []}) for s in set(track_flat))
-
-    for sequence_index in range(len(track)):
-        for place_index in range(len(track[sequence_index])):
-            occurrences[track[sequence_index][place_index]]["sequence_index"].append(sequence_index)
-            occurrences[track[sequence_index][place_index]]["place_index"].append(place_index)
-
-    return occurrences
-
-
-def check_sequence(sequence, images, min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs):
-    counts = collections.Counter(sequence)
-    distances = get_distances(sequence)
-
-    if None in sequence:
-        return False, "Not all places in the sequence have been filled"
-    if not all([counts[target] == 2 for target in images["targets"]]):
-        return False, "Not every target appears exactly twice"
-    if not all(counts[vig] == 2 for vig in images["vigs"]):
-        return False, "Not every vig appears exactly twice"
-    if not all(counts[filler] == 1 for filler in images["fillers"]):
-        return False, "Not every filler appears exactly once"
-    if not all([min_dist_targets <= distances[target] <= max_dist_targets for target in images["targets"]]):
-        return False, "Not every target repeat is within the allowed distance range"
-    if not all([min_dist_vigs <= distances[vig] <= max_dist_vigs for vig in images["vigs"]]):
-        return False, "Not every vigilance repeat is within the allowed distance range"
-
-    return True, "All good"
-
-
-def check_track(images, track, types):
-    images_flat = {k: [dictionary[k] for dictionary in images] for k in images[0]}  # list of dicts to dict of lists
-    images_flat = {k: [item for sublist in images_flat[k] for item in sublist] for k in images_flat}  # flatten lists
-    occurrences = get_occurrences(track)
-
-    # Checking occurrences
-    if not all([len(set(occurrences[target]["place_index"])) == 2 for target in images_flat["targets"]]):
-        return False, "Failed track level check. Not every target appears exactly twice"
-    if not all([len(set(occurrences[target]["sequence_index"])) == 1 for target in images_flat["targets"]]):
-        return False, "Failed track level check. Not every target appears in exactly one sequence within the track"
-    if not all([len(set(occurrences[filler]["place_index"])) == 1 for filler in images_flat["fillers"]]):
-        return False, "Failed track level check. Not every filler appears exactly once"
-    if not all([len(set(occurrences[vig]["place_index"])) == 2 for vig in images_flat["vigs"]]):
-        return False, "Failed track level check. Not every vig appears exactly twice"
-    if not all([len(set(occurrences[vig]["sequence_index"])) == 1 for vig in images_flat["vigs"]]):
-        return False, "Failed track level check. Not every vig appears in exactly one sequence within the track"
-
-    # Checking if every place has the right label in types
-    if not all([types[occurrences[target]["sequence_index"][0]][occurrences[target]["place_index"][0]] == "target" for
-                target in images_flat["targets"]]):
-        return False, "Failed track level check. Not every first occurrence of a target is labeled correctly in types"
-    if not all(
-            [types[occurrences[target]["sequence_index"][1]][occurrences[target]["place_index"][1]] == "target repeat"
-             for target in images_flat["targets"]]):
-        return False, "Failed track level check. Not every repeat occurrence of a target is labeled correctly in types"
-    if not all([types[occurrences[vig]["sequence_index"][0]][occurrences[vig]["place_index"][0]] == "vig" for vig in
-                images_flat["vigs"]]):
-        return False, "Failed track level check. Not every first occurrence of a vig is labeled correctly in types"
-    if not all(
-            [types[occurrences[vig]["sequence_index"][1]][occurrences[vig]["place_index"][1]] == "vig repeat" for vig
-             in images_flat["vigs"]]):
-        return False, "Failed track level check. Not every repeat occurrence of a vig is labeled correctly in types"
-    if not all([types[occurrences[filler]["sequence_index"][0]][occurrences[filler]["place_index"][0]] == "filler" for
-                filler in
-                images_flat["fillers"]]):
-        return False, "Failed track level check. Not every first occurrence of a filler is labeled correctly in types"
-
+    violations = validate_track(images, track, types, clusters=clusters, **distances)
+    if violations:
+        return False, "Failed track level check. " + "; ".join(violations)
     return True, "All good"
 
 
 # endregion
 
-if __name__ == "__main__":
-# %% Collect command line arguments ----------------------------------------------------------------------------------
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--image_root', type=str, default="../stimuli/memcat", help='dir containing target images')
-    parser.add_argument('--target_dir', type=str, default="targets", help='sub-dir containing target images')
-    parser.add_argument('--filler_dir', type=str, default="fillers", help='sub-dir containing filler images')
-    parser.add_argument('--track_dir', type=str, default="./sequenceFiles", help='dir store the worker sequences in')
+# region Command line arguments
+def add_sequence_arguments(parser):
+    """
+    Adds the arguments defining one sequence (block) to an argparse parser (shared with inspectSequenceDiagnostics.py).
+    """
     parser.add_argument('--num_targets', type=int, default=60, help='how many target images needed for one block')
     parser.add_argument('--num_fillers', type=int, default=57, help='how many filler images needed for one block')
     parser.add_argument('--num_vigs', type=int, default=19, help='how many vigilance images needed for one block')
@@ -452,6 +1331,18 @@ if __name__ == "__main__":
     parser.add_argument('--max_dist_vigs', type=int, default=4, help='maximum distance (difference in index) between '
                                                                      'first and second presentation of a vigilance '
                                                                      'image')
+
+
+# endregion
+
+if __name__ == "__main__":
+# %% Collect command line arguments ----------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_root', type=str, default="../stimuli/memcat", help='dir containing target images')
+    parser.add_argument('--target_dir', type=str, default="targets", help='sub-dir containing target images')
+    parser.add_argument('--filler_dir', type=str, default="fillers", help='sub-dir containing filler images')
+    parser.add_argument('--track_dir', type=str, default="./sequenceFiles", help='dir store the worker sequences in')
+    add_sequence_arguments(parser)
     parser.add_argument('--num_workers', type=int, default=10, help='number of tracks to construct')
     parser.add_argument('--num_blocks', type=int, default=-1, help='number of sequences (i.e., blocks) per worker, -1 for '
                                                                    'the maximum available')
@@ -460,6 +1351,24 @@ if __name__ == "__main__":
     parser.add_argument('--preview', type=bool, default=False, help='set to true when generating a sequence for the '
                                                                     'mturk preview. Will make sure it is saved with '
                                                                     'the proper filename')
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes to generate tracks with (the tracks '
+                                                            'are the same for any number of processes)')
+    parser.add_argument('--seed', type=int, default=None, help='seed to generate the tracks with, random if not set')
+    parser.add_argument('--report_interval', type=float, default=5, help='seconds between progress reports')
+    parser.add_argument('--top_up', type=bool, default=False, help='set to true to keep the tracks already in '
+                                                                   'track_dir and only generate the ones missing to '
+                                                                   'have num_workers tracks, numbered after the last '
+                                                                   'one (can run while the server is live)')
+    parser.add_argument('--balanced', type=bool, default=False, help='set to true to give every track the images that '
+                                                                     'are in the fewest tracks so far, instead of '
+                                                                     'drawing them at random (see exposureScheduler.py)')
+    parser.add_argument('--stimulus_index', type=str, default="./stimulusIndex.json", help='file to keep the listings '
+                                                                                     'of the stimulus dirs in between '
+                                                                                     'runs (see stimulusIndex.py), '
+                                                                                     'empty to not keep them')
+    parser.add_argument('--pack', type=bool, default=False, help='set to true to write all tracks into one pack file '
+                                                                 '(track_dir/tracks.pack, see trackPack.py) instead '
+                                                                 'of one json file per track')
 
     args = parser.parse_args()
 
@@ -471,7 +1380,9 @@ if __name__ == "__main__":
     target_dir_full = os.path.join(args.image_root, args.target_dir)
     filler_dir_full = os.path.join(args.image_root, args.filler_dir)
 
-    targets_all = os.listdir(target_dir_full)  # list of all (clusters) of targets
+    # Directory listings come from the stimulus index, which only lists directories that changed since the last run
+    stimulus_index = StimulusIndex(args.stimulus_index if args.stimulus_index else None)
+    targets_all = stimulus_index.listing(target_dir_full)  # list of all (clusters) of targets, sorted
 
     if target_dir_full == filler_dir_full:
         separate_fillers = False  # we will be sampling the fillers from the same pool of images as the targets
@@ -479,10 +1390,19 @@ if __name__ == "__main__":
 
     else:
         separate_fillers = True  # we will be sampling the fillers from a different pool of images
-        fillers_all = os.listdir(filler_dir_full)  # list of all (clusters of) fillers
+        fillers_all = stimulus_index.listing(filler_dir_full)  # list of all (clusters of) fillers
         max_num_blocks = min(math.floor(len(targets_all) / args.num_targets),
                              math.floor(len(fillers_all) / (args.num_fillers + args.num_vigs)))
 
+    # Members of every cluster, listed once (and only again when a cluster changes) instead of for every image drawn
+    if args.clustering:
+        target_members = stimulus_index.clusters(target_dir_full)
+        filler_members = stimulus_index.clusters(filler_dir_full) if separate_fillers else target_members
+    else:
+        target_members = filler_members = None
+    stimulus_index.save()
+    print("stimulus index: listed ", stimulus_index.num_listed, " directories")
+
     if args.num_blocks == -1:
         num_blocks = max_num_blocks
     elif args.num_blocks > max_num_blocks:
@@ -495,100 +1415,146 @@ if __name__ == "__main__":
     if args.preview:
         args.num_workers = 1 # we only need one sequence for the mturk preview
 
-# %% Creating worker sequences -----------------------------------------------------------------------------------------
-
-    for worker in range(args.num_workers):
+    check_parameters(args.num_targets, args.num_fillers, args.num_vigs, args.min_dist_targets, args.max_dist_targets,
+                     args.min_dist_vigs, args.max_dist_vigs)  # explains what's wrong with impossible settings
 
-        # region Selecting images
-        # ------------------------
-        # Reset
-        targets_available = copy.deepcopy(targets_all)
-        if separate_fillers:
-            fillers_available = copy.deepcopy(fillers_all)
-        else:
-            fillers_available = targets_available  # pointing to the same list
+    # Every track gets its own seed derived from this one (see track_seed), pass --seed to reproduce a run
+    seed = args.seed if args.seed is not None else random.SystemRandom().randrange(2 ** 32)
+    print("seed: ", seed)
 
-        # Sample and remove
-        targets_selected = \
-            [targets_available.pop(random.randrange(len(targets_available))) for _ in range(num_blocks * args.num_targets)]
+    # Tracks that are already there: a top-up keeps them and continues the numbering after the last one
+    lock_path = lock_track_dir(args.track_dir) if not args.preview else None
+    pack_path = os.path.join(args.track_dir, "tracks.pack")
+    if args.preview:
+        existing_ids = []
+    elif args.pack:
+        existing_ids = list(range(len(TrackPack(pack_path)))) if os.path.isfile(pack_path) else []
+    else:
+        existing_ids = stored_track_ids(args.track_dir)
 
-        fillers_selected = \
-            [fillers_available.pop(random.randrange(len(fillers_available))) for _ in range(num_blocks * args.num_fillers)]
+    if args.top_up and not args.preview:
+        first_id = existing_ids[-1] + 1 if existing_ids else 0
+        workers = range(first_id, first_id + max(args.num_workers - len(existing_ids), 0))
+        print(len(existing_ids), " tracks present, generating ", len(workers), " more (track ", first_id, " on)")
+    else:
+        workers = range(args.num_workers)
+        if existing_ids:
+            print("WARNING: ", len(existing_ids), " tracks present in ", args.track_dir, " will be overwritten (use "
+                  "--top_up=True to add tracks instead)")
 
-        vigs_selected = \
-            [fillers_available.pop(random.randrange(len(fillers_available))) for _ in range(num_blocks * args.num_vigs)]
-
-        # Add parent dir
-        targets_selected = [os.path.join(args.target_dir, x) for x in targets_selected]
-        fillers_selected = [os.path.join(args.filler_dir, x) for x in fillers_selected]
-        vigs_selected = [os.path.join(args.filler_dir, x) for x in vigs_selected]
-
-        # Select one member of each set (subdir)
-        if args.clustering:
-            targets_selected = [os.path.join(x, random.sample(os.listdir(x), 1)[0]) for x in targets_selected]
-            fillers_selected = [os.path.join(x, random.sample(os.listdir(x), 1)[0]) for x in fillers_selected]
-            vigs_selected = [os.path.join(x, random.sample(os.listdir(x), 1)[0]) for x in vigs_selected]
-
-        # Chunk the lists in num_blocks chunks
-        targets_selected = [targets_selected[x:x + args.num_targets] for x in
-                            range(0, len(targets_selected), args.num_targets)]
-        fillers_selected = [fillers_selected[x:x + args.num_fillers] for x in
-                            range(0, len(fillers_selected), args.num_fillers)]
-        vigs_selected = [vigs_selected[x:x + args.num_vigs] for x in range(0, len(vigs_selected), args.num_vigs)]
-
-        # Add everything together such that each chunk has all the images for one block in it
-        # images_selected = [targets_selected[i] + vigs_selected[i] + fillers_selected[i] for i in range(num_blocks)]
-        images_selected = [{"targets": targets_selected[i],
-                            "fillers": fillers_selected[i],
-                            "vigs": vigs_selected[i]} for i in range(num_blocks)]
-        # endregion
-
-        # region Create sequence
-        # ----------------------
-        # Reorder the images in one track of num_blocks valid sequences
-        track = []  # list of sequences (blocks) for one worker
-        types = []  # describes trial types (e.g., "target repeat")
-
-        for sequence_i in range(len(images_selected)):
-            sequence_current, types_current = create_sequence(images_selected[sequence_i], args.min_dist_targets,
-                                                              args.max_dist_targets, args.min_dist_vigs, args.max_dist_vigs)
-            track.append(sequence_current)
-            types.append(types_current)
-
-        # endregion
-
-        # region Safety checks
-        # ---------------------
-        # Track level checks
-        approved, text = check_track(images_selected, track, types)
-
-        if not approved:
-            raise Exception(text)
-
-        # Track level checks for stimulus clusters (e.g., to avoid multiple members of the same cluster in one track)
-        if args.clustering:
-            clusters_selected = \
-                [dict(zip(x.keys(), [[os.path.dirname(z) for z in y] for y in x.values()])) for x in images_selected]
-
-            approved, text = check_track(clusters_selected,
-                                         [[os.path.dirname(y) for y in x] for x in track],
-                                         types)
-            if not approved:
-                raise Exception(text + " (for clusters)")
-
-        # endregion
-
-        # region Save output
-        # ---------------------
-        # Track level checks
-
-        # Saving everything to json file
-        if not args.preview:
-            with open(os.path.join(args.track_dir, "track_" + str(worker).zfill(5)) + ".json", 'w') as fp:
-                json.dump({"sequences": track, "types": types}, fp)
+# %% Creating worker sequences -----------------------------------------------------------------------------------------
+    settings = {"seed": seed,
+                "targets_all": targets_all,
+                "fillers_all": fillers_all if separate_fillers else None,
+                "separate_fillers": separate_fillers,
+                "num_blocks": num_blocks,
+                "num_targets": args.num_targets,
+                "num_fillers": args.num_fillers,
+                "num_vigs": args.num_vigs,
+                "target_dir": args.target_dir,
+                "filler_dir": args.filler_dir,
+                "clustering": args.clustering,
+                "target_members": target_members,
+                "filler_members": filler_members,
+                "min_dist_targets": args.min_dist_targets,
+                "max_dist_targets": args.max_dist_targets,
+                "min_dist_vigs": args.min_dist_vigs,
+                "max_dist_vigs": args.max_dist_vigs}
+
+    # Balanced exposure: the images of every track are the least exposed ones so far (see exposureScheduler.py),
+    # counting the tracks that are kept
+    if args.balanced:
+        if args.top_up and existing_ids:
+            if args.pack:
+                existing_pack = TrackPack(pack_path)
+                existing_tracks = (existing_pack.read(track_i) for track_i in existing_ids)
+            else:
+                existing_tracks = (read_stored_track(args.track_dir, track_i) for track_i in existing_ids)
+            exposures = count_exposures(existing_tracks, args.target_dir, args.filler_dir)
         else:
-            with open(os.path.join(args.track_dir, "previewSequence.json"), 'w') as fp:
-                json.dump({"sequences": track, "types": types}, fp)
-
-        print(worker)
-        # endregion
+            exposures = {"targets": collections.Counter(), "fillers": collections.Counter()}
+        scheduler_rng = random.Random(seed)
+        if separate_fillers:
+            target_scheduler = ExposureScheduler(targets_all, exposures["targets"], scheduler_rng)
+            filler_scheduler = ExposureScheduler(fillers_all, exposures["fillers"], scheduler_rng)
+        else:
+            target_scheduler = filler_scheduler = ExposureScheduler(
+                targets_all, exposures["targets"] + exposures["fillers"], scheduler_rng)
+        selections = schedule_selections(len(workers), target_scheduler, filler_scheduler, num_blocks,
+                                         args.num_targets, args.num_fillers, args.num_vigs)
+    else:
+        selections = None
+
+    pack_writer = None
+    try:
+        if args.pack and not args.preview:
+            pack_writer = PackWriter(pack_path)  # replaces the old pack when closed, so the server sees all or nothing
+            if args.top_up:
+                old_pack = TrackPack(pack_path) if existing_ids else None
+                for track_i in existing_ids:
+                    pack_writer.add_bytes(old_pack.read_bytes(track_i))
+
+        manifest_entries = []  # see trackManifest.py
+        start_time = time.time()
+        last_report = start_time
+        num_done = 0
+        placement_stats = new_placement_stats()
+        for worker, track, types, stats in generate_tracks(workers, settings, args.jobs, selections):
+            merge_placement_stats(placement_stats, stats)
+
+            # region Save output
+            # ---------------------
+            # Saving everything to the pack or a json file
+            if pack_writer is not None:
+                pack_writer.add({"sequences": track, "types": types})
+            elif not args.preview:
+                write_json_atomic({"sequences": track, "types": types},
+                                  os.path.join(args.track_dir, "track_" + str(worker).zfill(5)) + ".json")
+            else:
+                write_json_atomic({"sequences": track, "types": types},
+                                  os.path.join(args.track_dir, "previewSequence.json"))
+
+            if not args.preview:
+                manifest_entries.append(track_entry(worker, {"sequences": track, "types": types}))
+
+            num_done += 1
+            if time.time() - last_report >= args.report_interval or num_done == len(workers):
+                last_report = time.time()
+                print("generated ", num_done, "/", len(workers), " tracks (",
+                      round(num_done / max(last_report - start_time, 1e-9), 2), " tracks/s), repairs: ",
+                      placement_stats["repairs"], ", searches: ", placement_stats["searches"], " (of ",
+                      placement_stats["sequences"], " sequences)")
+            # endregion
+
+        if pack_writer is not None:
+            pack_writer.close()
+
+        # Manifest of all tracks in track_dir, written once the tracks are in place
+        if not args.preview:
+            manifest_path = os.path.join(args.track_dir, MANIFEST_NAME)
+            manifest = read_manifest(manifest_path) if args.top_up else new_manifest()
+            kept = set(existing_ids) if args.top_up else set()
+            manifest["tracks"] = [x for x in manifest["tracks"] if x["id"] in kept]
+            for track_i in sorted(kept - set(x["id"] for x in manifest["tracks"])):  # kept tracks it didn't know yet
+                if args.pack:
+                    manifest["tracks"].append(track_entry(track_i, old_pack.read(track_i)))
+                else:
+                    manifest["tracks"].append(track_entry(track_i, read_stored_track(args.track_dir, track_i)))
+            manifest["tracks"] += manifest_entries
+            manifest["generations"].append({"firstTrack": workers.start,
+                                            "numTracks": len(workers),
+                                            "settings": {key: value for key, value in vars(args).items()
+                                                         if key not in ("jobs", "report_interval")}})
+            manifest["generations"][-1]["settings"]["seed"] = seed
+            write_manifest(manifest, manifest_path)
+
+        if args.balanced:
+            print("tracks per target: ", target_scheduler.spread()[0], " to ", target_scheduler.spread()[1],
+                  ", per filler: ", filler_scheduler.spread()[0], " to ", filler_scheduler.spread()[1])
+    except BaseException:
+        if pack_writer is not None:
+            pack_writer.abort()  # the old pack stays as it was (unless it was already replaced, see PackWriter.abort)
+        raise
+    finally:
+        if lock_path is not None:
+            os.remove(lock_path)
@@ -1,60 +1,299 @@
+import os
+import argparse
+import multiprocessing
 import numpy as np
-from initializeWorkerSequences import create_sequence
+from initializeWorkerSequences import create_sequences_batch, add_sequence_arguments
+from trackFormats import TYPE_LABELS, CompactTrack
+from validateTracks import encode_blocks, encode_types, stored_tracks
 from matplotlib import pyplot as plt
 
 """
 INSPECT DIAGNOSTICS OF HOW SEQUENCES ARE CONSTRUCTED
 
-This code deals with plotting some diagnostics of how create_sequence preconstructs the memory game sequences, 
-by simulating a large number of calls to this function. 
+This code deals with computing diagnostics of how create_sequence preconstructs the memory game sequences, by simulating
+a large number of calls to this function (in batches, with create_sequences_batch, spread over all cores), or of the
+tracks that were actually generated.
 
-One thing we can infer from this is how likely it is to assign repeats to certain places in the sequence. This way, 
-we can spot if zones are way too likely/unlikely to have repeats in them and adjust the create_sequence algorithm 
-accordingly. 
+One thing we can infer from this is how likely it is to assign repeats to certain places in the sequence. This way,
+we can spot if zones are way too likely/unlikely to have repeats in them and adjust the create_sequence algorithm
+accordingly.
 
+The diagnostics are:
+- per place in the sequence, the probability of every trial type (position_probabilities.csv, type_probabilities.png,
+and the probability of a target, first or repeat, in repeat_probabilities.png)
+- the distribution of the distance (lag) between first and repeat presentation, for targets and vigs (lags.csv,
+lag_distributions.png)
+- the distribution of the length of runs of consecutive trials of the same type, and of consecutive repeats of any kind
+(run_lengths.csv, run_lengths.png)
+
+Every batch of sequences is reduced to counts right away (see Diagnostics), so the number of simulations isn't limited
+by memory. The sequence settings are the same arguments as for initializeWorkerSequences.py:
+python inspectSequenceDiagnostics.py --num_simulations 1000000 --min_dist_targets 35 --max_dist_targets 140
+
+Diagnostics of existing tracks (a directory of .json/.trk tracks or a pack) instead of simulations:
+python inspectSequenceDiagnostics.py --track_dir ./sequenceFiles
+python inspectSequenceDiagnostics.py --pack ./sequenceFiles/tracks.pack
 """
 
-# %% Settings ---------------------------------------------------------------------------------------------------------
-num_targets = 60
-num_fillers = 57
-num_vigs = 19
-min_dist_targets = 35
-max_dist_targets = 140
-min_dist_vigs = 1
-max_dist_vigs = 4
-num_simulations = 1000
-
-type_map = {
-    "target": 1,
-    "target repeat": 2,
-    "filler": 3,
-    "vig": 4,
-    "vig repeat": 5
-}
-
-inv_type_map = {v: k for k, v in type_map.items()}
-
-# %% Simulate stimulus set ---------------------------------------------------------------------------------------------
-images_selected = {"targets": list(range(num_targets)),
-                   "fillers": list(range(num_targets, num_targets + num_fillers)),
-                   "vigs": list(range(num_targets + num_fillers, num_targets + num_fillers + num_vigs))}
-
-# %% Simulate sequences ------------------------------------------------------------------------------------------------
-simulations = np.zeros((num_simulations, num_targets * 2 + num_fillers + num_vigs * 2))
-
-for i in range(num_simulations):
-    _, types = create_sequence(images_selected, min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs)
-    simulations[i, :] = [type_map[x] for x in types]
-
-# %% Plots -------------------------------------------------------------------------------------------------------------
-x = np.arange(num_targets * 2 + num_fillers + num_vigs * 2)
-
-# region Repeat probabilities
-repeat_probs = ((simulations == 1) | (simulations == 2)).sum(axis=0)/num_simulations
-plt.bar(x, repeat_probs)
-plt.xlabel("place in sequence")
-plt.ylabel("probability of repeat")
-plt.savefig("repeat_probabilities")
-plt.clf()
+NUM_CODES = len(TYPE_LABELS)
+REPEAT_PAIRS = {"target": (1, 2), "vig": (4, 5)}  # type code of the first presentation and of the repeat
+RUN_GROUPS = {label: [code] for code, label in enumerate(TYPE_LABELS) if label is not None}
+RUN_GROUPS["any repeat"] = [2, 5]
+
+
+# region Accumulating diagnostics
+def add_counts(total, counts):
+    """
+    :return: total + counts (arrays of counts, along the first axis), the shorter one padded with zeros
+    """
+    if len(counts) > len(total):
+        total, counts = counts, total
+    total = total.copy()
+    total[:len(counts)] += counts
+    return total
+
+
+class Diagnostics:
+    """
+    Counts of trial types per place, repeat lags and run lengths, over any number of sequences.
+    """
+
+    def __init__(self):
+        self.num_sequences = 0
+        self.place_totals = np.zeros(0, dtype=np.int64)  # number of sequences that have a place
+        self.type_counts = np.zeros((0, NUM_CODES), dtype=np.int64)  # place x type code
+        self.lag_counts = {name: np.zeros(0, dtype=np.int64) for name in REPEAT_PAIRS}  # index = lag
+        self.run_counts = {name: np.zeros(0, dtype=np.int64) for name in RUN_GROUPS}  # index = run length
+
+    def add(self, types, ids):
+        """
+        Adds a batch of sequences of the same length.
+
+        :param types: uint8 array (sequences x places) of type codes
+        :param ids: int array of the same shape, the same value for the first and repeat presentation of an image (e.g.,
+        the slots returned by create_sequences_batch or image ids)
+        """
+        num_sequences, num_places = types.shape
+        self.num_sequences += num_sequences
+        self.place_totals = add_counts(self.place_totals, np.full(num_places, num_sequences, dtype=np.int64))
+
+        codes = types.astype(np.int64) + NUM_CODES * np.arange(num_places)
+        counts = np.bincount(codes.ravel(), minlength=num_places * NUM_CODES).reshape(num_places, NUM_CODES)
+        self.type_counts = add_counts(self.type_counts, counts)
+
+        # Lags: match every repeat with the first presentation of the same image in the same sequence
+        ids = ids.astype(np.int64)
+        key_size = int(ids.max()) + 1 if ids.size > 0 else 1
+        for name, (first_code, repeat_code) in REPEAT_PAIRS.items():
+            first_rows, first_places = np.nonzero(types == first_code)
+            repeat_rows, repeat_places = np.nonzero(types == repeat_code)
+            first_keys = first_rows * key_size + ids[first_rows, first_places]
+            repeat_keys = repeat_rows * key_size + ids[repeat_rows, repeat_places]
+            order = np.argsort(first_keys)
+            match = np.searchsorted(first_keys[order], repeat_keys)
+            match = np.minimum(match, max(len(order) - 1, 0))
+            found = first_keys[order][match] == repeat_keys if len(order) > 0 else np.zeros(0, dtype=bool)
+            lags = repeat_places[found] - first_places[order][match][found]
+            self.lag_counts[name] = add_counts(self.lag_counts[name], np.bincount(lags[lags > 0]))
+
+        # Run lengths: starts and ends of the runs of True in every row, padded with False on both sides
+        for name, group_codes in RUN_GROUPS.items():
+            padded = np.zeros((num_sequences, num_places + 2), dtype=np.int8)
+            padded[:, 1:-1] = np.isin(types, group_codes)
+            edges = np.diff(padded, axis=1)
+            lengths = np.nonzero(edges == -1)[1] - np.nonzero(edges == 1)[1]
+            self.run_counts[name] = add_counts(self.run_counts[name], np.bincount(lengths))
+
+    def merge(self, other):
+        """
+        Adds the counts of another Diagnostics (e.g., computed in another process).
+        """
+        self.num_sequences += other.num_sequences
+        self.place_totals = add_counts(self.place_totals, other.place_totals)
+        self.type_counts = add_counts(self.type_counts, other.type_counts)
+        for name in REPEAT_PAIRS:
+            self.lag_counts[name] = add_counts(self.lag_counts[name], other.lag_counts[name])
+        for name in RUN_GROUPS:
+            self.run_counts[name] = add_counts(self.run_counts[name], other.run_counts[name])
+
+    def type_probabilities(self):
+        """
+        :return: array (places x type codes) with the probability of every type on every place
+        """
+        return self.type_counts / np.maximum(self.place_totals, 1)[:, None]
+
+
+def simulate_batch(task):
+    """
+    :param task: (settings, number of sequences, seed of the batch)
+    :return: Diagnostics of the batch
+    """
+    settings, num_sequences, batch_seed = task
+    types, slots = create_sequences_batch(num_sequences, settings["num_targets"], settings["num_fillers"],
+                                          settings["num_vigs"], settings["min_dist_targets"],
+                                          settings["max_dist_targets"], settings["min_dist_vigs"],
+                                          settings["max_dist_vigs"], rng=np.random.default_rng(batch_seed))
+    diagnostics = Diagnostics()
+    diagnostics.add(types, slots)
+    return diagnostics
+
+
+def simulate(settings, num_simulations, batch_size, jobs, seed=None):
+    """
+    Simulates num_simulations sequences in batches, spread over jobs processes.
+
+    :param settings: dict with the sequence arguments (see add_sequence_arguments)
+    :return: Diagnostics of all simulated sequences
+    """
+    batch_seeds = np.random.SeedSequence(seed).spawn((num_simulations + batch_size - 1) // batch_size)
+    tasks = [(settings, min(batch_size, num_simulations - i * batch_size), batch_seed)
+             for i, batch_seed in enumerate(batch_seeds)]
+    diagnostics = Diagnostics()
+    if jobs <= 1:
+        for task in tasks:
+            diagnostics.merge(simulate_batch(task))
+    else:
+        with multiprocessing.Pool(jobs) as pool:
+            for batch_diagnostics in pool.imap_unordered(simulate_batch, tasks):
+                diagnostics.merge(batch_diagnostics)
+    return diagnostics
+
+
+def track_diagnostics(tracks):
+    """
+    :param tracks: iterable of tracks (dicts with keys "sequences" and "types", or CompactTracks)
+    :return: Diagnostics of all blocks of all tracks
+    """
+    diagnostics = Diagnostics()
+    for track in tracks:
+        if isinstance(track, CompactTrack):
+            ids = np.asarray(track.image_array, dtype=np.int64)
+            codes = track.code_table[track.type_array]
+            offsets = np.asarray(track.block_offsets, dtype=np.int64)
+        else:
+            ids, offsets = encode_blocks(track["sequences"], {})
+            codes = encode_types(track["types"])
+        lengths = np.diff(offsets)
+        if len(lengths) > 0 and (lengths == lengths[0]).all():  # all blocks at once
+            diagnostics.add(codes.reshape(len(lengths), lengths[0]), ids.reshape(len(lengths), lengths[0]))
+        else:
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                diagnostics.add(codes[None, start:end], ids[None, start:end])
+    return diagnostics
+
+
+# endregion
+
+# region Output
+def write_outputs(diagnostics, out_dir):
+    """
+    Writes the diagnostics as csv files and plots to out_dir.
+    """
+    labels = [label for label in TYPE_LABELS if label is not None]
+    probabilities = diagnostics.type_probabilities()[:, 1:]
+    places = np.arange(len(probabilities))
+    np.savetxt(os.path.join(out_dir, "position_probabilities.csv"), np.column_stack([places, probabilities]),
+               delimiter=",", header="place," + ",".join(labels), comments="", fmt=["%d"] + ["%.6f"] * len(labels))
+
+    max_lag = max(len(x) for x in diagnostics.lag_counts.values())
+    lags = np.zeros((max_lag, len(REPEAT_PAIRS)), dtype=np.int64)
+    for i, name in enumerate(REPEAT_PAIRS):
+        lags[:len(diagnostics.lag_counts[name]), i] = diagnostics.lag_counts[name]
+    np.savetxt(os.path.join(out_dir, "lags.csv"), np.column_stack([np.arange(max_lag), lags]), delimiter=",",
+               header="lag," + ",".join(REPEAT_PAIRS), comments="", fmt="%d")
+
+    max_run = max(len(x) for x in diagnostics.run_counts.values())
+    runs = np.zeros((max_run, len(RUN_GROUPS)), dtype=np.int64)
+    for i, name in enumerate(RUN_GROUPS):
+        runs[:len(diagnostics.run_counts[name]), i] = diagnostics.run_counts[name]
+    np.savetxt(os.path.join(out_dir, "run_lengths.csv"), np.column_stack([np.arange(max_run), runs]), delimiter=",",
+               header="run length," + ",".join(RUN_GROUPS), comments="", fmt="%d")
+
+    # region Repeat probabilities
+    plt.bar(places, probabilities[:, 0] + probabilities[:, 1])
+    plt.xlabel("place in sequence")
+    plt.ylabel("probability of repeat")
+    plt.savefig(os.path.join(out_dir, "repeat_probabilities"))
+    plt.clf()
+    # endregion
+
+    # region Type probabilities
+    bottom = np.zeros(len(places))
+    for i, label in enumerate(labels):
+        plt.bar(places, probabilities[:, i], bottom=bottom, label=label, width=1)
+        bottom += probabilities[:, i]
+    plt.xlabel("place in sequence")
+    plt.ylabel("probability of trial type")
+    plt.legend()
+    plt.savefig(os.path.join(out_dir, "type_probabilities"))
+    plt.clf()
+    # endregion
+
+    # region Lag distributions
+    fig, axes = plt.subplots(1, len(REPEAT_PAIRS), figsize=(10, 4))
+    for ax, (i, name) in zip(axes, enumerate(REPEAT_PAIRS)):
+        ax.bar(np.arange(max_lag), lags[:, i] / max(lags[:, i].sum(), 1))
+        ax.set_xlabel("distance between " + name + " and repeat")
+        ax.set_ylabel("probability")
+    fig.tight_layout()
+    fig.savefig(os.path.join(out_dir, "lag_distributions"))
+    plt.close(fig)
+    # endregion
+
+    # region Run lengths
+    for i, name in enumerate(RUN_GROUPS):
+        nonzero = np.flatnonzero(runs[:, i])
+        if len(nonzero) > 0:
+            plt.plot(np.arange(max_run)[nonzero], runs[nonzero, i] / runs[:, i].sum(), marker="o", label=name)
+    plt.yscale("log")
+    plt.xlabel("run length (consecutive trials of the same type)")
+    plt.ylabel("probability")
+    plt.legend()
+    plt.savefig(os.path.join(out_dir, "run_lengths"))
+    plt.clf()
+    # endregion
+
+
+def print_summary(diagnostics):
+    print("sequences: ", diagnostics.num_sequences)
+    for name, counts in diagnostics.lag_counts.items():
+        if counts.sum() > 0:
+            lags = np.arange(len(counts))
+            print(name, " lags: mean ", round(float((lags * counts).sum() / counts.sum()), 2), ", range ",
+                  int(np.flatnonzero(counts)[0]), " to ", int(np.flatnonzero(counts)[-1]))
+    for name, counts in diagnostics.run_counts.items():
+        if counts.sum() > 0:
+            print("longest run of ", name, ": ", int(np.flatnonzero(counts)[-1]))
+
+
 # endregion
 
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    add_sequence_arguments(parser)
+    parser.add_argument('--num_simulations', type=int, default=100000, help='number of sequences to simulate')
+    parser.add_argument('--batch_size', type=int, default=10000, help='number of sequences simulated at once')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of processes to simulate with')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the simulations, random if not set')
+    parser.add_argument('--track_dir', type=str, default=None, help='dir with existing tracks to compute the '
+                                                                    'diagnostics of, instead of simulating')
+    parser.add_argument('--pack', type=str, default=None, help='pack with existing tracks to compute the diagnostics '
+                                                               'of, instead of simulating')
+    parser.add_argument('--out_dir', type=str, default=".", help='dir to write the csv files and plots to')
+    args = parser.parse_args()
+
+    # %% Compute diagnostics ------------------------------------------------------------------------------------------
+    if args.track_dir is not None or args.pack is not None:
+        seen = set()  # a track can be there both as json and as compact file, count it once
+        tracks = (track for name, track in stored_tracks(args.track_dir, args.pack)
+                  if os.path.splitext(name)[0] not in seen and not seen.add(os.path.splitext(name)[0]))
+        diagnostics = track_diagnostics(tracks)
+    else:
+        diagnostics = simulate(vars(args), args.num_simulations, args.batch_size, args.jobs, args.seed)
+
+    # %% Outputs ------------------------------------------------------------------------------------------------------
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    print_summary(diagnostics)
+    write_outputs(diagnostics, args.out_dir)
@@ -0,0 +1,117 @@
+import os
+import json
+import argparse
+
+"""
+STIMULUS INDEX
+
+The code deals with knowing which stimuli there are without listing the stimulus directories over and over (see
+initializeWorkerSequences.py). With clustering, every target, filler and vig of every track is drawn from a cluster
+directory; listing that directory every time means hundreds of thousands of listings for one generation run, which is
+slow on networked storage.
+
+The index holds, for every stimulus directory (e.g., stimuli/memcat/targets), its sorted entries and, with clustering,
+the sorted members of every cluster (subdirectory). It is saved as a json file and kept between runs. A directory is
+only listed again when its modification time changed (i.e., when entries were added, removed or renamed), so a run with
+unchanged stimuli takes one stat per directory instead of a listing per drawn image.
+
+Building (or refreshing) the index by hand:
+python stimulusIndex.py --image_root ../stimuli/memcat --dirs targets fillers --clustering=True
+ """
+
+
+class StimulusIndex:
+    """
+    Sorted listings of stimulus directories (and of their clusters), persisted in a json file.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: json file to load the index from and save it to, None to keep it in memory only
+        """
+        self.path = path
+        # realpath -> {"mtime": ..., "entries": [...], "clusters": {name: {"mtime": ..., "members": [...]}}}
+        self.dirs = {}
+        self.changed = False
+        self.num_listed = 0  # directories listed (not taken from the index) since it was loaded
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                self.dirs = json.load(f)["dirs"]
+
+    def listing(self, directory):
+        """
+        :param directory: stimulus directory
+        :return: sorted entries of the directory
+        """
+        return self.entry(directory)["entries"]
+
+    def clusters(self, directory):
+        """
+        Makes sure the members of every cluster (subdirectory) of a stimulus directory are in the index.
+
+        :param directory: stimulus directory
+        :return: dict cluster name -> sorted members of the cluster
+        """
+        entry = self.entry(directory)
+        old_clusters = entry.get("clusters", {})
+        clusters = {}
+        with os.scandir(directory) as it:
+            for dir_entry in it:
+                if not dir_entry.is_dir():
+                    continue
+                mtime = dir_entry.stat().st_mtime_ns
+                cluster = old_clusters.get(dir_entry.name)
+                if cluster is None or cluster["mtime"] != mtime:
+                    cluster = {"mtime": mtime, "members": sorted(os.listdir(dir_entry.path))}
+                    self.num_listed += 1
+                    self.changed = True
+                clusters[dir_entry.name] = cluster
+        if len(clusters) != len(old_clusters):
+            self.changed = True
+        entry["clusters"] = clusters
+        return {name: cluster["members"] for name, cluster in clusters.items()}
+
+    def entry(self, directory):
+        key = os.path.realpath(directory)
+        mtime = os.stat(key).st_mtime_ns
+        entry = self.dirs.get(key)
+        if entry is None or entry["mtime"] != mtime:
+            entry = {"mtime": mtime, "entries": sorted(os.listdir(key)),
+                     "clusters": entry.get("clusters", {}) if entry is not None else {}}
+            self.dirs[key] = entry
+            self.num_listed += 1
+            self.changed = True
+        return entry
+
+    def save(self):
+        """
+        Writes the index (if it changed), via a temporary file.
+        """
+        if self.path is None or not self.changed:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dirs": self.dirs}, f)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_root', type=str, default="../stimuli/memcat", help='dir containing the stimulus dirs')
+    parser.add_argument('--dirs', type=str, nargs="+", default=["targets", "fillers"], help='stimulus dirs to index')
+    parser.add_argument('--clustering', type=bool, default=False, help='also index the members of every cluster')
+    parser.add_argument('--index', type=str, default="./stimulusIndex.json", help='json file holding the index')
+    args = parser.parse_args()
+
+    # %% Index --------------------------------------------------------------------------------------------------------
+    stimulus_index = StimulusIndex(args.index)
+    for stimulus_dir in args.dirs:
+        stimulus_dir = os.path.join(args.image_root, stimulus_dir)
+        if args.clustering:
+            print(stimulus_dir, ": ", len(stimulus_index.clusters(stimulus_dir)), " clusters")
+        else:
+            print(stimulus_dir, ": ", len(stimulus_index.listing(stimulus_dir)), " entries")
+    stimulus_index.save()
+    print("listed ", stimulus_index.num_listed, " directories, index saved to ", args.index)
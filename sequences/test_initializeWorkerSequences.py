@@ -0,0 +1,75 @@
+import random
+import itertools
+import pytest
+import numpy as np
+from initializeWorkerSequences import create_sequence, check_parameters, search_placement, new_placement_stats, \
+    PlacementError
+from validateTracks import validate_sequence
+
+
+def synthetic_images(num_targets, num_fillers, num_vigs):
+    return {"targets": ["t" + str(i) for i in range(num_targets)],
+            "fillers": ["f" + str(i) for i in range(num_fillers)],
+            "vigs": ["v" + str(i) for i in range(num_vigs)]}
+
+
+@pytest.mark.parametrize("num_targets, num_fillers, num_vigs, target_dists, vig_dists", [
+    (20, 10, 5, (35, 140), (1, 4)),
+    (20, 10, 5, (35, 140), (1, 1)),
+    (20, 10, 5, (35, 140), (2, 2)),
+    (100, 20, 30, (1, 1), (2, 2)),
+    (58, 3, 10, (20, 20), (4, 5)),
+])
+def test_tight_settings_always_succeed(num_targets, num_fillers, num_vigs, target_dists, vig_dists):
+    random.seed(0)
+    np.random.seed(0)
+    images = synthetic_images(num_targets, num_fillers, num_vigs)
+    stats = new_placement_stats()
+    for _ in range(10):
+        sequence, types = create_sequence(images, *target_dists, *vig_dists, stats=stats)
+        assert validate_sequence(sequence, images, *target_dists, *vig_dists) == []
+    assert stats["sequences"] == 10
+
+
+@pytest.mark.parametrize("settings, message", [
+    ((1, 0, 1, 1, 1, 2, 2), "No sequence of 4 places has room for 1 targets repeated 1 to 1 places later and 1 vigs"),
+    ((3, 0, 0, 2, 2, 1, 1), "At most 2 targets fit in a sequence of 6 places"),
+    ((61, 27, 1, 55, 56, 4, 7), "At most 56 targets fit in a sequence of 151 places"),
+    ((10, 0, 0, 11, 20, 1, 4), "At most 9 targets can be repeated at least 11 places later"),
+])
+def test_check_parameters_explains(settings, message):
+    with pytest.raises(PlacementError, match=message):
+        check_parameters(*settings)
+
+
+def fits(labels, min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs):
+    distances = {"target": (min_dist_targets, max_dist_targets), "vig": (min_dist_vigs, max_dist_vigs)}
+    waiting = {"target": [], "vig": []}
+    for place, label in enumerate(labels):
+        if label in waiting:
+            waiting[label].append(place)
+        elif label != "filler":
+            kind = label.split(" ")[0]
+            if not waiting[kind] or not distances[kind][0] <= place - waiting[kind].pop(0) <= distances[kind][1]:
+                return False
+    return not waiting["target"] and not waiting["vig"]
+
+
+def test_search_placement_finds_every_placement():
+    # Compared to trying every order of the trials, for small sequences
+    for num_targets, num_fillers, num_vigs, min_dist_targets, extra_targets, min_dist_vigs, extra_vigs in \
+            itertools.product(range(3), range(3), range(2), range(1, 5), range(2), range(1, 3), range(2)):
+        distances = (min_dist_targets, min_dist_targets + extra_targets, min_dist_vigs, min_dist_vigs + extra_vigs)
+        trials = ["target", "target repeat"] * num_targets + ["vig", "vig repeat"] * num_vigs + ["filler"] * num_fillers
+        possible = any(fits(x, *distances) for x in set(itertools.permutations(trials)))
+
+        placement = search_placement(num_targets, num_fillers, num_vigs, *distances)
+        assert (placement is not None) == possible
+        if placement is not None:
+            labels = [None] * len(trials)
+            for label, places in zip(["vig", "target", "filler"], placement):
+                for place in places:
+                    labels[place[0]] = label
+                    if len(place) > 1:
+                        labels[place[1]] = label + " repeat"
+            assert fits(labels, *distances)
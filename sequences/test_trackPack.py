@@ -0,0 +1,27 @@
+import os
+from trackPack import PackWriter, TrackPack
+
+TRACK = {"sequences": [["a.jpg", "b.jpg", "a.jpg"]], "types": [["target", "filler", "target repeat"]]}
+
+
+def test_abort_after_close(tmp_path):
+    path = str(tmp_path / "tracks.pack")
+    writer = PackWriter(path)
+    writer.add(TRACK)
+    try:
+        writer.close()
+        raise RuntimeError("failed right after close")  # e.g., writing the manifest
+    except RuntimeError as e:
+        writer.abort()  # must not hide the original error
+        assert str(e) == "failed right after close"
+    assert TrackPack(path).read(0) == TRACK
+
+
+def test_abort_keeps_old_pack(tmp_path):
+    path = str(tmp_path / "tracks.pack")
+    with PackWriter(path) as writer:
+        writer.add(TRACK)
+    writer = PackWriter(path)
+    writer.abort()
+    assert not os.path.isfile(path + ".tmp")
+    assert len(TrackPack(path)) == 1
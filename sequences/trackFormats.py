@@ -0,0 +1,215 @@
+import os
+import json
+import struct
+import argparse
+import numpy as np
+
+"""
+TRACK FILE FORMATS
+
+The code deals with reading and writing tracks (see initializeWorkerSequences.py) in two formats:
+- json (track_00000.json): {"sequences": [[image path, ...], ...], "types": [[trial type, ...], ...]}
+- compact (track_00000.trk): the same information, but every image path is stored only once (in a dictionary) and
+the sequences and types are stored as flat binary arrays of integers. The arrays are memory-mapped when reading, so
+only the block (sequence) that is actually needed gets decoded.
+
+Layout of a compact file:
+- 8 bytes: MAGIC
+- 4 bytes: length of the header (little-endian unsigned int)
+- header: json with the image dictionary ("images"), the type labels ("typeLabels", index = type code), the start of
+every block in the flat arrays ("blockOffsets", plus the end of the last block) and the byte offsets of the arrays
+- int32 array: for every trial, the index of its image in the image dictionary (all blocks one after the other)
+- uint8 array: for every trial, its type code
+
+Converting existing json tracks (writes a .trk next to every .json that doesn't have an up-to-date one yet):
+python trackFormats.py --track_dir ./sequenceFiles
+ """
+
+MAGIC = b"MGTRACK1"
+
+# Type codes (same as in inspectSequenceDiagnostics.py), index = code
+TYPE_LABELS = [None, "target", "target repeat", "filler", "vig", "vig repeat"]
+TYPE_CODES = {label: code for code, label in enumerate(TYPE_LABELS) if label is not None}
+
+# Summary of the tracks kept next to them (see trackManifest.py), not a track itself
+MANIFEST_NAME = "manifest.json"
+
+
+# region Compact format
+def encode_compact(track):
+    """
+    Encodes a track in the compact format.
+
+    :param track: dict with keys "sequences" and "types" (as stored in the json files)
+    :return: bytes
+    """
+    images = []
+    image_ids = {}
+    for sequence in track["sequences"]:
+        for image in sequence:
+            if image not in image_ids:
+                image_ids[image] = len(images)
+                images.append(image)
+
+    block_offsets = [0]
+    for sequence in track["sequences"]:
+        block_offsets.append(block_offsets[-1] + len(sequence))
+
+    image_array = np.array([image_ids[image] for sequence in track["sequences"] for image in sequence], dtype="<i4")
+    type_array = np.array([TYPE_CODES[label] for types in track["types"] for label in types], dtype=np.uint8)
+
+    # The header holds the offsets of the arrays, which depend on the length of the header itself: pad it with spaces to
+    # a multiple of 8 bytes and recompute until it is stable
+    header = {"images": images, "typeLabels": TYPE_LABELS, "blockOffsets": block_offsets,
+              "imageOffset": 0, "typeOffset": 0}
+    header_bytes = b""
+    while True:
+        header["imageOffset"] = len(MAGIC) + 4 + len(header_bytes)
+        header["typeOffset"] = header["imageOffset"] + image_array.nbytes
+        new_header_bytes = json.dumps(header).encode()
+        new_header_bytes += b" " * (-(len(MAGIC) + 4 + len(new_header_bytes)) % 8)
+        stable = len(new_header_bytes) == len(header_bytes)
+        header_bytes = new_header_bytes
+        if stable:
+            break
+
+    return MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes + image_array.tobytes() + type_array.tobytes()
+
+
+class CompactTrack:
+    """
+    Track read from a compact file. Can be used like the dict loaded from a json track: track["sequences"][i] and
+    track["types"][i] decode block i only. track["codes"][i] gives the type codes of block i as an array.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the compact (.trk) file
+        """
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception(path + " is not a compact track file")
+            header_length = struct.unpack("<I", f.read(4))[0]
+            header = json.loads(f.read(header_length))
+
+        self.images = header["images"]
+        self.type_labels = header["typeLabels"]
+        self.block_offsets = header["blockOffsets"]
+        num_trials = self.block_offsets[-1]
+        self.image_array = np.memmap(path, dtype="<i4", mode="r", offset=header["imageOffset"], shape=(num_trials,))
+        self.type_array = np.memmap(path, dtype=np.uint8, mode="r", offset=header["typeOffset"], shape=(num_trials,))
+
+        # translate the type codes of the file to the ones used here (they're the same, unless the file is older)
+        self.code_table = np.array([TYPE_CODES.get(label, 0) for label in self.type_labels], dtype=np.uint8)
+
+        self.fields = {"sequences": Blocks(self, self.block_images),
+                       "types": Blocks(self, self.block_types),
+                       "codes": Blocks(self, self.block_codes)}
+
+    def __len__(self):
+        return len(self.block_offsets) - 1
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def block_slice(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("block index out of range")
+        index = index % len(self)
+        return slice(self.block_offsets[index], self.block_offsets[index + 1])
+
+    def block_images(self, index):
+        return [self.images[i] for i in self.image_array[self.block_slice(index)].tolist()]
+
+    def block_types(self, index):
+        return [self.type_labels[code] for code in self.type_array[self.block_slice(index)].tolist()]
+
+    def block_codes(self, index):
+        return self.code_table[self.type_array[self.block_slice(index)]]
+
+    def to_dict(self):
+        """
+        :return: the full track as a dict (as stored in the json files)
+        """
+        return {"sequences": [self.block_images(i) for i in range(len(self))],
+                "types": [self.block_types(i) for i in range(len(self))]}
+
+
+class Blocks:
+    """
+    List-like view on the blocks of a CompactTrack, decoding a block when it is indexed.
+    """
+
+    def __init__(self, track, decode):
+        self.track = track
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.track)
+
+    def __getitem__(self, index):
+        return self.decode(index)
+
+
+# endregion
+
+# region Reading and writing
+def read_track(path):
+    """
+    Reads a track in either format (decided by the file extension).
+
+    :param path: path to a .json or .trk file
+    :return: dict (json) or CompactTrack (compact), both indexable as track["sequences"][block]
+    """
+    if path.endswith(".trk"):
+        return CompactTrack(path)
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_compact(track, path):
+    """
+    Writes a track in the compact format (atomically: readers never see a half-written file).
+
+    :param track: dict with keys "sequences" and "types"
+    :param path: path of the .trk file
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(encode_compact(track))
+    os.replace(tmp_path, path)
+
+
+def convert_dir(track_dir):
+    """
+    Writes a compact file next to every json track that doesn't have an up-to-date one yet.
+
+    :param track_dir: dir containing the json tracks
+    :return: number of tracks converted
+    """
+    num_converted = 0
+    for file_name in sorted(os.listdir(track_dir)):
+        if not file_name.endswith(".json") or file_name == MANIFEST_NAME:
+            continue
+        json_path = os.path.join(track_dir, file_name)
+        compact_path = json_path[:-len(".json")] + ".trk"
+        if os.path.isfile(compact_path) and os.path.getmtime(compact_path) >= os.path.getmtime(json_path):
+            continue
+        write_compact(read_track(json_path), compact_path)
+        num_converted += 1
+    return num_converted
+
+
+# endregion
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--track_dir', type=str, default="./sequenceFiles", help='dir containing the json tracks')
+    args = parser.parse_args()
+
+    # %% Convert ------------------------------------------------------------------------------------------------------
+    print("converted ", convert_dir(args.track_dir), " tracks")
@@ -0,0 +1,234 @@
+import os
+import json
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+from trackFormats import TYPE_CODES, MANIFEST_NAME
+from trackPack import TrackPack, track_id, track_file_name, stored_track_ids, read_stored_track
+from validateTracks import stored_tracks
+
+"""
+TRACK MANIFEST
+
+The code deals with a small summary of all generated tracks (see initializeWorkerSequences.py), written next to them as
+manifest.json, so the server and the explore viewer can know what is in the pool without parsing every track:
+- "tracks": per track its id, name and content hash, and per block its number of trials, its trial type codes (one
+digit per trial, codes as in trackFormats.py) and its content hash
+- "generations": the settings of every generation run (the first one and every top-up) and the tracks it produced
+
+The hashes don't depend on the format a track is stored in (json, compact or pack): a block hash covers the image paths
+and type labels of the block, a track hash covers the hashes of its blocks. At startup, the server compares the tracks
+it is about to hand out with the manifest (see TrackManifest.check), which catches a pool that doesn't match the
+manifest (tracks missing, added or changed) or the server settings (fewer blocks than maxNumRuns), and it reads the
+trial types it needs to score a run from the manifest instead of from the track.
+
+(Re)building the manifest of existing tracks, and checking tracks against it:
+python trackManifest.py --track_dir ./sequenceFiles
+python trackManifest.py --pack ./sequenceFiles/tracks.pack --check=True
+ """
+
+MANIFEST_FORMAT = 1
+
+
+# region Building
+def block_hash(sequence, types):
+    """
+    :param sequence: image paths of one block
+    :param types: trial type labels of the block
+    :return: content hash of the block
+    """
+    return hashlib.sha256(json.dumps([list(sequence), list(types)]).encode()).hexdigest()[:16]
+
+
+def encode_codes(types):
+    """
+    :param types: trial type labels of one block
+    :return: the type codes as a string with one digit per trial
+    """
+    return "".join(str(TYPE_CODES[label]) for label in types)
+
+
+def track_entry(file_id, track):
+    """
+    :param file_id: id of the track
+    :param track: dict with keys "sequences" and "types", or a CompactTrack
+    :return: manifest entry of the track
+    """
+    blocks = []
+    for i in range(len(track["sequences"])):
+        types = track["types"][i]
+        blocks.append({"numTrials": len(types),
+                       "codes": encode_codes(types),
+                       "hash": block_hash(track["sequences"][i], types)})
+    return {"id": file_id,
+            "name": track_file_name(file_id),
+            "hash": hashlib.sha256("".join(block["hash"] for block in blocks).encode()).hexdigest()[:16],
+            "blocks": blocks}
+
+
+def new_manifest():
+    return {"format": MANIFEST_FORMAT, "generations": [], "tracks": []}
+
+
+def read_manifest(path):
+    """
+    :return: the manifest at path, an empty one if there is none
+    """
+    if not os.path.isfile(path):
+        return new_manifest()
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise Exception(path + " is not a track manifest (of format " + str(MANIFEST_FORMAT) + ")")
+    return manifest
+
+
+def write_manifest(manifest, path):
+    """
+    Writes a manifest (sorted by track id) via a temporary file, so readers never see a half-written one.
+    """
+    manifest["tracks"].sort(key=lambda x: x["id"])
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def manifest_of_tracks(tracks):
+    """
+    :param tracks: iterable of (track name, track), see validateTracks.stored_tracks
+    :return: manifest of the tracks (without generation settings), a track stored in several formats counts once
+    """
+    manifest = new_manifest()
+    seen = set()
+    for name, track in tracks:
+        file_id = track_id(name)
+        if file_id is not None and file_id not in seen:
+            seen.add(file_id)
+            manifest["tracks"].append(track_entry(file_id, track))
+    return manifest
+
+
+# endregion
+
+# region Reading
+class TrackManifest:
+    """
+    Manifest of the track pool, reloaded when the manifest file is replaced (e.g., after a top-up).
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of manifest.json
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.file_id = None
+        self.tracks = {}  # track id -> entry
+
+    def refresh(self):
+        stat = os.stat(self.path)
+        file_id = (stat.st_ino, stat.st_mtime_ns)
+        with self.lock:
+            if file_id != self.file_id:
+                self.tracks = {entry["id"]: entry for entry in read_manifest(self.path)["tracks"]}
+                self.file_id = file_id
+
+    def __len__(self):
+        self.refresh()
+        return len(self.tracks)
+
+    def entry(self, sequence_file):
+        """
+        :param sequence_file: path or name of a track
+        :return: manifest entry of the track, None if it isn't in the manifest (e.g., the preview track)
+        """
+        self.refresh()
+        file_id = track_id(sequence_file)
+        return self.tracks.get(file_id) if file_id is not None else None
+
+    def codes(self, sequence_file, block):
+        """
+        :param sequence_file: path or name of a track
+        :param block: index of the block
+        :return: uint8 array with the type codes of the block, None if the track isn't in the manifest
+        """
+        entry = self.entry(sequence_file)
+        if entry is None or not 0 <= block < len(entry["blocks"]):
+            return None
+        return np.frombuffer(entry["blocks"][block]["codes"].encode(), dtype=np.uint8) - ord("0")
+
+    def check(self, track_files, load, sample=0, min_blocks=0):
+        """
+        Compares a track pool with the manifest.
+
+        :param track_files: names of the tracks in the pool
+        :param load: function reading a track by name
+        :param sample: number of tracks (chosen at random) to read and compare with their hash, -1 for all
+        :param min_blocks: number of blocks every track should at least have
+        :return: list of problems, empty if the pool matches the manifest
+        """
+        self.refresh()
+        problems = []
+        pool_ids = {track_id(x): x for x in track_files if track_id(x) is not None}
+        missing = sorted(set(self.tracks) - set(pool_ids))
+        unknown = sorted(set(pool_ids) - set(self.tracks))
+        if missing:
+            problems.append(str(len(missing)) + " tracks in the manifest are missing from the pool (e.g., " +
+                            track_file_name(missing[0]) + ")")
+        if unknown:
+            problems.append(str(len(unknown)) + " tracks in the pool are not in the manifest (e.g., " +
+                            pool_ids[unknown[0]] + ")")
+        short = [i for i, entry in self.tracks.items() if len(entry["blocks"]) < min_blocks]
+        if short:
+            problems.append(str(len(short)) + " tracks have fewer than " + str(min_blocks) + " blocks (e.g., " +
+                            track_file_name(short[0]) + ")")
+
+        common = sorted(set(pool_ids) & set(self.tracks))
+        if 0 <= sample < len(common):
+            common = random.sample(common, sample)
+        changed = [i for i in common if track_entry(i, load(pool_ids[i]))["hash"] != self.tracks[i]["hash"]]
+        if changed:
+            problems.append(str(len(changed)) + " of " + str(len(common)) + " tracks checked don't match their hash "
+                            "in the manifest (e.g., " + pool_ids[changed[0]] + ")")
+        return problems
+
+
+# endregion
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--track_dir', type=str, default="./sequenceFiles", help='dir containing the tracks')
+    parser.add_argument('--pack', type=str, default=None, help='pack with the tracks, instead of the track dir')
+    parser.add_argument('--manifest', type=str, default=None, help='manifest file, manifest.json next to the tracks '
+                                                                   'if not set')
+    parser.add_argument('--check', type=bool, default=False, help='check all tracks against the existing manifest '
+                                                                  'instead of (re)building it')
+    args = parser.parse_args()
+
+    manifest_path = args.manifest
+    if manifest_path is None:
+        manifest_path = os.path.join(os.path.dirname(args.pack) if args.pack else args.track_dir, MANIFEST_NAME)
+
+    # %% Check or build -----------------------------------------------------------------------------------------------
+    if args.check:
+        if args.pack is not None:
+            track_pack = TrackPack(args.pack)
+            track_files = track_pack.names()
+            problems = TrackManifest(manifest_path).check(track_files, track_pack.load, sample=-1)
+        else:
+            track_files = [track_file_name(i) for i in stored_track_ids(args.track_dir)]
+            problems = TrackManifest(manifest_path).check(
+                track_files, lambda name: read_stored_track(args.track_dir, track_id(name)), sample=-1)
+        for problem in problems:
+            print(problem)
+        print("checked ", len(track_files), " tracks against ", manifest_path, ": ", "ok" if not problems else
+              "MISMATCH")
+    else:
+        manifest = manifest_of_tracks(stored_tracks(args.track_dir, args.pack))
+        manifest["generations"] = read_manifest(manifest_path)["generations"]  # keep what is known about them
+        write_manifest(manifest, manifest_path)
+        print("wrote the manifest of ", len(manifest["tracks"]), " tracks to ", manifest_path)
@@ -0,0 +1,315 @@
+import os
+import re
+import json
+import struct
+import argparse
+import threading
+import http.server
+from trackFormats import read_track
+
+"""
+PACKED TRACK STORE
+
+The code deals with storing all tracks (see initializeWorkerSequences.py) in one file instead of one json file per
+track, so the track directory stays small to list, back up and sync, however many tracks there are.
+
+Layout of a pack file (tracks.pack):
+- 8 bytes: MAGIC
+- the tracks, one after the other, each as the same json document a track_00000.json file would hold
+- index: (number of tracks + 1) little-endian uint64 byte offsets, track i runs from offset i to offset i + 1
+- 16 bytes: byte offset of the index and number of tracks (little-endian uint64 each)
+
+Track i keeps the name it would have had as a separate file (track_0000i.json), so the assignment registry, the data
+files and the front-end all refer to tracks the same way in both setups. Reading a track takes one read of its index
+entry and one read of the track itself. A pack is always written as a whole to a temporary file first and then moved
+into place, so readers see either the old or the new pack, never a half-written one.
+
+Packing existing json tracks:
+python trackPack.py --pack ./sequenceFiles/tracks.pack --from_dir ./sequenceFiles
+
+Serving the sequences folder for the explore viewer (index.html), with the tracks coming from the pack:
+python trackPack.py --pack ./sequenceFiles/tracks.pack --serve --port 7000
+ """
+
+MAGIC = b"MGTPACK1"
+TRAILER = struct.Struct("<QQ")
+OFFSET = struct.Struct("<QQ")  # start and end of one track (two consecutive index entries)
+TRACK_NAME = re.compile(r"^track_(\d+)\.")
+
+
+def track_file_name(track_id):
+    """
+    :param track_id: integer id of a track
+    :return: file name the track would have as a separate file
+    """
+    return "track_" + str(track_id).zfill(5) + ".json"
+
+
+def track_id(sequence_file):
+    """
+    :param sequence_file: path or name of a track (e.g., ../sequences/sequenceFiles/track_00012.json)
+    :return: integer id of the track (12), None if the name isn't one of a generated track (e.g., the preview track)
+    """
+    match = TRACK_NAME.match(os.path.basename(sequence_file))
+    return int(match.group(1)) if match is not None else None
+
+
+def stored_track_ids(track_dir):
+    """
+    :param track_dir: dir containing tracks as separate files (json or compact)
+    :return: sorted ids of the tracks in the dir
+    """
+    return sorted(set(track_id(x) for x in os.listdir(track_dir)
+                      if (x.endswith(".json") or x.endswith(".trk")) and track_id(x) is not None))
+
+
+def read_stored_track(track_dir, file_id):
+    """
+    :return: track file_id of a track dir, from its json file or else its compact file
+    """
+    path = os.path.join(track_dir, track_file_name(file_id))
+    return read_track(path if os.path.isfile(path) else path[:-len(".json")] + ".trk")
+
+
+# region Writing
+class PackWriter:
+    """
+    Writes a new pack, track by track. The pack only replaces an existing one when the writer is closed without errors.
+
+    with PackWriter("tracks.pack") as writer:
+        writer.add(track)
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the pack file
+        """
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(MAGIC)
+        self.offsets = [len(MAGIC)]
+        self.closed = False
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def add(self, track):
+        """
+        :param track: dict with keys "sequences" and "types"
+        :return: id of the track in the pack
+        """
+        return self.add_bytes(json.dumps(track).encode())
+
+    def add_bytes(self, data):
+        """
+        :param data: json document of a track (e.g., as read with TrackPack.read_bytes)
+        :return: id of the track in the pack
+        """
+        self.file.write(data)
+        self.offsets.append(self.file.tell())
+        return len(self) - 1
+
+    def close(self):
+        index_offset = self.file.tell()
+        self.file.write(struct.pack("<" + str(len(self.offsets)) + "Q", *self.offsets))
+        self.file.write(TRAILER.pack(index_offset, len(self)))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        self.closed = True
+
+    def abort(self):
+        """
+        Drops the new pack, the existing one stays as it was. No-op once the writer is closed (the new pack is in place
+        then).
+        """
+        if self.closed:
+            return
+        self.file.close()
+        if os.path.isfile(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def pack_dir(track_dir, path):
+    """
+    Packs the json tracks (track_00000.json, ...) of a directory. Ids have to be consecutive, starting at 0.
+
+    :param track_dir: dir containing the json tracks
+    :param path: path of the pack file to write
+    :return: number of tracks packed
+    """
+    track_files = sorted((track_id(x), x) for x in os.listdir(track_dir)
+                         if x.endswith(".json") and track_id(x) is not None)
+    with PackWriter(path) as writer:
+        for expected_id, (file_id, file_name) in enumerate(track_files):
+            if file_id != expected_id:
+                raise Exception("cannot pack " + track_dir + ", track " + track_file_name(expected_id) + " is missing")
+            writer.add(read_track(os.path.join(track_dir, file_name)))
+        return len(writer)
+
+
+# endregion
+
+# region Reading
+class TrackPack:
+    """
+    Reads tracks from a pack file by id. Picks up a pack that was replaced in the meantime (e.g., regenerated).
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the pack file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.file_id = None  # (inode, mtime) of the open file
+        self.index_offset = 0
+        self.num_tracks = 0
+
+    def open(self):
+        """
+        (Re)opens the pack if it was replaced since it was last opened. Caller holds the lock.
+
+        :return: (inode, mtime) of the pack
+        """
+        stat = os.stat(self.path)
+        file_id = (stat.st_ino, stat.st_mtime_ns)
+        if file_id != self.file_id:
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.path, "rb")
+            if self.file.read(len(MAGIC)) != MAGIC:
+                raise Exception(self.path + " is not a track pack")
+            self.file.seek(-TRAILER.size, os.SEEK_END)
+            self.index_offset, self.num_tracks = TRAILER.unpack(self.file.read(TRAILER.size))
+            self.file_id = file_id
+        return file_id
+
+    def version(self):
+        """
+        :return: value that changes whenever the pack is replaced
+        """
+        with self.lock:
+            return self.open()
+
+    def __len__(self):
+        with self.lock:
+            self.open()
+            return self.num_tracks
+
+    def names(self):
+        """
+        :return: file names of all tracks in the pack
+        """
+        return [track_file_name(i) for i in range(len(self))]
+
+    def __contains__(self, sequence_file):
+        file_id = track_id(sequence_file)
+        return file_id is not None and file_id < len(self)
+
+    def read_bytes(self, file_id):
+        """
+        :param file_id: id of the track
+        :return: the json document of the track
+        """
+        with self.lock:
+            self.open()
+            if not 0 <= file_id < self.num_tracks:
+                raise Exception("track " + str(file_id) + " is not in " + self.path)
+            self.file.seek(self.index_offset + file_id * 8)
+            start, end = OFFSET.unpack(self.file.read(OFFSET.size))
+            self.file.seek(start)
+            return self.file.read(end - start)
+
+    def read(self, file_id):
+        """
+        :param file_id: id of the track
+        :return: dict with keys "sequences" and "types"
+        """
+        return json.loads(self.read_bytes(file_id))
+
+    def load(self, sequence_file):
+        """
+        Reads a track by its (file) name: from the pack if it holds a track with that id, from the file otherwise (e.g.,
+        the preview track).
+
+        :param sequence_file: path to the track (e.g., ../sequences/sequenceFiles/track_00012.json)
+        :return: parsed track
+        """
+        if sequence_file in self:
+            return self.read(track_id(sequence_file))
+        return read_track(sequence_file)
+
+    def signature(self, sequence_file):
+        """
+        :param sequence_file: path to the track
+        :return: value that changes when the track might have changed (for SequenceCache)
+        """
+        if sequence_file in self:
+            return self.version()
+        stat = os.stat(sequence_file)
+        return stat.st_mtime_ns, stat.st_size
+
+
+# endregion
+
+# region Serving
+def make_handler(pack, directory):
+    """
+    :param pack: TrackPack
+    :param directory: dir to serve the other files from
+    :return: request handler class serving track_XXXXX.json requests from the pack when there is no such file
+    """
+
+    class PackRequestHandler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def do_GET(self):
+            path = self.translate_path(self.path)
+            if os.path.isfile(path) or path not in pack:
+                return super().do_GET()
+            body = pack.read_bytes(track_id(path))
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return PackRequestHandler
+
+
+# endregion
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pack', type=str, default="./sequenceFiles/tracks.pack", help='path of the pack file')
+    parser.add_argument('--from_dir', type=str, default=None, help='dir with json tracks to pack')
+    parser.add_argument('--serve', action='store_true', help='serve the sequences folder for the explore viewer, with '
+                                                             'the tracks coming from the pack')
+    parser.add_argument('--serve_dir', type=str, default=".", help='dir to serve')
+    parser.add_argument('--port', type=int, default=7000, help='port to serve on')
+    args = parser.parse_args()
+
+    # %% Pack ---------------------------------------------------------------------------------------------------------
+    if args.from_dir is not None:
+        print("packed ", pack_dir(args.from_dir, args.pack), " tracks into ", args.pack)
+
+    # %% Serve --------------------------------------------------------------------------------------------------------
+    if args.serve:
+        track_pack = TrackPack(args.pack)
+        print("serving ", args.serve_dir, " (", len(track_pack), " tracks in the pack) on port ", args.port)
+        http.server.ThreadingHTTPServer(("", args.port), make_handler(track_pack, args.serve_dir)).serve_forever()
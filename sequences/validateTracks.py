@@ -0,0 +1,361 @@
+import os
+import sys
+import argparse
+import numpy as np
+from trackFormats import TYPE_CODES, MANIFEST_NAME, CompactTrack, read_track
+from trackPack import TrackPack, track_id
+
+"""
+TRACK VALIDATION
+
+The code deals with checking that sequences and tracks (see initializeWorkerSequences.py) are valid: every target and
+vig appears exactly twice, in the same block, with its repeat at an allowed distance, every filler appears exactly once,
+and every trial is labeled with the right type.
+
+Images are replaced by integer ids first (one dictionary lookup per trial, compact tracks already store them that way),
+after which all checks are done at once on arrays: sorting the ids groups the occurrences of every image, so the first
+and second occurrence of every image, its number of occurrences and its repeat distance are all known after one sort.
+All violations are reported together, not just the first one found.
+
+For clusters (see --clustering in initializeWorkerSequences.py), the same checks run on the cluster (parent dir) of
+every image, computed once per distinct image.
+
+Auditing existing tracks (a directory of .json/.trk tracks or a pack), with the distances they were generated with:
+python validateTracks.py --track_dir ./sequenceFiles
+python validateTracks.py --pack ./sequenceFiles/tracks.pack --min_dist_targets 35 --max_dist_targets 140
+ """
+
+TARGET = TYPE_CODES["target"]
+TARGET_REPEAT = TYPE_CODES["target repeat"]
+FILLER = TYPE_CODES["filler"]
+VIG = TYPE_CODES["vig"]
+VIG_REPEAT = TYPE_CODES["vig repeat"]
+
+ROLES = {"targets": TARGET, "fillers": FILLER, "vigs": VIG}  # which code the first occurrence of a selected image has
+FIRST_CODE = np.array([0, TARGET, TARGET, FILLER, VIG, VIG], dtype=np.uint8)  # role of an image, from any of its codes
+MAX_EXAMPLES = 3
+
+
+# region Encoding
+def encode_blocks(blocks, vocabulary):
+    """
+    Replaces the images of all blocks by integer ids.
+
+    :param blocks: list of lists of images (None for an unfilled place)
+    :param vocabulary: dict image -> id, extended with the images that aren't in it yet
+    :return: int64 array of ids (all blocks one after the other, -1 for None) and the block offsets (plus the end)
+    """
+    ids = np.fromiter((-1 if image is None else vocabulary.setdefault(image, len(vocabulary))
+                       for block in blocks for image in block), dtype=np.int64)
+    offsets = np.zeros(len(blocks) + 1, dtype=np.int64)
+    np.cumsum([len(block) for block in blocks], out=offsets[1:])
+    return ids, offsets
+
+
+def encode_types(types):
+    """
+    :param types: list of lists of trial type labels
+    :return: uint8 array of type codes (all blocks one after the other)
+    """
+    return np.fromiter((TYPE_CODES.get(label, 0) for block in types for label in block), dtype=np.uint8)
+
+
+def encode_selection(selections, vocabulary):
+    """
+    :param selections: list of dicts with keys "targets", "fillers" and "vigs" (the images selected for each block)
+    :param vocabulary: dict image -> id, extended with the selected images
+    :return: uint8 array with the role (type code of the first occurrence) of every image id, 0 if not selected
+    """
+    for selection in selections:
+        for key in ROLES:
+            for image in selection[key]:
+                vocabulary.setdefault(image, len(vocabulary))
+    roles = np.zeros(len(vocabulary), dtype=np.uint8)
+    for selection in selections:
+        for key, role in ROLES.items():
+            roles[[vocabulary[image] for image in selection[key]]] = role
+    return roles
+
+
+def cluster_ids(names, key=os.path.dirname):
+    """
+    :param names: list of images, index = image id
+    :param key: function giving the cluster of an image
+    :return: int64 array with the cluster id of every image id, and the list of clusters (index = cluster id)
+    """
+    clusters = {}
+    ids = np.fromiter((clusters.setdefault(key(name), len(clusters)) for name in names), dtype=np.int64)
+    return ids, list(clusters)
+
+
+# endregion
+
+# region Checks
+def find_violations(ids, offsets, names, codes=None, roles=None, min_dist_targets=None, max_dist_targets=None,
+                    min_dist_vigs=None, max_dist_vigs=None, what="image"):
+    """
+    Checks all blocks of a track (or a single sequence) at once.
+
+    :param ids: integer id of the image on every trial, all blocks one after the other (-1 for an unfilled place)
+    :param offsets: start of every block in ids, plus the end of the last block
+    :param names: image (or cluster) names, index = id, only used in the messages
+    :param codes: optional type codes of the trials, the labels aren't checked without them
+    :param roles: optional role (TARGET, FILLER, VIG) of every id that was selected (0 if it wasn't); without them the
+    role of an image is read from its labels
+    :param min_dist_targets: minimum distance between target and repeat, None to not check it (same for the others)
+    :param max_dist_targets: maximum distance between target and repeat
+    :param min_dist_vigs: minimum distance between vig and repeat
+    :param max_dist_vigs: maximum distance between vig and repeat
+    :param what: what the ids stand for, used in the messages ("image" or "cluster")
+    :return: list of messages, one per violated rule, empty if everything is fine
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    violations = []
+
+    def report(mask, text, id_list):
+        num = int(np.count_nonzero(mask))
+        if num > 0:
+            examples = [str(names[i]) for i in id_list[mask][:MAX_EXAMPLES]]
+            violations.append(text + " (" + what + "s: " + str(num) + ", e.g., " + ", ".join(examples) + ")")
+
+    unfilled = ids < 0
+    if unfilled.any():
+        violations.append("Not all places in the sequence have been filled (" + str(int(unfilled.sum())) + " places)")
+        keep = ~unfilled
+        trial_index = np.flatnonzero(keep)
+        ids = ids[keep]
+        codes = codes[keep] if codes is not None else None
+    else:
+        trial_index = np.arange(len(ids))
+
+    num_ids = max(len(names), int(ids.max()) + 1 if len(ids) > 0 else 0)
+    block_of = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))[trial_index]
+    place_of = trial_index - offsets[block_of]
+
+    # Group the occurrences of every image: the trials of image i are order[starts[i]:starts[i] + counts[i]]
+    order = np.argsort(ids, kind="stable")
+    counts = np.bincount(ids, minlength=num_ids)
+    starts = np.cumsum(counts) - counts
+    present = np.flatnonzero(counts > 0)
+    first = order[starts[present]]
+    twice = present[counts[present] >= 2]
+    second = order[starts[twice] + 1]
+    last = order[starts[twice] + counts[twice] - 1]
+    second_to_last = order[starts[twice] + counts[twice] - 2]
+
+    # Role of every image: from the selection, else from the label of its first occurrence
+    if roles is not None:
+        role = np.zeros(num_ids, dtype=np.uint8)
+        role[:len(roles)] = roles
+        report(role[present] == 0, "Not every image in the sequence was selected for it", present)
+    elif codes is not None:
+        role = np.zeros(num_ids, dtype=np.uint8)
+        role[present] = FIRST_CODE[codes[first]]
+    else:
+        raise Exception("cannot validate without the roles or the types of the images")
+
+    # Occurrences
+    all_ids = np.arange(num_ids)
+    for code, num, label in [(TARGET, 2, "Not every target appears exactly twice"),
+                             (VIG, 2, "Not every vig appears exactly twice"),
+                             (FILLER, 1, "Not every filler appears exactly once")]:
+        report((role == code) & (counts != num), label, all_ids)
+
+    same_block = block_of[first[np.searchsorted(present, twice)]] == block_of[second]
+    for code, label in [(TARGET, "Not every target appears in exactly one sequence"),
+                        (VIG, "Not every vig appears in exactly one sequence")]:
+        report((role[twice] == code) & ~same_block, label, twice)
+
+    # Repeat distances (between the last two occurrences, within one block)
+    distances = place_of[last] - place_of[second_to_last]
+    in_block = block_of[last] == block_of[second_to_last]
+    for code, low, high, label in [
+            (TARGET, min_dist_targets, max_dist_targets, "Not every target repeat is within the allowed distance range"),
+            (VIG, min_dist_vigs, max_dist_vigs, "Not every vigilance repeat is within the allowed distance range")]:
+        if low is None and high is None:
+            continue
+        low = low if low is not None else -np.inf
+        high = high if high is not None else np.inf
+        report((role[twice] == code) & in_block & ((distances < low) | (distances > high)), label, twice)
+
+    # Labels of the first and second occurrences
+    if codes is not None:
+        for code, label in [(TARGET, "target"), (VIG, "vig"), (FILLER, "filler")]:
+            report((role[present] == code) & (codes[first] != code),
+                   "Not every first occurrence of a " + label + " is labeled correctly in types", present)
+        for code, repeat_code, label in [(TARGET, TARGET_REPEAT, "target"), (VIG, VIG_REPEAT, "vig")]:
+            report((role[twice] == code) & (codes[second] != repeat_code),
+                   "Not every repeat occurrence of a " + label + " is labeled correctly in types", twice)
+
+    return violations
+
+
+def block_count_violations(codes, offsets, num_targets=None, num_fillers=None, num_vigs=None):
+    """
+    :param codes: type codes of all trials, all blocks one after the other
+    :param offsets: start of every block, plus the end of the last block
+    :param num_targets: number of targets every block should have, None to not check it (same for the others)
+    :param num_fillers: number of fillers every block should have
+    :param num_vigs: number of vigs every block should have
+    :return: list of messages, one per violated rule
+    """
+    num_blocks = len(offsets) - 1
+    block_of = np.repeat(np.arange(num_blocks), np.diff(offsets))
+    counts = np.bincount(block_of * len(FIRST_CODE) + codes, minlength=num_blocks * len(FIRST_CODE))
+    counts = counts.reshape(num_blocks, len(FIRST_CODE))
+    violations = []
+    for num, code_list, label in [(num_targets, [TARGET, TARGET_REPEAT], "targets"), (num_fillers, [FILLER], "fillers"),
+                                  (num_vigs, [VIG, VIG_REPEAT], "vigs")]:
+        if num is None:
+            continue
+        wrong = np.flatnonzero((counts[:, code_list] != num).any(axis=1))
+        if len(wrong) > 0:
+            violations.append("Not every sequence has " + str(num) + " " + label + " (sequences " +
+                              ", ".join(str(x) for x in wrong[:MAX_EXAMPLES]) + (", ...)" if len(wrong) > MAX_EXAMPLES
+                                                                                  else ")"))
+    return violations
+
+
+def validate_sequence(sequence, images, min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs):
+    """
+    :param sequence: list of images (None for an unfilled place)
+    :param images: dict with keys "targets", "fillers" and "vigs", the images selected for the sequence
+    :return: list of violations (see find_violations)
+    """
+    vocabulary = {}
+    roles = encode_selection([images], vocabulary)
+    ids, offsets = encode_blocks([sequence], vocabulary)
+    return find_violations(ids, offsets, list(vocabulary), roles=roles, min_dist_targets=min_dist_targets,
+                           max_dist_targets=max_dist_targets, min_dist_vigs=min_dist_vigs, max_dist_vigs=max_dist_vigs)
+
+
+def validate_track(images, track, types, clusters=False, **distances):
+    """
+    :param images: list of dicts with keys "targets", "fillers" and "vigs", the images selected for every block
+    :param track: list of lists of images (one per block)
+    :param types: list of lists of trial type labels (one per block)
+    :param clusters: also check that no cluster (parent dir of the images) is used more than its image could be
+    :param distances: optional min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs to check
+    :return: list of violations (see find_violations)
+    """
+    vocabulary = {}
+    roles = encode_selection(images, vocabulary)
+    ids, offsets = encode_blocks(track, vocabulary)
+    codes = encode_types(types)
+    names = list(vocabulary)
+    violations = find_violations(ids, offsets, names, codes=codes, roles=roles, **distances)
+    if clusters:
+        violations += cluster_violations(ids, offsets, names, codes, roles=roles)
+    return violations
+
+
+def cluster_violations(ids, offsets, names, codes, roles=None):
+    """
+    :return: violations (see find_violations) of the clusters of the images, with " (for clusters)" added
+    """
+    image_cluster, cluster_names = cluster_ids(names)
+    cluster_roles = None
+    if roles is not None:
+        cluster_roles = np.zeros(len(cluster_names), dtype=np.uint8)
+        cluster_roles[image_cluster[:len(roles)]] = roles
+    cluster_of = np.where(ids < 0, -1, image_cluster[np.maximum(ids, 0)])
+    return [x + " (for clusters)" for x in find_violations(cluster_of, offsets, cluster_names, codes=codes,
+                                                           roles=cluster_roles, what="cluster")]
+
+
+def audit_track(track, clusters=False, num_targets=None, num_fillers=None, num_vigs=None, **distances):
+    """
+    Checks a stored track, without knowing which images were selected for it: the labels tell the role of every image.
+
+    :param track: dict with keys "sequences" and "types", or a CompactTrack
+    :param clusters: also check the clusters (parent dirs) of the images
+    :param num_targets: number of targets every block should have, None to not check it (same for the others)
+    :param num_fillers: number of fillers every block should have
+    :param num_vigs: number of vigs every block should have
+    :param distances: optional min_dist_targets, max_dist_targets, min_dist_vigs, max_dist_vigs to check
+    :return: list of violations
+    """
+    if isinstance(track, CompactTrack):  # already stored as ids and codes
+        ids = np.asarray(track.image_array, dtype=np.int64)
+        offsets = np.asarray(track.block_offsets, dtype=np.int64)
+        codes = track.code_table[track.type_array]
+        names = track.images
+    else:
+        vocabulary = {}
+        ids, offsets = encode_blocks(track["sequences"], vocabulary)
+        codes = encode_types(track["types"])
+        names = list(vocabulary)
+        if len(codes) != len(ids):
+            return ["The types don't match the sequences (" + str(len(codes)) + " types for " + str(len(ids)) +
+                    " trials)"]
+
+    violations = []
+    unknown = np.flatnonzero(FIRST_CODE[codes] == 0)
+    if len(unknown) > 0:
+        violations.append("Not every trial has a known type (" + str(len(unknown)) + " trials)")
+        codes = codes.copy()
+        codes[unknown] = FILLER  # checked as fillers, so the other checks still run
+    violations += find_violations(ids, offsets, names, codes=codes, **distances)
+    violations += block_count_violations(codes, offsets, num_targets, num_fillers, num_vigs)
+    if clusters:
+        violations += cluster_violations(ids, offsets, names, codes)
+    return violations
+
+
+# endregion
+
+# region Audit
+def stored_tracks(track_dir=None, pack_path=None):
+    """
+    :param track_dir: dir containing json or compact tracks
+    :param pack_path: path of a pack (see trackPack.py), used instead of track_dir if given
+    :return: generator of (track name, track)
+    """
+    if pack_path is not None:
+        pack = TrackPack(pack_path)
+        for name in pack.names():
+            yield name, pack.read(track_id(name))
+        return
+    for file_name in sorted(os.listdir(track_dir)):
+        if (file_name.endswith(".json") or file_name.endswith(".trk")) and file_name != MANIFEST_NAME:
+            yield file_name, read_track(os.path.join(track_dir, file_name))
+
+
+# endregion
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--track_dir', type=str, default="./sequenceFiles", help='dir containing the tracks to audit')
+    parser.add_argument('--pack', type=str, default=None, help='pack file to audit instead of the track dir')
+    parser.add_argument('--min_dist_targets', type=int, default=35, help='minimum distance between target and repeat')
+    parser.add_argument('--max_dist_targets', type=int, default=140, help='maximum distance between target and repeat')
+    parser.add_argument('--min_dist_vigs', type=int, default=1, help='minimum distance between vig and repeat')
+    parser.add_argument('--max_dist_vigs', type=int, default=4, help='maximum distance between vig and repeat')
+    parser.add_argument('--num_targets', type=int, default=-1, help='number of targets per block, -1 to not check it')
+    parser.add_argument('--num_fillers', type=int, default=-1, help='number of fillers per block, -1 to not check it')
+    parser.add_argument('--num_vigs', type=int, default=-1, help='number of vigs per block, -1 to not check it')
+    parser.add_argument('--clustering', type=bool, default=False, help='also check that every cluster (parent dir) '
+                                                                      'is used only once per track')
+    args = parser.parse_args()
+
+    # %% Audit --------------------------------------------------------------------------------------------------------
+    num_tracks = 0
+    num_invalid = 0
+    for name, track in stored_tracks(args.track_dir, args.pack):
+        violations = audit_track(track, clusters=args.clustering,
+                                 num_targets=args.num_targets if args.num_targets >= 0 else None,
+                                 num_fillers=args.num_fillers if args.num_fillers >= 0 else None,
+                                 num_vigs=args.num_vigs if args.num_vigs >= 0 else None,
+                                 min_dist_targets=args.min_dist_targets, max_dist_targets=args.max_dist_targets,
+                                 min_dist_vigs=args.min_dist_vigs, max_dist_vigs=args.max_dist_vigs)
+        num_tracks += 1
+        if violations:
+            num_invalid += 1
+            print(name, ":")
+            for violation in violations:
+                print("    ", violation)
+
+    print("audited ", num_tracks, " tracks, ", num_invalid, " invalid")
+    sys.exit(1 if num_invalid > 0 else 0)
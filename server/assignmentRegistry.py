@@ -0,0 +1,256 @@
+import os
+import csv
+import json
+import argparse
+from filelock import FileLock
+
+"""
+WORKER ASSIGNMENT REGISTRY
+
+The code deals with keeping track of which worker was assigned which track, which sequence (block) they should run
+next, and whether they have been blocked or have finished.
+
+The registry is kept in memory as a dict keyed by workerId. It is loaded from assignedSequences.csv once and every
+change is appended as one line to a journal file next to it (assignedSequences.csv.journal). Changes therefore never
+rewrite the whole table. Every process serving the game reads the lines other processes appended to the journal since
+its last look (see sync), so the in-memory copies stay up to date.
+
+The journal can be merged back into assignedSequences.csv at any time (also while the server is running):
+python assignmentRegistry.py --compact
+ """
+
+# Column layout of assignedSequences.csv
+ASSIGNMENT_COLUMNS = ["blocked", "finished", "indexToRun", "pilot", "sequenceFile", "timestamp", "version", "workerId"]
+
+
+class AssignmentRegistry:
+    """
+    In-memory index of the worker assignments, persisted in a csv file plus an append-only journal.
+    """
+
+    def __init__(self, assigned_sequences_file, lock):
+        """
+        :param assigned_sequences_file: path to the csv file (e.g., assignedSequences.csv)
+        :param lock: FileLock guarding the csv file and the journal
+        """
+        self.csv_file = assigned_sequences_file
+        self.journal_file = assigned_sequences_file + ".journal"
+        self.lock = lock
+        self.rows = {}  # workerId -> row dict
+        self.assigned_files = set()  # file names (no dir, no extension) of the tracks that have been assigned
+        self.columns = list(ASSIGNMENT_COLUMNS)
+        self.csv_signature = None  # (inode, mtime) of the csv file when it was loaded
+        self.journal_inode = None
+        self.journal_offset = 0  # how far into the journal this process has read
+        with self.lock:
+            self.load()
+
+    # region Persistence
+    def load(self):
+        """
+        (Re)loads the full registry: the csv file and then the journal. Caller holds the lock.
+        """
+        self.rows = {}
+        self.assigned_files = set()
+        if os.path.isfile(self.csv_file) and os.path.getsize(self.csv_file) > 0:
+            with open(self.csv_file, newline="") as f:
+                reader = csv.DictReader(f)
+                self.columns = reader.fieldnames
+                for row in reader:
+                    self.rows[row["workerId"]] = parse_row(row)
+                    if row["sequenceFile"]:
+                        self.assigned_files.add(track_name(row["sequenceFile"]))
+        self.csv_signature = self.get_csv_signature()
+        self.journal_inode = None
+        self.journal_offset = 0
+        self.sync()
+
+    def get_csv_signature(self):
+        """
+        :return: (inode, mtime) of the csv file, None if there is none. Compaction replaces the file, changing both.
+        """
+        if not os.path.isfile(self.csv_file):
+            return None
+        stat = os.stat(self.csv_file)
+        return stat.st_ino, stat.st_mtime_ns
+
+    def sync(self):
+        """
+        Applies the journal lines appended (by any process) since the last sync. Caller holds the lock.
+        """
+        if self.get_csv_signature() != self.csv_signature:
+            self.load()  # compacted in the meantime, the csv file holds everything we missed (a new journal can even
+            return  # reuse the inode of the old one, so that alone doesn't tell)
+
+        if not os.path.isfile(self.journal_file):
+            if self.journal_offset > 0:
+                self.load()  # journal got compacted away
+            return
+
+        stat = os.stat(self.journal_file)
+        if self.journal_inode is not None and (stat.st_ino != self.journal_inode or stat.st_size < self.journal_offset):
+            self.load()  # journal got compacted in the meantime, the csv file holds everything we missed
+            return
+        self.journal_inode = stat.st_ino
+
+        if stat.st_size == self.journal_offset:
+            return  # nothing new, the common case
+
+        with open(self.journal_file, "rb") as f:
+            f.seek(self.journal_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # incomplete last line (process died mid-write), ignore it
+                self.journal_offset += len(line)
+                row = json.loads(line)
+                self.rows[row["workerId"]] = row
+                if row["sequenceFile"]:
+                    self.assigned_files.add(track_name(row["sequenceFile"]))
+
+    def write(self, row):
+        """
+        Stores a new version of a worker's row in memory and appends it to the journal. Caller holds the lock.
+
+        :param row: row dict
+        """
+        self.sync()  # to make sure our offset ends up right behind the line we add
+        line = (json.dumps(row) + "\n").encode()
+        with open(self.journal_file, "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.journal_inode is None:
+            self.journal_inode = os.stat(self.journal_file).st_ino
+        self.journal_offset += len(line)
+        self.rows[row["workerId"]] = row
+        if row["sequenceFile"]:
+            self.assigned_files.add(track_name(row["sequenceFile"]))
+
+    def compact(self):
+        """
+        Merges the journal into the csv file and removes the journal.
+        """
+        with self.lock:
+            self.sync()
+            tmp_file = self.csv_file + ".tmp"
+            with open(tmp_file, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=self.columns, extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(self.rows.values())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.csv_file)
+            if os.path.isfile(self.journal_file):
+                os.remove(self.journal_file)
+            self.csv_signature = self.get_csv_signature()
+            self.journal_inode = None
+            self.journal_offset = 0
+
+    # endregion
+
+    # region Lookups and updates
+    def __contains__(self, workerId):
+        return workerId in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, workerId):
+        """
+        :param workerId: worker to look up
+        :return: row dict (don't modify it, use the update functions below) or None if worker is unknown
+        """
+        return self.rows.get(workerId)
+
+    def assign(self, workerId, sequence_file, timestamp, version):
+        """
+        Registers a new worker and the track they were assigned.
+        """
+        with self.lock:
+            if workerId in self.rows:
+                raise Exception('cannot assign new sequence, workerId already has one')
+            self.write({"workerId": workerId,
+                        "sequenceFile": sequence_file,
+                        "indexToRun": 0,
+                        "blocked": False,
+                        "finished": False,
+                        "timestamp": timestamp,
+                        "version": version})
+
+    def advance(self, workerId, index_to_run, finished, timestamp):
+        """
+        Updates which sequence a worker should run next (or marks them as finished).
+        """
+        with self.lock:
+            self.sync()
+            row = dict(self.rows[workerId]) if workerId in self.rows else unknown_worker_row(workerId)
+            row["indexToRun"] = index_to_run
+            row["finished"] = finished
+            row["timestamp"] = timestamp
+            self.write(row)
+
+    def block(self, workerId):
+        """
+        Blocks a worker from playing more sequences.
+        """
+        with self.lock:
+            self.sync()
+            row = dict(self.rows[workerId]) if workerId in self.rows else unknown_worker_row(workerId)
+            row["blocked"] = True
+            self.write(row)
+
+    # endregion
+
+
+def unknown_worker_row(workerId):
+    """
+    Row for a worker that is updated without having been assigned a track (e.g., blocked after a run that was played
+    without the registry knowing them). They get a row without a track, as the csv file used to give them.
+
+    :param workerId: worker to add
+    :return: row dict
+    """
+    print("WARNING: worker ", workerId, " is not in the registry, adding them without a track")
+    return {"workerId": workerId, "sequenceFile": "", "indexToRun": 0, "blocked": False, "finished": False,
+            "timestamp": "", "version": ""}
+
+
+def track_name(sequence_file):
+    """
+    :param sequence_file: path to a track file
+    :return: file name without dir and extension (the same for a track in any format)
+    """
+    return os.path.splitext(os.path.basename(sequence_file))[0]
+
+
+def parse_row(row):
+    """
+    Converts the values of a row read from assignedSequences.csv (all strings) to their proper types.
+
+    :param row: dict as read by csv.DictReader
+    :return: dict
+    """
+    row = dict(row)
+    row["blocked"] = row["blocked"] == "True"
+    row["finished"] = row["finished"] == "True"
+    row["indexToRun"] = int(float(row["indexToRun"]))  # pandas sometimes wrote it as a float
+    return row
+
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default="server_config.json", help='server config file')
+    parser.add_argument('--compact', action='store_true', help='merge the journal into the csv file')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    # %% Compact ------------------------------------------------------------------------------------------------------
+    registry = AssignmentRegistry(config["assignedSequencesFile"], FileLock(config["assignedSequencesFile"] + ".lock"))
+    if args.compact:
+        registry.compact()
+        print("compacted, ", len(registry), " workers in ", registry.csv_file)
+    else:
+        print(len(registry), " workers in the registry")
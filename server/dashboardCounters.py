@@ -0,0 +1,148 @@
+import os
+import json
+import atexit
+import threading
+
+"""
+DASHBOARD COUNTERS
+
+The code deals with counting finalized blocks (dashboard.json: numBlocksTotalSoFar and numValidBlocksSoFar) without a
+locked read and rewrite of the dashboard file for every block.
+
+Every server process adds to counters in memory (under a thread lock, so threads never lose an increment). A background
+thread flushes them every flush_interval seconds: under the dashboard file lock, it reads the file, adds what this
+process counted since the last flush and writes the file back (via a temporary file, so readers never see a half-written
+one). What is still pending is flushed when the process exits. With a flush_interval of 0, every add is flushed right
+away (what the server did before), and the file is read again every time the totals are asked for (there is no thread
+to pick up the counts of other processes).
+
+The totals a process reports are those of the last file it read plus what it counted since. Counts of other processes
+show up after their next flush, so they are at most about one flush_interval behind. numValidBlocksNeeded is only ever
+read from the file, so it can be changed while the server is running.
+ """
+
+COUNTERS = ("numBlocksTotalSoFar", "numValidBlocksSoFar")
+
+
+class DashboardCounters:
+    """
+    Block counters kept in memory and flushed to dashboard.json periodically and at exit.
+    """
+
+    def __init__(self, path, file_lock, flush_interval):
+        """
+        :param path: path of dashboard.json
+        :param file_lock: FileLock guarding the dashboard file (shared with the other server processes)
+        :param flush_interval: seconds between two flushes, 0 to flush on every add
+        """
+        self.path = path
+        self.file_lock = file_lock
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = {key: 0 for key in COUNTERS}  # counted since the last flush
+        self.snapshot = self.read()  # dashboard as last read from the file
+        self.num_flushes = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None  # process that started it
+
+    def read(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def add(self, num_blocks, num_valid):
+        """
+        Counts finalized blocks.
+
+        :param num_blocks: number of blocks
+        :param num_valid: how many of them were valid (passed the vigilance criteria)
+        """
+        with self.lock:
+            self.pending["numBlocksTotalSoFar"] += num_blocks
+            self.pending["numValidBlocksSoFar"] += num_valid
+        if self.flush_interval <= 0:
+            self.flush()
+
+    def flush(self):
+        """
+        Adds the pending counts to the dashboard file (also picks up the counts other processes flushed).
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {key: 0 for key in COUNTERS}
+        try:
+            with self.file_lock:
+                dashboard = self.read()
+                if any(pending.values()):
+                    for key in COUNTERS:
+                        dashboard[key] += pending[key]
+                    tmp_path = self.path + ".tmp"
+                    with open(tmp_path, "w") as fp:
+                        json.dump(dashboard, fp)
+                    os.replace(tmp_path, self.path)
+        except BaseException:
+            with self.lock:  # keep the counts for the next flush
+                for key in COUNTERS:
+                    self.pending[key] += pending[key]
+            raise
+        with self.lock:
+            self.snapshot = dashboard
+            self.num_flushes += 1
+
+    def values(self):
+        """
+        :return: dashboard as this process knows it: the last file read plus what was counted since
+        """
+        if self.flush_interval <= 0:
+            self.refresh()
+        with self.lock:
+            dashboard = dict(self.snapshot)
+            for key in COUNTERS:
+                dashboard[key] += self.pending[key]
+        return dashboard
+
+    def refresh(self):
+        """
+        Reads the file again, for the counts other processes flushed (no lock needed, the file is replaced in one go).
+        """
+        dashboard = self.read()
+        with self.lock:
+            self.snapshot = dashboard
+
+    def study_complete(self):
+        """
+        :return: True once numValidBlocksSoFar reached numValidBlocksNeeded
+        """
+        dashboard = self.values()
+        return dashboard["numValidBlocksSoFar"] >= dashboard["numValidBlocksNeeded"]
+
+    def run(self):
+        """
+        Background thread: flushes every flush_interval seconds until stopped.
+        """
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("ERROR: could not flush dashboard counters, will retry: ", e)
+
+    def start(self):
+        """
+        Starts the background thread (not needed with a flush_interval of 0).
+        """
+        self.pid = os.getpid()
+        if self.flush_interval > 0:
+            self.thread = threading.Thread(target=self.run, name="dashboard-counters", daemon=True)
+            self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stops the background thread and flushes what is still pending.
+        """
+        if os.getpid() != self.pid:  # a forked process (e.g., a gunicorn worker) inherited the atexit hook
+            return
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
@@ -0,0 +1,120 @@
+import time
+import threading
+
+"""
+GROUP COMMIT
+
+The code deals with combining the disk writes of runs that are finalized at about the same time (e.g., right after a
+batch of HITs was released). Instead of every request appending its own trials and syncing the data file, the first
+request to arrive becomes the "leader": it writes the runs of all requests waiting with one append (and one sync) and
+wakes them up. Requests arriving while a batch is being written form the next batch. A leader that finds other requests
+waiting gives more of them a short window to join. A leader that is alone writes right away, so a request that isn't
+finalized together with others doesn't wait at all.
+
+A request never waits much longer than the window plus the time it takes to write one batch. The window is cut short
+when max_batch_size runs are waiting. If writing a batch fails, its records are written one at a time, so only the
+requests whose own record can't be written get the error.
+ """
+
+
+class GroupCommitter:
+    """
+    Gathers records submitted from several threads and writes them out in batches.
+    """
+
+    def __init__(self, write_batch, window, max_batch_size):
+        """
+        :param write_batch: function taking a list of records and writing them out
+        :param window: seconds the leader waits for other records to join its batch
+        :param max_batch_size: maximum number of records written in one batch
+        """
+        self.write_batch = write_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.condition = threading.Condition()
+        self.pending = []  # requests waiting to be written
+        self.leader_active = False
+
+        # Metrics
+        self.num_batches = 0
+        self.num_records = 0
+        self.max_batch_seen = 0
+        self.commit_time_total = 0.0
+        self.commit_time_max = 0.0
+
+    def submit(self, record):
+        """
+        Writes a record as part of a batch. Returns once the batch it ended up in has been written.
+
+        :param record: record to hand to write_batch
+        """
+        request = {"record": record, "done": False, "error": None}
+        with self.condition:
+            self.pending.append(request)
+            if len(self.pending) >= self.max_batch_size:
+                self.condition.notify_all()  # no need for the leader to wait any longer
+            while not request["done"]:
+                if not self.leader_active:
+                    self.leader_active = True
+                    self.lead()
+                else:
+                    self.condition.wait()
+
+        if request["error"] is not None:
+            raise request["error"]
+
+    def lead(self):
+        """
+        Waits for the window to pass (or the batch to fill up) if other requests are waiting already, writes one batch
+        and hands over the leadership. Called with the condition held.
+        """
+        deadline = time.time() + self.window
+        while 1 < len(self.pending) < self.max_batch_size:  # alone: nothing to wait for
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.condition.wait(remaining)
+
+        batch = self.pending[:self.max_batch_size]
+        del self.pending[:len(batch)]
+
+        # Write without holding the condition, so the next batch can gather in the meantime
+        self.condition.release()
+        start = time.time()
+        try:
+            self.write_batch([request["record"] for request in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0]["error"] = e
+            else:
+                print("ERROR: could not write a batch of ", len(batch), " records, writing them one at a time: ", e)
+                for request in batch:
+                    try:
+                        self.write_batch([request["record"]])
+                    except Exception as e:
+                        request["error"] = e
+        commit_time = time.time() - start
+        self.condition.acquire()
+
+        self.num_batches += 1
+        self.num_records += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        self.commit_time_total += commit_time
+        self.commit_time_max = max(self.commit_time_max, commit_time)
+
+        for request in batch:
+            request["done"] = True
+        self.leader_active = False
+        self.condition.notify_all()  # wakes the requests in this batch, and a leader for the next one
+
+    def stats(self):
+        """
+        :return: dict with batch size and commit time metrics
+        """
+        with self.condition:
+            return {"batches": self.num_batches,
+                    "runs": self.num_records,
+                    "meanBatchSize": self.num_records / self.num_batches if self.num_batches > 0 else 0,
+                    "maxBatchSize": self.max_batch_seen,
+                    "meanCommitTime": self.commit_time_total / self.num_batches if self.num_batches > 0 else 0,
+                    "maxCommitTime": self.commit_time_max}
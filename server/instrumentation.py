@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import atexit
+import threading
+from flask import request
+
+"""
+INSTRUMENTATION
+
+The code deals with measuring where the server spends its time, so a slow request can be traced to its cause (e.g.,
+waiting for a file lock versus writing the data file).
+
+Everything is recorded in histograms (number of observations per duration bucket, plus their count and sum):
+- memorygame_request_duration_seconds{endpoint, status}: whole requests
+- memorygame_stage_duration_seconds{endpoint, stage}: stages of a request (e.g., "registry sync", "track read", "data
+write"), see Instrumentation.stage
+- memorygame_lock_wait_seconds{endpoint, lock} and memorygame_lock_hold_seconds{endpoint, lock}: how long it took to get
+a file lock and how long it was held, see TimedLock
+Work done outside of a request (e.g., by the persist queue thread) has endpoint "background".
+
+The server exposes the histograms at /metrics in the Prometheus text format. Every server process keeps its own
+histograms and writes them to a file in metrics_dir every flush_interval seconds, so /metrics shows the sum over all
+live processes, whichever one answers. A process removes its file when it exits. Files of processes that are gone
+anyway (e.g., a gunicorn worker that was killed) are removed when the histograms are summed, and files that weren't
+written for STALE_FLUSHES flush intervals are left out. With json_logs, every request is also printed as one json line
+with its duration and the time spent in every stage.
+ """
+
+# Upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Files in metrics_dir not written for this many flush intervals are left out of the sum
+STALE_FLUSHES = 3
+
+HELP = {"memorygame_request_duration_seconds": "Duration of requests",
+        "memorygame_stage_duration_seconds": "Duration of stages within requests",
+        "memorygame_lock_wait_seconds": "Time spent waiting to acquire a file lock",
+        "memorygame_lock_hold_seconds": "Time a file lock was held"}
+
+
+class Instrumentation:
+    """
+    Histograms of request, stage and lock timings of one server process.
+    """
+
+    def __init__(self, metrics_dir=None, flush_interval=5.0, json_logs=False):
+        """
+        :param metrics_dir: dir the processes write their histograms to, None to only report this process
+        :param flush_interval: seconds between two writes of this process's histograms
+        :param json_logs: print a json line per request
+        """
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+        self.json_logs = json_logs
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, sorted label items) -> [count per bucket..., count, sum]
+        self.local = threading.local()  # the request the current thread is handling
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None  # process that started it
+        if metrics_dir is not None:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+    # region Recording
+    def observe(self, name, seconds, **labels):
+        """
+        Adds one observation to a histogram.
+
+        :param name: metric name (see HELP)
+        :param seconds: observed duration
+        :param labels: labels of the histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [0] * (len(BUCKETS) + 2)
+                self.histograms[key] = histogram
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def endpoint(self):
+        return getattr(self.local, "endpoint", None) or "background"
+
+    def record_stage(self, stage, seconds):
+        self.observe("memorygame_stage_duration_seconds", seconds, endpoint=self.endpoint(), stage=stage)
+        stages = getattr(self.local, "stages", None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def stage(self, stage):
+        """
+        Times a stage: with instrumentation.stage("data write"): ...
+
+        :param stage: name of the stage
+        :return: context manager
+        """
+        return StageTimer(self, stage)
+
+    def timed(self, stage, function):
+        """
+        :param stage: name of the stage
+        :param function: function to time
+        :return: function doing the same, timing every call as the stage
+        """
+        def timed_function(*args, **kwargs):
+            with self.stage(stage):
+                return function(*args, **kwargs)
+        return timed_function
+
+    def timed_lock(self, lock, name):
+        """
+        :param lock: lock to time (e.g., a FileLock)
+        :param name: name of the lock in the metrics
+        :return: TimedLock, to be used in a with statement instead of the lock
+        """
+        return TimedLock(self, lock, name)
+
+    # endregion
+
+    # region Requests
+    def install(self, app):
+        """
+        Times every request of a Flask app.
+
+        :param app: Flask app
+        """
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_request(self):
+        self.local.start = time.perf_counter()
+        self.local.endpoint = request.endpoint
+        self.local.stages = {}
+
+    def after_request(self, response):
+        duration = time.perf_counter() - self.local.start
+        endpoint = self.endpoint()
+        self.observe("memorygame_request_duration_seconds", duration, endpoint=endpoint,
+                     status=str(response.status_code))
+        if self.json_logs:
+            print(json.dumps({"time": time.time(), "pid": os.getpid(), "endpoint": endpoint,
+                              "status": response.status_code, "duration": round(duration, 6),
+                              "stages": {stage: round(seconds, 6) for stage, seconds in self.local.stages.items()}}))
+        self.local.endpoint = None
+        self.local.stages = None
+        return response
+
+    # endregion
+
+    # region Reporting
+    def snapshot(self):
+        """
+        :return: list of [name, labels, histogram], json serializable
+        """
+        with self.lock:
+            return [[name, dict(labels), list(histogram)] for (name, labels), histogram in self.histograms.items()]
+
+    def flush(self):
+        """
+        Writes this process's histograms to metrics_dir (via a temporary file).
+        """
+        if self.metrics_dir is None:
+            return
+        path = os.path.join(self.metrics_dir, str(os.getpid()) + ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def collect(self):
+        """
+        :return: dict (name, sorted label items) -> histogram, summed over this process and the files of the others
+        """
+        snapshots = [self.snapshot()]
+        if self.metrics_dir is not None:
+            own_file = str(os.getpid()) + ".json"
+            for file_name in sorted(os.listdir(self.metrics_dir)):
+                if file_name.endswith(".json") and file_name != own_file:
+                    path = os.path.join(self.metrics_dir, file_name)
+                    try:
+                        if not process_alive(file_name[:-len(".json")]):
+                            os.remove(path)  # its process died without cleaning up
+                            continue
+                        if time.time() - os.path.getmtime(path) > STALE_FLUSHES * self.flush_interval:
+                            continue  # not written for a while, its process is stuck or gone
+                        with open(path) as f:
+                            snapshots.append(json.load(f))
+                    except (OSError, ValueError):
+                        continue  # removed in the meantime
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, histogram in snapshot:
+                key = (name, tuple(sorted(labels.items())))
+                total = histograms.setdefault(key, [0] * len(histogram))
+                for i, value in enumerate(histogram):
+                    total[i] += value
+        return histograms
+
+    def render(self):
+        """
+        :return: all histograms in the Prometheus text format
+        """
+        lines = []
+        histograms = self.collect()
+        for name in sorted(set(key[0] for key in histograms)):
+            lines.append("# HELP " + name + " " + HELP.get(name, name))
+            lines.append("# TYPE " + name + " histogram")
+            for key in sorted(key for key in histograms if key[0] == name):
+                histogram = histograms[key]
+                labels = ",".join(label + '="' + str(value).replace('"', '\\"') + '"' for label, value in key[1])
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram):
+                    cumulative += count
+                    lines.append(name + "_bucket{" + labels + ',le="' + str(bound) + '"} ' + str(cumulative))
+                lines.append(name + "_bucket{" + labels + ',le="+Inf"} ' + str(histogram[-2]))
+                lines.append(name + "_count{" + labels + "} " + str(histogram[-2]))
+                lines.append(name + "_sum{" + labels + "} " + repr(float(histogram[-1])))
+        return "\n".join(lines) + "\n"
+
+    def run(self):
+        """
+        Background thread: writes this process's histograms every flush_interval seconds until stopped.
+        """
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("ERROR: could not write metrics, will retry: ", e)
+
+    def start(self):
+        """
+        Starts the background thread (only needed with a metrics_dir).
+        """
+        self.pid = os.getpid()
+        if self.metrics_dir is not None:
+            self.thread = threading.Thread(target=self.run, name="instrumentation", daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stops the background thread and removes this process's file (its histograms end with the process).
+        """
+        if os.getpid() != self.pid:  # a forked process (e.g., a gunicorn worker) inherited the atexit hook
+            return
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.metrics_dir is not None:
+            path = os.path.join(self.metrics_dir, str(os.getpid()) + ".json")
+            if os.path.isfile(path):
+                os.remove(path)
+
+    # endregion
+
+
+def process_alive(pid):
+    """
+    :param pid: process id (as a string, e.g., from a file name)
+    :return: False if there is no process with that id (on this machine), True otherwise (also if pid isn't a number)
+    """
+    try:
+        os.kill(int(pid), 0)
+    except ValueError:
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # exists, but belongs to another user
+    return True
+
+
+class StageTimer:
+    """
+    Context manager timing one stage.
+    """
+
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.record_stage(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class TimedLock:
+    """
+    Wraps a lock used in with statements, recording how long it took to acquire it and how long it was held. Only the
+    outermost with statement of a thread is timed, so it can wrap a reentrant lock (e.g., a FileLock).
+    """
+
+    def __init__(self, instrumentation, lock, name):
+        """
+        :param instrumentation: Instrumentation to record in
+        :param lock: lock to wrap
+        :param name: name of the lock in the metrics
+        """
+        self.instrumentation = instrumentation
+        self.lock = lock
+        self.name = name
+        self.local = threading.local()  # depth and acquire time, per thread
+
+    def __enter__(self):
+        depth = getattr(self.local, "depth", 0)
+        start = time.perf_counter()
+        self.lock.__enter__()
+        if depth == 0:
+            self.local.acquired = time.perf_counter()
+            self.instrumentation.observe("memorygame_lock_wait_seconds", self.local.acquired - start,
+                                         endpoint=self.instrumentation.endpoint(), lock=self.name)
+        self.local.depth = depth + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.local.depth -= 1
+        result = self.lock.__exit__(exc_type, exc_value, traceback)
+        if self.local.depth == 0:
+            self.instrumentation.observe("memorygame_lock_hold_seconds", time.perf_counter() - self.local.acquired,
+                                         endpoint=self.instrumentation.endpoint(), lock=self.name)
+        return result
@@ -0,0 +1,328 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+import concurrent.futures
+import numpy as np
+from assignmentRegistry import ASSIGNMENT_COLUMNS
+from trialStore import DATA_COLUMNS
+
+"""
+LOAD TEST
+
+The code deals with measuring how the server behaves when many participants play at the same time (e.g., right after a
+batch of HITs was released), and how that changes as the data files grow over the course of a study.
+
+For every study size it is asked to test, it:
+- builds a synthetic study in a fresh folder: a pool of tracks, an assignedSequences.csv with existing_workers workers
+already in it, and a data.csv with rows_per_worker rows for each of them
+- starts the server on that study (production mode, see "Production mode" in the README)
+- plays sessions (one new worker each) like the front-end does, from many clients at once: /initializerun,
+/finalizerun (with responses that hit most repeats and make a few false alarms) and /submitruns
+- reports the throughput and the latency percentiles of every endpoint
+
+Start with the same settings on every change to the server and compare the reports to catch regressions. The server's
+own /metrics (see instrumentation.py) tells where the time goes.
+
+Examples (run from the server dir, needs gunicorn):
+python loadTest.py --existing_workers 0 10000 100000 --clients 64 --sessions 500
+python loadTest.py --overrides '{"finalizeMode": "deferred", "trialStore": "sqlite"}' --out deferred.json
+python loadTest.py --url http://127.0.0.1:5000/ --sessions 50  # a server that is already running, on its own tracks
+ """
+
+ENDPOINTS = ["initializerun", "finalizerun", "submitruns"]
+
+
+# region Synthetic study
+def make_block(rng, name, num_trials, target_dists=(35, 140), vig_dists=(1, 4)):
+    """
+    :param rng: random.Random
+    :param name: prefix making the image names of the block unique
+    :param num_trials: number of trials
+    :return: (image paths, type labels) of one block with targets, fillers, vigs and their repeats
+    """
+    images = [None] * num_trials
+    types = [None] * num_trials
+    for i in range(num_trials):
+        if types[i] is not None:  # a repeat was put here
+            continue
+        label = rng.choices(["target", "filler", "vig"], [0.4, 0.45, 0.15])[0]
+        images[i] = ("targets/" if label == "target" else "fillers/") + name + "_" + str(i) + ".jpg"
+        types[i] = label
+        if label != "filler":
+            low, high = target_dists if label == "target" else vig_dists
+            j = i + rng.randint(low, high)
+            if j < num_trials and types[j] is None:
+                images[j] = images[i]
+                types[j] = label + " repeat"
+            else:
+                types[i] = "filler"
+    return images, types
+
+
+def make_study(root, num_tracks, num_blocks, num_trials, existing_workers, rows_per_worker, overrides, seed=0):
+    """
+    Builds a synthetic study in root (root/sequenceFiles, root/data, root/server_config.json).
+
+    :param root: folder to build it in (the server runs from there)
+    :param num_tracks: number of tracks in the pool
+    :param existing_workers: number of workers already in assignedSequences.csv (they hold tracks outside the pool)
+    :param rows_per_worker: data.csv rows per existing worker
+    :param overrides: dict of server config settings to change
+    :return: the server config of the study
+    """
+    rng = random.Random(seed)
+    sequence_dir = os.path.join(root, "sequenceFiles")
+    data_dir = os.path.join(root, "data")
+    os.makedirs(sequence_dir)
+    os.makedirs(data_dir)
+
+    for track_i in range(num_tracks + 1):  # the last one is the preview track
+        blocks = [make_block(rng, "t" + str(track_i) + "b" + str(block), num_trials) for block in range(num_blocks)]
+        name = "track_" + str(track_i).zfill(5) + ".json" if track_i < num_tracks else "previewSequence.json"
+        with open(os.path.join(sequence_dir if track_i < num_tracks else root, name), "w") as f:
+            json.dump({"sequences": [x[0] for x in blocks], "types": [x[1] for x in blocks]}, f)
+
+    with open(os.path.join(data_dir, "assignedSequences.csv"), "w") as f:
+        f.write(",".join(ASSIGNMENT_COLUMNS) + "\n")
+        for i in range(existing_workers):
+            row = {"blocked": "False", "finished": "True", "indexToRun": str(num_blocks - 1), "pilot": "",
+                   "sequenceFile": os.path.join(sequence_dir, "track_" + str(num_tracks + 1 + i).zfill(5) + ".json"),
+                   "timestamp": "2020-01-01 12:00:00.000000", "version": "loadtest", "workerId": "existing" + str(i)}
+            f.write(",".join(row[column] for column in ASSIGNMENT_COLUMNS) + "\n")
+    with open(os.path.join(data_dir, "data.csv"), "w") as f:
+        f.write(",".join(DATA_COLUMNS) + "\n")
+        for i in range(existing_workers):
+            row = {"assignmentId": "", "condition": "filler", "finishTime": "2020-1-1 12:5:0", "image": "fillers/x.jpg",
+                   "initTime": "2020-1-1 12:0:0", "medium": "other", "response": "0", "runIndex": "0",
+                   "sequenceFile": "track_x.json", "timestamp": "2020-01-01 12:00:00.000000", "trialIndex": "0",
+                   "workerId": "existing" + str(i)}
+            f.write((",".join(row[column] for column in DATA_COLUMNS) + "\n") * rows_per_worker)
+    with open(os.path.join(data_dir, "data_sandbox.csv"), "w") as f:
+        f.write(",".join(DATA_COLUMNS) + "\n")
+    with open(os.path.join(data_dir, "submittedRuns.csv"), "w") as f:
+        f.write("workerId,timestamp,medium,compensation,feedback,assignmentId\n")
+    with open(os.path.join(data_dir, "dashboard.json"), "w") as f:
+        json.dump({"numValidBlocksNeeded": 10 ** 9, "numValidBlocksSoFar": 0, "numBlocksTotalSoFar": 0}, f)
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "server_config.json")) as f:
+        config = json.load(f)
+    for key in config:
+        if key.endswith("File") or key.endswith("Dir"):  # paths into the study folder
+            config[key] = os.path.join(data_dir, os.path.basename(config[key]))
+    config.update({"sequenceDir": sequence_dir,
+                   "previewSequenceFile": os.path.join(root, "previewSequence.json"),
+                   "trackManifestFile": os.path.join(sequence_dir, "manifest.json"),  # none, nothing to check
+                   "trackFormat": "json",
+                   "maxNumRuns": num_blocks,
+                   "poolLowWaterMark": 0,
+                   "maintenance": False})
+    config.update(overrides)
+    with open(os.path.join(root, "server_config.json"), "w") as f:
+        json.dump(config, f, indent=4)
+    return config
+
+
+# endregion
+
+# region Server
+def start_server(root, processes, threads, port, timeout=120):
+    """
+    Starts the server (production mode) on the study in root and waits until it answers.
+
+    :return: the server process
+    """
+    log = open(os.path.join(root, "server.log"), "w")
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+                                "--production", "--processes", str(processes), "--threads", str(threads)],
+                               cwd=root, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception("server exited, see " + os.path.join(root, "server.log"))
+        try:
+            urllib.request.urlopen("http://127.0.0.1:" + str(port) + "/dashboard", timeout=1).read()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise Exception("server didn't answer within " + str(timeout) + " seconds, see " + os.path.join(root, "server.log"))
+
+
+def stop_server(process):
+    process.terminate()  # gunicorn shuts down gracefully (queues and counters get flushed)
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# endregion
+
+# region Clients
+class LatencyLog:
+    """
+    Latencies and errors per endpoint, shared by the client threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+
+    def call(self, base_url, endpoint, query="", payload=None, timeout=60):
+        """
+        Calls an endpoint and records how long it took.
+
+        :return: decoded json response, None if the call failed
+        """
+        data = json.dumps(payload).encode() if payload is not None else None
+        http_request = urllib.request.Request(base_url + endpoint + query, data=data,
+                                              headers={"Content-Type": "application/json"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(http_request, timeout=timeout) as response:
+                result = json.loads(response.read())
+        except (OSError, ValueError):
+            with self.lock:
+                self.errors[endpoint] += 1
+            return None
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+        return result
+
+
+def play_session(base_url, worker_id, log, rng, hit_rate=0.8, false_alarm_rate=0.05):
+    """
+    Plays one session the way the front-end does: initialize a block, finalize it, submit. A session plays one block:
+    the server doesn't hand a worker their next block within minutes of the previous one (it would still be running).
+    """
+    run_info = log.call(base_url, "initializerun", "?workerId=" + worker_id + "&medium=other&trialFeedback=1")
+    if run_info is None or run_info.get("blocked") or run_info.get("finished") or run_info.get("running") or \
+            run_info.get("studyComplete"):
+        return
+    conditions = run_info["conditions"]
+    responses = [i for i, label in enumerate(conditions)
+                 if rng.random() < (hit_rate if label.endswith("repeat") else false_alarm_rate)]
+    result = log.call(base_url, "finalizerun", payload={
+        "assignmentId": "", "workerId": worker_id, "indexToRun": run_info["index_to_run"],
+        "sequenceFile": run_info["sequenceFile"], "responseIndices": responses, "preview": False,
+        "timestamp": run_info["timestamp"], "medium": "other", "initTime": "2020-1-1 12:0:0",
+        "finishTime": "2020-1-1 12:5:0", "numTrials": len(conditions)})
+    if result is not None:
+        log.call(base_url, "submitruns", payload={"workerId": worker_id, "timestamp": run_info["timestamp"],
+                                                  "compensation": 0.5, "medium": "other", "feedback": "",
+                                                  "assignmentId": ""})
+
+
+def run_load(base_url, num_sessions, clients, seed=0, prefix="loadtest"):
+    """
+    Plays num_sessions sessions (one new worker each) from clients threads at once.
+
+    :return: (LatencyLog, seconds it took)
+    """
+    log = LatencyLog()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(clients) as executor:
+        futures = [executor.submit(play_session, base_url, prefix + str(seed) + "_" + str(i), log,
+                                   random.Random(seed * 1000003 + i)) for i in range(num_sessions)]
+        for future in futures:
+            future.result()
+    return log, time.perf_counter() - start
+
+
+def summarize(log, seconds):
+    """
+    :return: dict endpoint -> {"calls", "errors", "perSecond", "p50", "p95", "p99", "max"} (latencies in seconds)
+    """
+    summary = {}
+    for endpoint in ENDPOINTS:
+        latencies = np.array(log.latencies[endpoint])
+        summary[endpoint] = {"calls": len(latencies), "errors": log.errors[endpoint],
+                             "perSecond": len(latencies) / seconds if seconds > 0 else 0}
+        for name, q in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)):
+            summary[endpoint][name] = float(np.percentile(latencies, q)) if len(latencies) else None
+    return summary
+
+
+def print_summary(label, summary, seconds):
+    print("--- ", label, ": ", round(seconds, 2), " seconds")
+    print("endpoint".ljust(16), "calls".rjust(7), "errors".rjust(7), "per s".rjust(8),
+          *[name.rjust(9) for name in ("p50 ms", "p95 ms", "p99 ms", "max ms")])
+    for endpoint, stats in summary.items():
+        print(endpoint.ljust(16), str(stats["calls"]).rjust(7), str(stats["errors"]).rjust(7),
+              str(round(stats["perSecond"], 1)).rjust(8),
+              *[(str(round(stats[name] * 1000, 1)) if stats[name] is not None else "-").rjust(9)
+                for name in ("p50", "p95", "p99", "max")])
+
+
+# endregion
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--existing_workers', type=int, nargs="+", default=[0, 10000],
+                        help='study sizes to test: number of workers already in assignedSequences.csv')
+    parser.add_argument('--rows_per_worker', type=int, default=100, help='data.csv rows per existing worker')
+    parser.add_argument('--sessions', type=int, default=200, help='number of sessions (new workers) to play')
+    parser.add_argument('--clients', type=int, default=32, help='number of sessions played at the same time')
+    parser.add_argument('--num_blocks', type=int, default=4, help='blocks per track (maxNumRuns of the study)')
+    parser.add_argument('--num_trials', type=int, default=120, help='trials per block')
+    parser.add_argument('--processes', type=int, default=4, help='server worker processes')
+    parser.add_argument('--threads', type=int, default=2, help='threads per server worker process')
+    parser.add_argument('--port', type=int, default=5055, help='port to run the server on')
+    parser.add_argument('--overrides', type=str, default="{}", help='json dict of server config settings to change '
+                                                                    '(e.g., finalizeMode, trialStore)')
+    parser.add_argument('--url', type=str, default=None, help='test a server that is already running instead (it '
+                                                              'needs unassigned tracks for all sessions)')
+    parser.add_argument('--work_dir', type=str, default=None, help='dir to build the studies in, a temporary one if '
+                                                                   'not set (removed afterwards)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic study and responses')
+    parser.add_argument('--out', type=str, default=None, help='json file to write the results to')
+    args = parser.parse_args()
+
+    # %% Run ----------------------------------------------------------------------------------------------------------
+    results = []
+    if args.url is not None:
+        log, seconds = run_load(args.url, args.sessions, args.clients, args.seed,
+                                prefix="loadtest" + str(int(time.time())))
+        summary = summarize(log, seconds)
+        print_summary(args.url, summary, seconds)
+        results.append({"url": args.url, "seconds": seconds, "endpoints": summary})
+    else:
+        work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="memorygame_loadtest_")
+        overrides = dict(json.loads(args.overrides), port=args.port)
+        try:
+            for existing_workers in args.existing_workers:
+                root = os.path.join(work_dir, "study_" + str(existing_workers))
+                start = time.time()
+                make_study(root, args.sessions, args.num_blocks, args.num_trials, existing_workers,
+                           args.rows_per_worker, overrides, args.seed)
+                print("built a study with ", existing_workers, " existing workers in ", root, " (",
+                      round(time.time() - start, 1), " seconds)")
+                server_process = start_server(root, args.processes, args.threads, args.port)
+                try:
+                    log, seconds = run_load("http://127.0.0.1:" + str(args.port) + "/", args.sessions, args.clients,
+                                            args.seed)
+                finally:
+                    stop_server(server_process)
+                summary = summarize(log, seconds)
+                print_summary(str(existing_workers) + " existing workers", summary, seconds)
+                results.append({"existingWorkers": existing_workers, "rowsPerWorker": args.rows_per_worker,
+                                "seconds": seconds, "endpoints": summary})
+        finally:
+            if args.work_dir is None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=4)
+        print("results written to ", args.out)
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import atexit
+import threading
+import itertools
+from filelock import Timeout, FileLock
+
+"""
+PERSIST QUEUE
+
+The code deals with writing finalized runs to disk outside of the request that finalized them (the "deferred" finalize
+mode). The request only drops a small record into a spool directory and returns. A background thread then picks up
+all records waiting in the spool, writes them out in one go (e.g., one append to data.csv for many runs), and removes
+them from the spool.
+
+Records are made durable before the request returns: each one is written to a temporary file, synced to disk and then
+renamed into the spool. Whatever is left in the spool after a crash or restart is picked up by the first drain. Records
+are only removed after they have been written out, so a crash in between can lead to a run being written twice, never to
+a run being lost.
+
+If writing a batch fails, its records are written one at a time, so one record that can't be written doesn't hold up
+the others. A record that failed max_attempts drains in a row is moved to spool/failed (its attempts so far are counted
+in a file next to it, name.json.attempts), to be looked into by hand.
+
+Several server processes can share one spool directory: a lock makes sure only one of them drains it at any time.
+ """
+
+
+class PersistQueue:
+    """
+    Durable spool directory of records, drained in batches by a background thread.
+    """
+
+    def __init__(self, spool_dir, write_batch, drain_interval, max_batch_size, max_attempts=5):
+        """
+        :param spool_dir: dir to keep the records in until they are written out
+        :param write_batch: function taking a list of records and writing them out
+        :param drain_interval: seconds between two drains
+        :param max_batch_size: maximum number of records to hand to write_batch at once
+        :param max_attempts: number of drains a record can fail before it is moved to spool_dir/failed
+        """
+        self.spool_dir = spool_dir
+        self.failed_dir = os.path.join(spool_dir, "failed")
+        self.write_batch = write_batch
+        self.drain_interval = drain_interval
+        self.max_batch_size = max_batch_size
+        self.max_attempts = max_attempts
+        self.drain_lock = FileLock(os.path.join(spool_dir, "drain.lock"))
+        self.counter = itertools.count()  # makes record names unique within a process
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None  # process that started it
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def put(self, record):
+        """
+        Adds a record to the spool. It is safely on disk when this returns.
+
+        :param record: json serializable dict
+        """
+        # names sort in arrival order, so runs get written in the order they came in
+        name = "%020d_%d_%d.json" % (time.time_ns(), os.getpid(), next(self.counter))
+        tmp_path = os.path.join(self.spool_dir, name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.spool_dir, name))
+        sync_dir(self.spool_dir)
+
+    def pending(self):
+        """
+        :return: sorted list of the names of the records waiting in the spool
+        """
+        return sorted(x for x in os.listdir(self.spool_dir) if x.endswith(".json"))
+
+    def drain(self):
+        """
+        Writes out everything in the spool, in batches of at most max_batch_size records. Returns right away if
+        another process is already draining.
+
+        :return: number of records written out
+        """
+        try:
+            self.drain_lock.acquire(timeout=0)
+        except Timeout:
+            return 0
+
+        num_written = 0
+        try:
+            names = self.pending()
+            for i in range(0, len(names), self.max_batch_size):
+                batch_names = []
+                records = []
+                for name in names[i:i + self.max_batch_size]:
+                    try:
+                        with open(os.path.join(self.spool_dir, name)) as f:
+                            records.append(json.load(f))
+                        batch_names.append(name)
+                    except ValueError as e:
+                        self.record_failure(name, e)
+                if not records:
+                    continue
+                try:
+                    self.write_batch(records)
+                    written = batch_names
+                except Exception as e:
+                    if len(records) == 1:
+                        self.record_failure(batch_names[0], e)
+                        continue
+                    print("ERROR: could not write a batch of ", len(records), " spooled records, writing them one at a "
+                          "time: ", e)
+                    written = []
+                    for name, record in zip(batch_names, records):
+                        try:
+                            self.write_batch([record])
+                            written.append(name)
+                        except Exception as e:
+                            self.record_failure(name, e)
+                for name in written:
+                    os.remove(os.path.join(self.spool_dir, name))
+                    if os.path.isfile(os.path.join(self.spool_dir, name + ".attempts")):
+                        os.remove(os.path.join(self.spool_dir, name + ".attempts"))
+                num_written += len(written)
+        finally:
+            self.drain_lock.release()
+        return num_written
+
+    def record_failure(self, name, error):
+        """
+        Counts a failed attempt to write out a record, and moves it to failed_dir after max_attempts. Caller holds the
+        drain lock.
+
+        :param name: name of the record in the spool
+        :param error: what went wrong
+        """
+        attempts_path = os.path.join(self.spool_dir, name + ".attempts")
+        attempts = 0
+        if os.path.isfile(attempts_path):
+            with open(attempts_path) as f:
+                attempts = int(f.read() or 0)
+        attempts += 1
+        if attempts >= self.max_attempts:
+            os.makedirs(self.failed_dir, exist_ok=True)
+            os.replace(os.path.join(self.spool_dir, name), os.path.join(self.failed_dir, name))
+            if os.path.isfile(attempts_path):
+                os.remove(attempts_path)
+            print("ERROR: spooled record ", name, " failed ", attempts, " times, moved to ", self.failed_dir, ": ", error)
+        else:
+            with open(attempts_path, "w") as f:
+                f.write(str(attempts))
+            print("ERROR: could not write spooled record ", name, " (attempt ", attempts, " of ", self.max_attempts,
+                  "): ", error)
+
+    def run(self):
+        """
+        Background thread: drains the spool every drain_interval seconds until stopped.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                print("ERROR: could not drain persist queue, will retry: ", e)
+            self.stopped.wait(self.drain_interval)
+
+    def start(self):
+        """
+        Starts the background thread. Its first drain recovers anything left behind by a previous run of the server.
+        """
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name="persist-queue", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stops the background thread and writes out what is still waiting.
+        """
+        if os.getpid() != self.pid:  # a forked process (e.g., a gunicorn worker) inherited the atexit hook
+            return
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.drain()
+
+
+def sync_dir(path):
+    """
+    Makes a rename in a directory durable (no-op on platforms that can't open directories).
+
+    :param path: dir to sync
+    """
+    if os.name != "posix":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from statistics import NormalDist
+
+# Trial type codes are shared with the generator
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sequences"))
+from trackFormats import TYPE_CODES
+
+"""
+SCORING
+
+The code deals with scoring the performance of a participant on a sequence (run): hit rate, false alarm rate, hit rate
+on the vigilance repeats, d' and criterion. The server uses it to give feedback and to check the vigilance performance
+after every run. It can also be run on a full data file to (re)score all runs of a study at once:
+python scoring.py --data ../data/data.csv --out ../data/scores.csv
+
+Trial types are coded as small integers (TYPE_CODES of trackFormats.py, the codes compact tracks and the track manifest
+are stored with), once per track when it is loaded. Which codes count as repeats, vigilance repeats or non-repeats then
+comes down to a lookup table, and every score is a sum over a boolean mask.
+ """
+
+# region Encoding
+def encode_types(types):
+    """
+    :param types: list of trial type labels (e.g., "target repeat")
+    :return: uint8 array of type codes
+    """
+    return np.array([TYPE_CODES[x] for x in types], dtype=np.uint8)
+
+
+def prepare_track(sequence_info):
+    """
+    Adds the coded trial types of every block to a parsed track (under the key "codes").
+
+    :param sequence_info: dict with keys "sequences" and "types" (or a CompactTrack, see trackFormats.py)
+    :return: the same dict
+    """
+    if "codes" not in sequence_info:  # compact tracks come with their codes
+        sequence_info["codes"] = [encode_types(x) for x in sequence_info["types"]]
+    return sequence_info
+
+
+def label_table(labels):
+    """
+    :param labels: list of trial type labels
+    :return: boolean lookup table, indexing it with type codes tells which trials have one of the labels
+    """
+    table = np.zeros(max(TYPE_CODES.values()) + 1, dtype=bool)
+    table[[TYPE_CODES[x] for x in labels]] = True
+    return table
+
+
+# endregion
+
+# region Scores
+def response_mask(response_indices, num_trials):
+    """
+    :param response_indices: indices of the trials the participant responded on
+    :param num_trials: number of trials in the run
+    :return: boolean array, True where there was a response
+    """
+    responses = np.zeros(num_trials, dtype=bool)
+    response_indices = np.asarray(response_indices, dtype=np.int64)
+    responses[response_indices[(response_indices >= 0) & (response_indices < num_trials)]] = True
+    return responses
+
+
+def d_prime(hit_rate, false_alarm_rate):
+    """
+    Sensitivity and criterion (signal detection theory). Rates must be strictly between 0 and 1 (see corrected_rate).
+
+    :return: (d', criterion)
+    """
+    z_hit = NormalDist().inv_cdf(hit_rate)
+    z_false_alarm = NormalDist().inv_cdf(false_alarm_rate)
+    return z_hit - z_false_alarm, -(z_hit + z_false_alarm) / 2
+
+
+def corrected_rate(count, num):
+    """
+    Log-linear correction (Hautus, 1995), keeps rates away from 0 and 1 so d' stays finite.
+    """
+    return (count + 0.5) / (num + 1)
+
+
+def score_run(codes, responses, condition_labels):
+    """
+    Scores one run.
+
+    :param codes: type codes of the trials in the run
+    :param responses: boolean array, True where there was a response
+    :param condition_labels: dict with keys "repeatTrials", "vigRepeatTrials", "noRepeatTrials" (see server_config.json)
+    :return: dict with the scores, rates are -1 if there were no trials to compute them on
+    """
+    repeat = label_table(condition_labels["repeatTrials"])[codes]
+    vig_repeat = label_table(condition_labels["vigRepeatTrials"])[codes]
+    no_repeat = label_table(condition_labels["noRepeatTrials"])[codes]
+
+    num_repeats = int(repeat.sum())
+    num_vig_repeats = int(vig_repeat.sum())
+    num_no_repeats = int(no_repeat.sum())
+    num_hits = int((repeat & responses).sum())
+    num_vig_hits = int((vig_repeat & responses).sum())
+    num_false_alarms = int((no_repeat & responses).sum())
+
+    sensitivity, criterion = d_prime(corrected_rate(num_hits, num_repeats),
+                                     corrected_rate(num_false_alarms, num_no_repeats))
+
+    return {"hit_rate": float(num_hits) / num_repeats if num_repeats > 0 else -1,
+            "false_alarm_num": num_false_alarms,
+            "false_alarm_rate": float(num_false_alarms) / num_no_repeats if num_no_repeats > 0 else -1,
+            "vig_hit_rate": float(num_vig_hits) / num_vig_repeats if num_vig_repeats > 0 else -1,
+            "d_prime": sensitivity,
+            "criterion": criterion}
+
+
+def passes_vigilance(scores, vig_hr_criterion, far_criterion):
+    """
+    :param scores: dict as returned by score_run
+    :param vig_hr_criterion: minimum hit rate on the vigilance repeats (only checked if there were any)
+    :param far_criterion: false alarm rate from which on a run fails
+    :return: True if the run meets the vigilance criteria
+    """
+    if 0 <= scores["vig_hit_rate"] < vig_hr_criterion:
+        return False
+    if scores["false_alarm_rate"] >= far_criterion:
+        return False
+    return True
+
+
+def score_data(data, condition_labels, run_columns=("workerId", "assignmentId", "sequenceFile", "runIndex",
+                                                     "timestamp")):
+    """
+    Scores every run in a data file at once.
+
+    :param data: DataFrame with the data.csv layout
+    :param condition_labels: dict with keys "repeatTrials", "vigRepeatTrials", "noRepeatTrials"
+    :param run_columns: columns that together identify a run
+    :return: DataFrame with one row per run
+    """
+    codes = data["condition"].map(TYPE_CODES)
+    unknown = data["condition"][codes.isna()].unique()
+    if len(unknown) > 0:
+        raise Exception("unknown trial types in the condition column: " + ", ".join(repr(x) for x in unknown) +
+                        " (known: " + ", ".join(TYPE_CODES) + ")")
+    codes = codes.to_numpy(dtype=np.uint8)
+    responses = data["response"].to_numpy(dtype=np.int64) == 1
+    repeat = label_table(condition_labels["repeatTrials"])[codes]
+    vig_repeat = label_table(condition_labels["vigRepeatTrials"])[codes]
+    no_repeat = label_table(condition_labels["noRepeatTrials"])[codes]
+
+    masks = pd.DataFrame({"num_repeats": repeat,
+                          "num_vig_repeats": vig_repeat,
+                          "num_no_repeats": no_repeat,
+                          "num_hits": repeat & responses,
+                          "num_vig_hits": vig_repeat & responses,
+                          "false_alarm_num": no_repeat & responses}, index=data.index)
+    for column in run_columns:
+        masks[column] = data[column]
+    counts = masks.groupby(list(run_columns), sort=False, dropna=False).sum().reset_index()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        counts["hit_rate"] = np.where(counts["num_repeats"] > 0, counts["num_hits"] / counts["num_repeats"], -1)
+        counts["false_alarm_rate"] = np.where(counts["num_no_repeats"] > 0,
+                                              counts["false_alarm_num"] / counts["num_no_repeats"], -1)
+        counts["vig_hit_rate"] = np.where(counts["num_vig_repeats"] > 0,
+                                          counts["num_vig_hits"] / counts["num_vig_repeats"], -1)
+
+    inv_cdf = np.vectorize(NormalDist().inv_cdf, otypes=[float])
+    z_hit = inv_cdf(corrected_rate(counts["num_hits"].to_numpy(), counts["num_repeats"].to_numpy()))
+    z_false_alarm = inv_cdf(corrected_rate(counts["false_alarm_num"].to_numpy(), counts["num_no_repeats"].to_numpy()))
+    counts["d_prime"] = z_hit - z_false_alarm
+    counts["criterion"] = -(z_hit + z_false_alarm) / 2
+    return counts
+
+
+# endregion
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default="server_config.json", help='server config file')
+    parser.add_argument('--data', type=str, default="../data/data.csv", help='data file to score')
+    parser.add_argument('--out', type=str, default="../data/scores.csv", help='csv file to write the scores to')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    # %% Score --------------------------------------------------------------------------------------------------------
+    scores = score_data(pd.read_csv(args.data), config["conditionLabels"])
+    far_fail = scores["false_alarm_rate"] >= config["blockingCriteria"]["farCriterion"]
+    vig_fail = (scores["vig_hit_rate"] >= 0) & (scores["vig_hit_rate"] < config["blockingCriteria"]["vigHrCriterion"])
+    scores["vigilance"] = np.where(far_fail | vig_fail, "fail", "pass")
+    scores.to_csv(args.out, index=False)
+    print("scored ", len(scores), " runs, ", int((scores["vigilance"] == "pass").sum()), " passed the vigilance check")
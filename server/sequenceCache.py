@@ -0,0 +1,84 @@
+import os
+import threading
+import collections
+
+"""
+SEQUENCE FILE CACHE
+
+The code deals with keeping recently used tracks (sequenceFiles) in memory, already parsed, so that the endpoints
+don't have to read and parse a full track file on every request.
+
+The cache holds at most max_entries tracks and drops the least recently used one when it is full. A cached track is
+only used as long as the modification time and size of its file haven't changed, so regenerated tracks are picked up.
+ """
+
+
+def file_signature(sequence_file):
+    stat = os.stat(sequence_file)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class SequenceCache:
+    """
+    Bounded LRU cache of parsed track files.
+    """
+
+    def __init__(self, max_entries, load, prepare=None, signature=None):
+        """
+        :param max_entries: maximum number of tracks to hold in memory
+        :param load: function reading a track file (e.g., trackFormats.read_track)
+        :param prepare: optional function applied to a track once after parsing it (e.g., to precompute things)
+        :param signature: optional function returning a value that changes when a track changes (e.g., for tracks
+        that aren't separate files, see trackPack.py), defaults to the modification time and size of the file
+        """
+        self.max_entries = max_entries
+        self.load = load
+        self.prepare = prepare
+        self.signature = signature if signature is not None else file_signature
+        self.entries = collections.OrderedDict()  # path -> (file signature, parsed track)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sequence_file):
+        """
+        Returns the parsed contents of a track file. Don't modify what it returns, it is shared between requests.
+
+        :param sequence_file: path to the track file
+        :return: dict with keys "sequences" and "types" (or anything else load returns)
+        """
+        key = os.path.normpath(sequence_file)
+        signature = self.signature(key)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        sequence_info = self.load(key)
+        if self.prepare is not None:
+            sequence_info = self.prepare(sequence_info)
+
+        with self.lock:
+            self.entries[key] = (signature, sequence_info)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return sequence_info
+
+    def stats(self):
+        """
+        :return: dict with the cache counters
+        """
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "maxEntries": self.max_entries,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
@@ -1,13 +1,29 @@
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_restful import Resource, Api
 from flask_cors import CORS
 
 import os
+import sys
 import json
-import pandas as pd
 import datetime
-import time
+import argparse
+import importlib
 from filelock import Timeout, FileLock
+from trialStore import open_trial_store
+from assignmentRegistry import AssignmentRegistry
+from trackPool import TrackPool
+from sequenceCache import SequenceCache
+from persistQueue import PersistQueue
+from groupCommit import GroupCommitter
+from dashboardCounters import DashboardCounters
+from submissionLog import SubmissionLog
+from instrumentation import Instrumentation
+from scoring import prepare_track, response_mask, score_run, passes_vigilance
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sequences"))  # shared with the generator
+from trackFormats import read_track
+from trackPack import TrackPack
+from trackManifest import TrackManifest
 
 app = Flask(__name__)
 api = Api(app)
@@ -15,11 +31,168 @@ CORS(app)
 with open("server_config.json") as f:
     config = json.load(f)
 
-lock_assigned_sequences = FileLock(config["assignedSequencesFile"] + ".lock")
-lock_data = FileLock(config["dataFile"] + ".lock")
-lock_data_sandbox = FileLock(config["dataSandboxFile"] + ".lock")
-lock_when_to_stop = FileLock(config["dashboardFile"] + ".lock")
-lock_submission_file = FileLock(config["submitFile"] + ".lock")
+
+# region Track manifest
+def check_track_manifest():
+    """
+    Compares the track pool with the manifest written by the generator (see trackManifest.py): which tracks there are,
+    whether they have enough blocks for maxNumRuns, and whether a sample of them still matches their hash.
+
+    :return: list of problems, empty if the pool matches the manifest
+    """
+    with lock_assigned_sequences:
+        assignment_registry.sync()
+        track_pool.refresh()
+        track_files = list(track_pool.track_files)
+    problems = track_manifest.check(track_files, lambda x: sequence_cache.get(os.path.join(config["sequenceDir"], x)),
+                                    sample=config["manifestCheckSample"], min_blocks=config["maxNumRuns"])
+    for problem in problems:
+        print("WARNING: track pool doesn't match ", config["trackManifestFile"], ": ", problem)
+    return problems
+
+
+def get_block_codes(sequence_file, index_to_run):
+    """
+    :return: type codes of the trials of a block, from the manifest if it lists the track (the track isn't read then)
+    """
+    codes = track_manifest.codes(sequence_file, index_to_run) if track_manifest is not None else None
+    if codes is None:
+        codes = sequence_cache.get(sequence_file)["codes"][index_to_run]
+    return codes
+
+
+# endregion
+
+# region Persistence helpers (shared by the "sync" and "deferred" finalize modes)
+def get_trial_rows(data_received, sequence_info):
+    """
+    Turns the data of one finalized run into data file rows (one per trial). Raises an Exception if the run doesn't
+    match its track (e.g., more trials than its block has).
+    """
+    run_index = data_received["indexToRun"]
+    num_trials = data_received["numTrials"]
+    if not (0 <= run_index < len(sequence_info["types"]) and 0 <= num_trials <= len(sequence_info["types"][run_index])):
+        raise Exception("run doesn't match its track " + str(data_received["sequenceFile"]) + ": block " +
+                        str(run_index) + " with " + str(num_trials) + " trials")
+    meta_data = {
+        "medium": data_received["medium"],
+        "sequenceFile": data_received["sequenceFile"],
+        "workerId": data_received["workerId"],
+        "assignmentId": data_received["assignmentId"],
+        "timestamp": data_received["timestamp"],
+        "runIndex": run_index,
+        "initTime": data_received["initTime"],
+        "finishTime": data_received["finishTime"]
+    }
+
+    # Trial data
+    response_indices = set(data_received["responseIndices"])
+    rows = []
+    for i in range(num_trials):
+        row = {"response": 1 if i in response_indices else 0,
+               "trialIndex": i,
+               "condition": sequence_info["types"][run_index][i],
+               "image": sequence_info["sequences"][run_index][i]}
+        row.update(meta_data)
+        rows.append(row)
+    return rows
+
+
+def write_runs(records):
+    """
+    Writes a batch of runs taken off the persist queue: one append per data file and one count on the dashboard.
+
+    Every append is all or nothing, and the records it stored are marked ("stored"), so when a batch is written again
+    after a failure (e.g., record by record, see GroupCommitter and PersistQueue), only the rows that weren't stored yet
+    are written.
+
+    :param records: list of dicts with keys "dataReceived" (what FinalizeRun received), "valid" and "rows" (see
+    get_trial_rows, built when the record is missing them, e.g., spooled by an older version of the server)
+    """
+    stores = {trial_store: ([], []), trial_store_sandbox: ([], [])}  # store -> (rows, records they come from)
+    for record in records:
+        if record.get("stored"):
+            continue
+        data_received = record["dataReceived"]
+        trial_rows = record.get("rows")
+        if trial_rows is None:
+            trial_rows = get_trial_rows(data_received, sequence_cache.get(data_received["sequenceFile"]))
+        store = trial_store_sandbox if data_received["medium"] == "mturk_sandbox" else trial_store
+        stores[store][0].extend(trial_rows)
+        stores[store][1].append(record)
+
+    with instrumentation.stage("data write"):
+        for store, (rows, stored_records) in stores.items():
+            if rows:
+                store.append(rows)
+                for record in stored_records:
+                    record["stored"] = True
+    dashboard_counters.add(len(records), sum(record["valid"] for record in records))
+
+
+# endregion
+
+# region Setup
+def setup():
+    """
+    Sets up the state of a server process: instrumentation, locks, registry, track pool, caches, stores and the
+    background threads. Runs when the module is imported (by a gunicorn worker, see run_production, or by the tests) or
+    served with the Flask development server, never in the gunicorn master (its threads and locks would be copied into
+    every worker it forks).
+    """
+    global instrumentation, lock_assigned_sequences, lock_data, lock_data_sandbox, lock_when_to_stop, \
+        lock_submission_file, assignment_registry, track_pack, track_pool, sequence_cache, track_manifest, trial_store, \
+        trial_store_sandbox, submission_log, manifest_problems, dashboard_counters, persist_queue, group_committer
+
+    instrumentation = Instrumentation(config["metricsDir"] or None, config["metricsFlushInterval"], config["jsonLogs"])
+    instrumentation.install(app)  # times every request (see /metrics)
+    instrumentation.start()
+
+    # Every lock records how long it took to get it and how long it was held
+    lock_assigned_sequences = instrumentation.timed_lock(FileLock(config["assignedSequencesFile"] + ".lock"),
+                                                         "assignedSequences")
+    lock_data = instrumentation.timed_lock(FileLock(config["dataFile"] + ".lock"), "data")
+    lock_data_sandbox = instrumentation.timed_lock(FileLock(config["dataSandboxFile"] + ".lock"), "dataSandbox")
+    lock_when_to_stop = instrumentation.timed_lock(FileLock(config["dashboardFile"] + ".lock"), "dashboard")
+    lock_submission_file = instrumentation.timed_lock(FileLock(config["submitFile"] + ".lock"), "submittedRuns")
+
+    assignment_registry = AssignmentRegistry(config["assignedSequencesFile"], lock_assigned_sequences)
+    track_pack = TrackPack(config["trackPackFile"]) if config["trackFormat"] == "pack" else None
+    track_pool = TrackPool(config["sequenceDir"], config["previewSequenceFile"], assignment_registry,
+                           extension=".trk" if config["trackFormat"] == "compact" else ".json",
+                           low_water_mark=config["poolLowWaterMark"], pack=track_pack,
+                           ignore=[os.path.basename(config["trackManifestFile"])])
+    if track_pack is not None:
+        sequence_cache = SequenceCache(config["sequenceCacheSize"],
+                                       load=instrumentation.timed("track read", track_pack.load),
+                                       prepare=instrumentation.timed("track prepare", prepare_track),
+                                       signature=track_pack.signature)
+    else:
+        sequence_cache = SequenceCache(config["sequenceCacheSize"], load=instrumentation.timed("track read", read_track),
+                                       prepare=instrumentation.timed("track prepare", prepare_track))  # codes trial types
+    track_manifest = TrackManifest(config["trackManifestFile"]) if os.path.isfile(config["trackManifestFile"]) else None
+    trial_store = open_trial_store(config["trialStore"], config["dataFile"], config["dataDbFile"], lock_data)
+    trial_store_sandbox = open_trial_store(config["trialStore"], config["dataSandboxFile"], config["dataSandboxDbFile"],
+                                           lock_data_sandbox)
+    submission_log = SubmissionLog(config["submitFile"], config["submitIndexFile"], lock_submission_file)
+
+    manifest_problems = check_track_manifest() if track_manifest is not None else []
+
+    # Started before the persist queue, so it is stopped (and flushed) after the queue wrote out what was left at exit
+    dashboard_counters = DashboardCounters(config["dashboardFile"], lock_when_to_stop, config["dashboardFlushInterval"])
+    dashboard_counters.start()
+    persist_queue = None
+    group_committer = None
+    if config["finalizeMode"] == "deferred":
+        persist_queue = PersistQueue(config["spoolDir"], write_runs, config["spoolDrainInterval"],
+                                     config["spoolMaxBatchSize"], config["spoolMaxAttempts"])
+        persist_queue.start()  # also writes out whatever was left in the spool by a previous run of the server
+    elif config["groupCommitWindow"] > 0:
+        group_committer = GroupCommitter(write_runs, config["groupCommitWindow"], config["groupCommitMaxBatchSize"])
+
+
+# endregion
+
 
 class InitializePreview(Resource):
     def initialize_vars(self):
@@ -28,8 +201,7 @@ class InitializePreview(Resource):
 
     def get_sequence_info(self, feedback):
         assigned_file = config["previewSequenceFile"]
-        with open(assigned_file) as f:
-            sequence_info = json.load(f)
+        sequence_info = sequence_cache.get(assigned_file)
         index_to_run = 0
 
         run_info = {"index_to_run": index_to_run,
@@ -58,57 +230,43 @@ class InitializeRun(Resource):
         self.workerId = request.args.get("workerId")
         self.medium = request.args.get("medium")
         self.trial_feedback = request.args.get("trialFeedback")
-        self.assigned_sequences_df = pd.read_csv(config["assignedSequencesFile"], delimiter=",")
-        self.assigned_sequences_df = self.assigned_sequences_df.set_index("workerId", drop=False)
+        with instrumentation.stage("registry sync"):
+            assignment_registry.sync()  # pick up assignments made by other server processes
         self.timestamp = datetime.datetime.now()
 
-    def available_sequences(self):
-        sequence_files = os.listdir(os.path.join(config["sequenceDir"]))
-        assigned_files = self.assigned_sequences_df["sequenceFile"].values.tolist()
-        assigned_files = [os.path.basename(x) for x in assigned_files]
-        available_files = [x for x in sequence_files if x not in assigned_files and x.endswith(".json")]
-        available_files = [x for x in available_files if not os.path.samefile(os.path.join(config["sequenceDir"],x), config["previewSequenceFile"])]
-        available_files = sorted(available_files)
-        return available_files
-
     def assign_new_sequence(self, workerId):
-        if workerId in self.assigned_sequences_df["workerId"].values:
+        if workerId in assignment_registry:
             raise Exception('cannot assign new sequence, workerId already has one')
         else:
-            available_files = self.available_sequences()
-            assigned_file = os.path.join(config["sequenceDir"], available_files[0])
-            new_row = {"workerId": workerId,
-                       "sequenceFile": assigned_file,
-                       "indexToRun": int(0),
-                       "blocked": False,
-                       "finished": False,
-                       "timestamp": self.timestamp.__str__(),
-                       "version": config["version"]}
-
-            self.assigned_sequences_df = self.assigned_sequences_df.append(pd.DataFrame(new_row, index=[0]),
-                                                                           ignore_index=True)
-            self.assigned_sequences_df = self.assigned_sequences_df.set_index("workerId", drop=False)
+            assigned_file = track_pool.pop()
+            assignment_registry.assign(workerId, assigned_file, self.timestamp.__str__(), config["version"])
 
     def already_running(self, workerId, timestamp, new_worker):
         if new_worker:
             return False
         else:
             # if previous initialization was less than 5 minutes ago, session is probably still active
-            previous_timestamp = self.assigned_sequences_df.loc[workerId, "timestamp"]
+            previous_timestamp = assignment_registry.get(workerId)["timestamp"]
+            if not previous_timestamp:  # never initialized a run (see unknown_worker_row)
+                return False
             previous_timestamp = datetime.datetime.strptime(previous_timestamp.__str__(), "%Y-%m-%d %H:%M:%S.%f")
             return (timestamp - previous_timestamp) < datetime.timedelta(minutes=4)
 
     def get_sequence_info(self, workerId, feedback):
-        assigned_file = self.assigned_sequences_df.loc[workerId, "sequenceFile"]
-        with open(assigned_file) as f:
-            sequence_info = json.load(f)
-        index_to_run = int(self.assigned_sequences_df.loc[workerId, "indexToRun"])
+        assignment = assignment_registry.get(workerId)
+        assigned_file = assignment["sequenceFile"]
+        if not assigned_file:  # added to the registry without a track (see unknown_worker_row), nothing to play
+            return {"index_to_run": int(assignment["indexToRun"]), "sequenceFile": "", "images": [],
+                    "blocked": int(assignment["blocked"]), "finished": 1, "maintenance": config["maintenance"],
+                    "timestamp": self.timestamp.__str__()}
+        sequence_info = sequence_cache.get(assigned_file)
+        index_to_run = int(assignment["indexToRun"])
 
         run_info = {"index_to_run": index_to_run,
-                    "sequenceFile": str(self.assigned_sequences_df.loc[workerId, "sequenceFile"]),
+                    "sequenceFile": str(assignment["sequenceFile"]),
                     "images": sequence_info["sequences"][index_to_run],
-                    "blocked": int(self.assigned_sequences_df.loc[workerId, "blocked"]),
-                    "finished": int(self.assigned_sequences_df.loc[workerId, "finished"]),
+                    "blocked": int(assignment["blocked"]),
+                    "finished": int(assignment["finished"]),
                     "maintenance": config["maintenance"],
                     "timestamp": self.timestamp.__str__()}
 
@@ -119,21 +277,27 @@ class InitializeRun(Resource):
 
         return run_info
 
-    def update_df(self, run_info):
+    def update_registry(self, run_info):
         if not (run_info["running"] or run_info["finished"] or run_info["blocked"] or run_info["maintenance"]):
             if run_info["index_to_run"] + 1 >= config["maxNumRuns"]:
-                self.assigned_sequences_df.at[self.workerId, "finished"] = True
+                assignment_registry.advance(self.workerId, run_info["index_to_run"], True, self.timestamp.__str__())
             else:
-                self.assigned_sequences_df.at[self.workerId, "indexToRun"] = run_info["index_to_run"] + 1
-            self.assigned_sequences_df.at[self.workerId, "timestamp"] = self.timestamp.__str__()
-            self.assigned_sequences_df.to_csv(config["assignedSequencesFile"], index=False)
+                assignment_registry.advance(self.workerId, run_info["index_to_run"] + 1, False,
+                                            self.timestamp.__str__())
 
     def get(self):
+        # enough valid blocks collected: no new tracks or blocks are handed out (no lock or registry needed for that)
+        # The answer has the keys of a normal run info (with no images), the front-end reads them
+        if dashboard_counters.study_complete():
+            return {"studyComplete": True, "index_to_run": -1, "sequenceFile": "", "images": [], "blocked": 0,
+                    "finished": 0, "running": False, "maintenance": config["maintenance"],
+                    "timestamp": datetime.datetime.now().__str__()}
+
         with lock_assigned_sequences:
             self.initialize_vars()
 
             # assign sequence file if worker is new
-            if self.workerId not in self.assigned_sequences_df["workerId"].values:
+            if self.workerId not in assignment_registry:
                 new_worker = True
                 self.assign_new_sequence(self.workerId)
             else:
@@ -145,159 +309,65 @@ class InitializeRun(Resource):
             # check if another run might be active
             return_dict["running"] = self.already_running(self.workerId, self.timestamp, new_worker)
 
-            # update the database
-            self.update_df(return_dict)
+            # update the registry
+            self.update_registry(return_dict)
 
             return return_dict
 
 
 class FinalizeRun(Resource):
     def initialize_vars(self):
-        start = time.time()
         self.data_received = request.get_json()
         self.medium = self.data_received["medium"]
-        self.sequence_info = self.get_sequence_info(self.data_received["sequenceFile"])
+        num_trials = self.data_received["numTrials"]
+        with instrumentation.stage("scoring"):
+            codes = get_block_codes(self.data_received["sequenceFile"], self.data_received["indexToRun"])
+            self.scores = score_run(codes[0:num_trials],
+                                    response_mask(self.data_received["responseIndices"], num_trials),
+                                    config["conditionLabels"])
         self.return_dict = \
             {"blocked": False,  # initializing, will be set to True if blocked,
              "finished": self.data_received["indexToRun"] + 1 >= config["maxNumRuns"],
              "maintenance": config["maintenance"]}
-        end = time.time()
-        print("initialized vars, took ", end - start, " seconds")
 
     def get_sequence_info(self, sequence_file):
-        with open(sequence_file) as f:
-            sequence_info = json.load(f)
-        return sequence_info
-
-    def update_data_file(self):
-        start = time.time()
-        data_received = self.data_received
-        sequence_info = self.sequence_info
-        run_index = data_received["indexToRun"]
-        num_trials = data_received["numTrials"]
-        meta_data = {
-            "medium": data_received["medium"],
-            "sequenceFile": data_received["sequenceFile"],
-            "workerId": data_received["workerId"],
-            "assignmentId": data_received["assignmentId"],
-            "timestamp": data_received["timestamp"],
-            "runIndex": run_index,
-            "initTime": data_received["initTime"],
-            "finishTime": data_received["finishTime"]
-        }
-
-        # Setting data file and lock
-        if self.medium == "mturk_sandbox":
-            data_file = config["dataSandboxFile"]
-            lock = lock_data_sandbox
-        else:
-            data_file = config["dataFile"]
-            lock = lock_data
-
-        print(lock)
+        return sequence_cache.get(sequence_file)
 
-        with lock:
-            data_all = pd.read_csv(data_file)
+    def get_rows(self):
+        return get_trial_rows(self.data_received, self.get_sequence_info(self.data_received["sequenceFile"]))
 
-            # Trial data
-            data = {
-                "response": [1 if i in data_received["responseIndices"] else 0 for i in range(num_trials)],
-                "trialIndex": list(range(data_received["numTrials"])),
-                "condition": sequence_info["types"][run_index][0:num_trials],
-                "image": sequence_info["sequences"][run_index][0:num_trials]
-            }
-            df = pd.DataFrame.from_dict(data, orient='index').transpose()
-            df = pd.concat([df, pd.DataFrame([meta_data] * num_trials)], axis=1)
-            data_all = data_all.append(df, ignore_index=True)
-            data_all.to_csv(data_file, index=False)
+    def update_data_file(self, rows):
+        # Setting trial store (only appends the new rows, never rewrites the data file)
+        if self.medium == "mturk_sandbox":
+            store = trial_store_sandbox
+        else:
+            store = trial_store
 
-        end = time.time()
-        print("updated data df, took ", end - start, " seconds")
+        with instrumentation.stage("data write"):
+            store.append(rows)
 
     def compute_scores(self):
-        start = time.time()
-        data_received = self.data_received
-        sequence_info = self.sequence_info
-        run_index = data_received["indexToRun"]
-        num_trials = data_received["numTrials"]
-
-        repeat_indices = []
-        for i in range(num_trials):
-            if sequence_info["types"][run_index][i] in config["conditionLabels"]["repeatTrials"]:
-                repeat_indices.append(i)
-        no_repeat_indices = []
-        for i in range(num_trials):
-            if sequence_info["types"][run_index][i] in config["conditionLabels"]["noRepeatTrials"]:
-                no_repeat_indices.append(i)
-
-        hits = set(repeat_indices) & set(data_received["responseIndices"])
-        false_alarms = set(no_repeat_indices) & set(data_received["responseIndices"])
-
-        end = time.time()
-        print("computed scores, took ", end - start, " seconds")
-        return {"hit_rate": float(len(hits)) / len(repeat_indices) if len(repeat_indices) > 0 else -1,
-                "false_alarm_num": len(false_alarms)}
+        scores = self.scores
+        return {"hit_rate": scores["hit_rate"],
+                "false_alarm_num": scores["false_alarm_num"]}
 
     def evaluate_vigilance(self, vig_hr_criterion, far_criterion):
-        start = time.time()
-        # initializing
-        data_received = self.data_received
-        sequence_info = self.sequence_info
-        run_index = data_received["indexToRun"]
-        num_trials = data_received["numTrials"]
-        passing_criteria = True
-
-        vig_repeat_indices = [i for i in range(num_trials) if sequence_info["types"][run_index][i] == "vig repeat"]
-        no_repeat_indices = [i for i in range(num_trials) if sequence_info["types"][run_index][i] in ["filler",
-                                                                                                      "target",
-                                                                                                      "vig"]]
-
-        if len(vig_repeat_indices) > 0:
-            vig_hits = set(vig_repeat_indices) & set(data_received["responseIndices"])
-            vig_hit_rate = float(len(vig_hits)) / len(vig_repeat_indices)
-            if vig_hit_rate < vig_hr_criterion:
-                passing_criteria = False
-
-        false_alarms = set(no_repeat_indices) & set(data_received["responseIndices"])
-        false_alarm_rate = float(len(false_alarms))/len(no_repeat_indices)
-        if false_alarm_rate >= far_criterion:
-            passing_criteria = False
-
-        end = time.time()
-        print("evaluated vigilance, took ", end - start, " seconds")
+        passing_criteria = passes_vigilance(self.scores, vig_hr_criterion, far_criterion)
         return "pass" if passing_criteria else "fail"
 
     def block_worker(self, workerId):
-        start = time.time()
         print("blocking")
         self.return_dict["blocked"] = True
 
-        with lock_assigned_sequences:
-            assigned_sequences_df = pd.read_csv(config["assignedSequencesFile"], delimiter=",")
-            assigned_sequences_df = assigned_sequences_df.set_index("workerId", drop=False)
-            assigned_sequences_df.at[workerId, "blocked"] = True
-            assigned_sequences_df.to_csv(config["assignedSequencesFile"], index=False)
-
-        end = time.time()
-        print("blocked worker, took ", end - start, " seconds")
+        with instrumentation.stage("block worker"):
+            assignment_registry.block(workerId)  # appends one journal line, no table rewrite
 
     def update_dashboard(self, valid):
-        start = time.time()
-        with lock_when_to_stop:
-            with open(config["dashboardFile"]) as f:
-                dashboard = json.load(f)
-            dashboard["numBlocksTotalSoFar"] += 1
-            dashboard["numValidBlocksSoFar"] += valid
-            with open(config["dashboardFile"], 'w') as fp:
-                json.dump(dashboard, fp)
-
-        end = time.time()
-        print("updated when to stop, took ", end - start, " seconds")
+        dashboard_counters.add(1, valid)
 
     def post(self):
         self.initialize_vars()
         if not self.data_received['preview']:
-            self.update_data_file()
             valid = 0
 
             # Check vigilance performance and block if necessary
@@ -310,7 +380,22 @@ class FinalizeRun(Resource):
             else:
                 valid = 1
 
-            self.update_dashboard(valid)
+            # Rows are built (and checked) first, so a run that doesn't match its track fails on its own, not along
+            # with the batch it would end up in
+            rows = self.get_rows()
+
+            # Store the data (together with runs finalized at the same time, on its own, or leave it to the persist queue
+            # and reply without waiting for the disk)
+            if persist_queue is not None:
+                persist_queue.put({"dataReceived": self.data_received, "valid": valid, "rows": rows})
+            elif group_committer is not None:
+                group_committer.submit({"dataReceived": self.data_received, "valid": valid, "rows": rows})
+            else:
+                self.update_data_file(rows)
+                self.update_dashboard(valid)
+
+        # Can the worker keep playing?
+        self.return_dict["studyComplete"] = dashboard_counters.study_complete()
 
         # Add scores to return_dict
         self.return_dict.update(self.compute_scores())
@@ -322,11 +407,11 @@ class SubmitRuns(Resource):
         self.data_received = request.get_json()
 
     def update_submissions(self):
-        data = self.data_received
-        with lock_submission_file:
-            submitted_runs_df = pd.read_csv(config["submitFile"])
-            submitted_runs_df = submitted_runs_df.append(data, ignore_index=True)
-            submitted_runs_df.to_csv(config["submitFile"], index=False)
+        # one appended record, a repeated submit of the same session is recognized and not recorded again
+        with instrumentation.stage("submission write"):
+            recorded = submission_log.append(self.data_received)
+        if not recorded:
+            print("submission was already recorded, workerId: ", self.data_received.get("workerId"))
 
     def post(self):
         self.initialize_vars()
@@ -334,11 +419,81 @@ class SubmitRuns(Resource):
         return ("submission successful")
 
 
+class Dashboard(Resource):
+    def get(self):
+        dashboard = dashboard_counters.values()
+        dashboard["studyComplete"] = dashboard["numValidBlocksSoFar"] >= dashboard["numValidBlocksNeeded"]
+        return dashboard
+
+
+class Metrics(Resource):
+    def get(self):
+        return Response(instrumentation.render(), mimetype="text/plain; version=0.0.4")
+
+
+class AdminStatus(Resource):
+    def get(self):
+        status = {"trackPool": track_pool.status(),
+                  "sequenceCache": sequence_cache.stats()}
+        if group_committer is not None:
+            status["groupCommit"] = group_committer.stats()
+        if track_manifest is not None:
+            status["trackManifest"] = {"tracks": len(track_manifest), "problemsAtStartup": manifest_problems}
+        return status
+
+
 api.add_resource(InitializePreview, '/initializepreview')
 api.add_resource(InitializeRun, '/initializerun')
 api.add_resource(FinalizeRun, '/finalizerun')
 api.add_resource(SubmitRuns, '/submitruns')
+api.add_resource(Dashboard, '/dashboard')
+api.add_resource(AdminStatus, '/admin/status')
+api.add_resource(Metrics, '/metrics')
+
+
+def run_production(num_processes, num_threads):
+    """
+    Serves the app with gunicorn (pip install gunicorn) instead of the Flask development server.
+
+    Every worker process has its own in-memory registry, track pool and caches. They are kept consistent through the
+    files in the data dir and their locks (see "Concurrency contract" in the README).
+
+    :param num_processes: number of worker processes
+    :param num_threads: number of threads per worker process
+    """
+    from gunicorn.app.base import BaseApplication  # only needed in production mode
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", "0.0.0.0:" + str(config["port"]))
+            self.cfg.set("workers", num_processes)
+            self.cfg.set("threads", num_threads)
+            self.cfg.set("preload_app", False)
+
+        def load(self):
+            # Runs in each worker process after the fork. Importing the module anew runs setup() there, which gives every
+            # worker its own locks, registry, caches and threads (FileLocks refuse to be used in a process they were not
+            # created in). The master, running this file as __main__, never calls setup().
+            return importlib.import_module("server").app
+
+    ProductionServer().run()
+
 
+if __name__ != '__main__':  # imported: by a gunicorn worker (see run_production) or by the tests
+    setup()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=config["port"], debug=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--production', action='store_true', help='serve with gunicorn and multiple worker processes '
+                                                                   'instead of the Flask development server')
+    parser.add_argument('--processes', type=int, default=config["numProcesses"], help='number of worker processes '
+                                                                                      '(production mode only)')
+    parser.add_argument('--threads', type=int, default=config["numThreads"], help='number of threads per worker '
+                                                                                  'process (production mode only)')
+    args = parser.parse_args()
+
+    if args.production:
+        run_production(args.processes, args.threads)  # the workers set themselves up when they import the module
+    else:
+        setup()
+        app.run(host='0.0.0.0', port=config["port"], debug=True)
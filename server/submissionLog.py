@@ -0,0 +1,203 @@
+import io
+import os
+import csv
+import json
+import sqlite3
+import argparse
+import threading
+from filelock import FileLock
+
+"""
+SUBMISSION LOG
+
+The code deals with recording submissions (the participant clicking submit, see SubmitRuns in server.py) so they can be
+compensated. Every submission is appended to submittedRuns.csv as one record; the file is never read back whole or
+rewritten, so it doesn't matter how many submissions there already are.
+
+Next to the csv file, a SQLite index (e.g., submittedRuns.sqlite) holds the same records with indexes on workerId and
+assignmentId, so payout scripts can look up submissions without loading the log (see the commands below). The csv
+file stays the record: the index remembers up to which byte of the csv file it is complete, and picks up what was
+appended after that (by another server process, or before a crash) before every use. It can be deleted at any time
+and is rebuilt from the csv file.
+
+A submission is only recorded once: clicking submit twice (or a retried request) is recognized by its key, the
+assignmentId, or the workerId and the timestamp of the last run when there is no assignmentId (i.e., outside of
+mTurk).
+
+Looking up submissions (run from the server dir):
+python submissionLog.py --worker_id A1B2C3
+python submissionLog.py --assignment_id 3X4Y5Z
+ """
+
+# Column layout of submittedRuns.csv
+SUBMISSION_COLUMNS = ["workerId", "timestamp", "medium", "compensation", "feedback", "assignmentId"]
+
+
+def submission_key(submission):
+    """
+    :param submission: dict with SUBMISSION_COLUMNS as keys
+    :return: key identifying the submission, the same for repeated submits of one session
+    """
+    if submission.get("assignmentId"):
+        return "assignment:" + str(submission["assignmentId"])
+    return "worker:" + str(submission.get("workerId")) + ":" + str(submission.get("timestamp"))
+
+
+class SubmissionLog:
+    """
+    Append-only csv log of submissions with a SQLite index on the side.
+    """
+
+    def __init__(self, submit_file, index_file, lock):
+        """
+        :param submit_file: path to the csv file (e.g., submittedRuns.csv)
+        :param index_file: path to the SQLite index (created if it does not exist yet)
+        :param lock: FileLock guarding the csv file, also serializes updates of the index between processes
+        """
+        self.submit_file = submit_file
+        self.index_file = index_file
+        self.lock = lock
+        self.columns = None
+        self.local = threading.local()  # sqlite connections can't be shared between threads
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS submissions (key TEXT PRIMARY KEY, " +
+                               ", ".join(column + " TEXT" for column in SUBMISSION_COLUMNS) + ")")
+            connection.execute("CREATE INDEX IF NOT EXISTS submissions_worker ON submissions (workerId)")
+            connection.execute("CREATE INDEX IF NOT EXISTS submissions_assignment ON submissions (assignmentId)")
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def connect(self):
+        """
+        :return: sqlite3 connection for the current thread (and process)
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():  # connections must not be reused in a forked process
+            connection = sqlite3.connect(self.index_file, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get_columns(self):
+        """
+        Column order of the csv file, taken from its header line (written first if the file is empty or missing).
+        Files from before assignmentId was recorded keep their columns, the assignmentId then only goes to the index.
+
+        :return: list of column names
+        """
+        if self.columns is None:
+            if os.path.isfile(self.submit_file) and os.path.getsize(self.submit_file) > 0:
+                with open(self.submit_file, newline="") as f:
+                    self.columns = next(csv.reader(f))
+            else:
+                self.columns = list(SUBMISSION_COLUMNS)
+                with open(self.submit_file, "w", newline="") as f:
+                    csv.writer(f).writerow(self.columns)
+        return self.columns
+
+    def catch_up(self, connection):
+        """
+        Adds the records appended to the csv file since the index was last updated. Caller holds the lock.
+
+        :param connection: sqlite3 connection (the changes are committed by the caller)
+        :return: size of the csv file, up to which the index is now complete
+        """
+        row = connection.execute("SELECT value FROM meta WHERE name = 'offset'").fetchone()
+        offset = row[0] if row is not None else 0
+        size = os.path.getsize(self.submit_file)
+        if size < offset:  # the csv file was replaced, start over
+            connection.execute("DELETE FROM submissions")
+            offset = 0
+        if size > offset:
+            with open(self.submit_file, "rb") as f:
+                f.seek(offset)
+                tail = f.read(size - offset)
+            end = tail.rfind(b"\n") + 1  # only complete lines
+            reader = csv.reader(io.StringIO(tail[:end].decode("utf-8"), newline=""))
+            if offset == 0:
+                next(reader, None)  # header line
+            columns = self.get_columns()
+            for values in reader:
+                self.insert(connection, dict(zip(columns, values)))
+            size = offset + end
+            connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('offset', ?)", (size,))
+        return size
+
+    @staticmethod
+    def insert(connection, submission):
+        """
+        :return: True if the submission was new to the index
+        """
+        cursor = connection.execute("INSERT OR IGNORE INTO submissions (key, " + ", ".join(SUBMISSION_COLUMNS) +
+                                    ") VALUES (?, " + ", ".join("?" for _ in SUBMISSION_COLUMNS) + ")",
+                                    [submission_key(submission)] +
+                                    [submission.get(column) for column in SUBMISSION_COLUMNS])
+        return cursor.rowcount > 0
+
+    def append(self, submission):
+        """
+        Records a submission, unless it was recorded before. It is on disk when this returns.
+
+        :param submission: dict with SUBMISSION_COLUMNS as keys (what the front-end sends)
+        :return: True if it was recorded now, False if it was a repeat
+        """
+        submission = {column: "" if submission.get(column) is None else submission[column]
+                      for column in SUBMISSION_COLUMNS}  # as it will read back from the csv file
+        with self.lock:
+            columns = self.get_columns()
+            with self.connect() as connection:
+                self.catch_up(connection)
+                if connection.execute("SELECT 1 FROM submissions WHERE key = ?",
+                                      (submission_key(submission),)).fetchone() is not None:
+                    return False
+
+                with open(self.submit_file, "a", newline="") as f:
+                    csv.DictWriter(f, fieldnames=columns, extrasaction="ignore").writerow(submission)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    size = f.tell()
+                self.insert(connection, submission)
+                connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('offset', ?)", (size,))
+        return True
+
+    def lookup(self, worker_id=None, assignment_id=None):
+        """
+        :param worker_id: workerId to look up
+        :param assignment_id: assignmentId to look up
+        :return: list of dicts, the submissions matching all ids given, in the order they were recorded
+        """
+        with self.lock:
+            with self.connect() as connection:
+                self.catch_up(connection)
+        conditions = []
+        values = []
+        if worker_id is not None:
+            conditions.append("workerId = ?")
+            values.append(worker_id)
+        if assignment_id is not None:
+            conditions.append("assignmentId = ?")
+            values.append(assignment_id)
+        cursor = self.connect().execute("SELECT " + ", ".join(SUBMISSION_COLUMNS) + " FROM submissions" +
+                                        (" WHERE " + " AND ".join(conditions) if conditions else "") +
+                                        " ORDER BY rowid", values)
+        return [dict(zip(SUBMISSION_COLUMNS, x)) for x in cursor]
+
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default="server_config.json", help='server config file')
+    parser.add_argument('--worker_id', type=str, default=None, help='workerId to look up')
+    parser.add_argument('--assignment_id', type=str, default=None, help='assignmentId to look up')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    # %% Look up ------------------------------------------------------------------------------------------------------
+    submission_log = SubmissionLog(config["submitFile"], config["submitIndexFile"],
+                                   FileLock(config["submitFile"] + ".lock"))
+    submissions = submission_log.lookup(args.worker_id, args.assignment_id)
+    for submission in submissions:
+        print(json.dumps(submission))
+    print(len(submissions), " submissions found")
@@ -0,0 +1,37 @@
+import os
+from filelock import FileLock
+from assignmentRegistry import AssignmentRegistry
+
+
+def test_sync_after_compaction(tmp_path):
+    csv_file = str(tmp_path / "assignedSequences.csv")
+    lock = FileLock(csv_file + ".lock")
+    reader = AssignmentRegistry(csv_file, lock)  # loaded before any journal line was written
+    writer = AssignmentRegistry(csv_file, lock)
+    writer.assign("w1", "track_00001.json", "2020-01-01 12:00:00", "v1")
+    AssignmentRegistry(csv_file, lock).compact()
+    assert not os.path.isfile(csv_file + ".journal")
+
+    with lock:
+        reader.sync()
+    assert "w1" in reader
+    assert "track_00001" in reader.assigned_files
+
+    # a new journal after the compaction is read from its start
+    writer.assign("w2", "track_00002.json", "2020-01-01 12:00:00", "v1")
+    with lock:
+        reader.sync()
+    assert "w2" in reader
+
+
+def test_unknown_worker(tmp_path):
+    csv_file = str(tmp_path / "assignedSequences.csv")
+    registry = AssignmentRegistry(csv_file, FileLock(csv_file + ".lock"))
+    registry.block("unknown1")
+    registry.advance("unknown2", 1, False, "2020-01-01 12:00:00")
+    assert registry.get("unknown1")["blocked"]
+    assert registry.get("unknown2")["indexToRun"] == 1
+    assert registry.assigned_files == set()  # no track taken
+
+    reloaded = AssignmentRegistry(csv_file, FileLock(csv_file + ".lock"))
+    assert reloaded.get("unknown1")["blocked"]
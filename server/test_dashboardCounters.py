@@ -0,0 +1,16 @@
+import json
+from filelock import FileLock
+from dashboardCounters import DashboardCounters
+
+
+def test_counts_of_other_process_without_flush_thread(tmp_path):
+    path = str(tmp_path / "dashboard.json")
+    with open(path, "w") as f:
+        json.dump({"numValidBlocksNeeded": 2, "numValidBlocksSoFar": 0, "numBlocksTotalSoFar": 0}, f)
+    lock = FileLock(path + ".lock")
+    finalizing = DashboardCounters(path, lock, 0)
+    watching = DashboardCounters(path, lock, 0)  # never adds, so never flushes
+
+    finalizing.add(3, 2)
+    assert watching.values()["numBlocksTotalSoFar"] == 3
+    assert watching.study_complete()
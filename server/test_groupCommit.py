@@ -0,0 +1,63 @@
+import time
+import threading
+from groupCommit import GroupCommitter
+
+
+def submit_together(write_batch, records, window=0.2):
+    """
+    Submits records from one thread each, making sure they end up in one batch: they queue up while a first batch is
+    being written.
+
+    :return: the GroupCommitter, dict record -> error for the records that failed
+    """
+    release = threading.Event()
+
+    def write(batch):
+        if batch == ["block"]:
+            release.wait()
+        else:
+            write_batch(batch)
+
+    committer = GroupCommitter(write, window=window, max_batch_size=10)
+    errors = {}
+
+    def submit(record):
+        try:
+            committer.submit(record)
+        except Exception as e:
+            errors[record if isinstance(record, str) else id(record)] = e
+
+    blocker = threading.Thread(target=submit, args=("block",))
+    blocker.start()
+    while not committer.leader_active:
+        time.sleep(0.001)
+    threads = [threading.Thread(target=submit, args=(record,)) for record in records]
+    for thread in threads:
+        thread.start()
+    while len(committer.pending) < len(records):
+        time.sleep(0.001)
+    release.set()
+    for thread in [blocker] + threads:
+        thread.join()
+    return committer, errors
+
+
+def test_bad_record_only_fails_itself():
+    written = []
+
+    def write_batch(records):
+        if "bad" in records:
+            raise IndexError("bad record")
+        written.extend(records)
+
+    committer, errors = submit_together(write_batch, ["a", "bad", "b"])
+    assert sorted(written) == ["a", "b"]
+    assert list(errors) == ["bad"]
+    assert committer.stats()["batches"] == 2  # the blocking one and one with the three records
+
+
+def test_lone_request_does_not_wait():
+    committer = GroupCommitter(lambda records: None, window=5.0, max_batch_size=10)
+    start = time.time()
+    committer.submit("a")
+    assert time.time() - start < 1.0
@@ -0,0 +1,45 @@
+import os
+import sys
+import json
+import time
+import subprocess
+from instrumentation import Instrumentation, STALE_FLUSHES
+
+
+def write_snapshot(metrics_dir, pid, age=0.0):
+    path = os.path.join(metrics_dir, str(pid) + ".json")
+    with open(path, "w") as f:
+        json.dump([["memorygame_request_duration_seconds", {"endpoint": "x", "status": "200"},
+                    [1] + [0] * 13 + [1, 0.1]]], f)
+    os.utime(path, (time.time() - age, time.time() - age))
+    return path
+
+
+def test_stale_and_dead_files_are_left_out(tmp_path):
+    metrics_dir = str(tmp_path)
+    instrumentation = Instrumentation(metrics_dir, flush_interval=1.0)
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    dead_path = write_snapshot(metrics_dir, dead.pid)
+    live = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        live_path = write_snapshot(metrics_dir, live.pid)
+        write_snapshot(metrics_dir, os.getppid(), age=STALE_FLUSHES + 1)  # alive, but not written for too long
+
+        histograms = instrumentation.collect()
+        assert not os.path.isfile(dead_path)
+        assert os.path.isfile(live_path)
+        assert sum(histogram[-2] for histogram in histograms.values()) == 1  # only the live, recent file
+    finally:
+        live.kill()
+        live.wait()
+
+
+def test_file_removed_at_stop(tmp_path):
+    instrumentation = Instrumentation(str(tmp_path), flush_interval=60.0)
+    instrumentation.start()
+    instrumentation.observe("memorygame_request_duration_seconds", 0.01, endpoint="x", status="200")
+    instrumentation.flush()
+    assert os.listdir(str(tmp_path)) == [str(os.getpid()) + ".json"]
+    instrumentation.stop()
+    assert os.listdir(str(tmp_path)) == []
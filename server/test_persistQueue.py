@@ -0,0 +1,26 @@
+import os
+from persistQueue import PersistQueue
+
+
+def test_failing_record_moves_to_failed(tmp_path):
+    written = []
+
+    def write_batch(records):
+        if any(record["bad"] for record in records):
+            raise IndexError("bad record")
+        written.extend(record["id"] for record in records)
+
+    queue = PersistQueue(str(tmp_path), write_batch, drain_interval=1.0, max_batch_size=10, max_attempts=2)
+    queue.put({"id": 0, "bad": False})
+    queue.put({"id": 1, "bad": True})
+    queue.put({"id": 2, "bad": False})
+
+    assert queue.drain() == 2  # the bad record doesn't hold up the others
+    assert written == [0, 2]
+    assert len(queue.pending()) == 1
+
+    queue.put({"id": 3, "bad": False})
+    assert queue.drain() == 1
+    assert queue.pending() == []
+    assert len(os.listdir(queue.failed_dir)) == 1
+    assert written == [0, 2, 3]
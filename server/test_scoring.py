@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scoring import score_data
+
+CONDITION_LABELS = {"repeatTrials": ["vig repeat", "target repeat"], "vigRepeatTrials": ["vig repeat"],
+                    "noRepeatTrials": ["filler", "target", "vig"]}
+
+
+def make_data(conditions):
+    return pd.DataFrame({"condition": conditions, "response": [1] * len(conditions), "workerId": "w1",
+                         "assignmentId": "", "sequenceFile": "track_00000.json", "runIndex": 0,
+                         "timestamp": "2020-01-01 12:00:00"})
+
+
+def test_score_data():
+    scores = score_data(make_data(["target", "target repeat", "filler"]), CONDITION_LABELS)
+    assert scores["hit_rate"].tolist() == [1.0]
+    assert scores["false_alarm_num"].tolist() == [2]
+
+
+def test_score_data_unknown_condition():
+    with pytest.raises(Exception, match="'taget'.*nan"):
+        score_data(make_data(["target", "taget", np.nan]), CONDITION_LABELS)
@@ -0,0 +1,109 @@
+import csv
+import sys
+import json
+import importlib
+from loadTest import make_study
+from test_groupCommit import submit_together
+
+
+def load_server(root, monkeypatch):
+    """
+    Imports server.py for the study in root (it reads server_config.json from the working dir).
+    """
+    monkeypatch.chdir(root)
+    sys.modules.pop("server", None)
+    return importlib.import_module("server")
+
+
+def test_initializerun_study_complete(tmp_path, monkeypatch):
+    config = make_study(str(tmp_path), num_tracks=2, num_blocks=2, num_trials=20, existing_workers=0,
+                        rows_per_worker=0, overrides={"metricsDir": ""})
+    with open(config["dashboardFile"], "w") as f:
+        json.dump({"numValidBlocksNeeded": 1, "numValidBlocksSoFar": 1, "numBlocksTotalSoFar": 1}, f)
+    server = load_server(tmp_path, monkeypatch)
+
+    response = server.app.test_client().get("/initializerun", query_string={"workerId": "w1", "medium": "other",
+                                                                           "trialFeedback": "false"})
+    run_info = response.get_json()
+    assert response.status_code == 200
+    assert run_info["studyComplete"] is True
+    # the keys the front-end reads before it checks studyComplete
+    assert run_info["images"] == []
+    for key in ["index_to_run", "sequenceFile", "timestamp", "blocked", "finished", "running", "maintenance"]:
+        assert key in run_info
+    assert "w1" not in server.assignment_registry  # no track handed out
+
+
+def test_finalizerun_bad_run_fails_alone(tmp_path, monkeypatch):
+    config = make_study(str(tmp_path), num_tracks=2, num_blocks=2, num_trials=20, existing_workers=0,
+                        rows_per_worker=0, overrides={"metricsDir": "", "finalizeMode": "sync",
+                                                      "groupCommitWindow": 0.05})
+    server = load_server(tmp_path, monkeypatch)
+    client = server.app.test_client()
+    server.app.config["PROPAGATE_EXCEPTIONS"] = False  # a failing request answers 500, as it would when deployed
+
+    def finalize(worker_id, num_trials):
+        run_info = client.get("/initializerun", query_string={"workerId": worker_id, "medium": "other",
+                                                              "trialFeedback": "1"}).get_json()
+        return client.post("/finalizerun", json={
+            "assignmentId": "", "workerId": worker_id, "indexToRun": run_info["index_to_run"],
+            "sequenceFile": run_info["sequenceFile"], "responseIndices": [], "preview": False,
+            "timestamp": run_info["timestamp"], "medium": "other", "initTime": "2020-1-1 12:0:0",
+            "finishTime": "2020-1-1 12:5:0", "numTrials": num_trials})
+
+    assert finalize("bad", 1000).status_code == 500  # more trials than the block has
+    assert finalize("good", 20).status_code == 200
+    with open(config["dataFile"], newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 20
+    assert all(row["workerId"] == "good" for row in rows)
+
+
+def test_finalizerun_unknown_worker(tmp_path, monkeypatch):
+    make_study(str(tmp_path), num_tracks=2, num_blocks=2, num_trials=20, existing_workers=0, rows_per_worker=0,
+               overrides={"metricsDir": ""})
+    server = load_server(tmp_path, monkeypatch)
+    client = server.app.test_client()
+    sequence_file = str(tmp_path / "sequenceFiles" / "track_00000.json")
+
+    response = client.post("/finalizerun", json={
+        "assignmentId": "", "workerId": "unknown", "indexToRun": 0, "sequenceFile": sequence_file,
+        "responseIndices": [], "preview": False, "timestamp": "2020-01-01 12:00:00", "medium": "other",
+        "initTime": "2020-1-1 12:0:0", "finishTime": "2020-1-1 12:5:0", "numTrials": 20})
+    assert response.status_code == 200
+    assert response.get_json()["blocked"]  # no responses at all, fails the vigilance criteria
+    assert server.assignment_registry.get("unknown")["blocked"]
+
+    run_info = client.get("/initializerun", query_string={"workerId": "unknown", "medium": "other",
+                                                          "trialFeedback": "1"}).get_json()
+    assert run_info["blocked"] and run_info["images"] == []
+
+
+def test_write_runs_failing_second_store(tmp_path, monkeypatch):
+    config = make_study(str(tmp_path), num_tracks=2, num_blocks=2, num_trials=20, existing_workers=0,
+                        rows_per_worker=0, overrides={"metricsDir": ""})
+    server = load_server(tmp_path, monkeypatch)
+
+    def fail(rows):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(server.trial_store_sandbox, "append", fail)
+    sequence_file = str(tmp_path / "sequenceFiles" / "track_00000.json")
+
+    def record(worker_id, medium):
+        data_received = {"assignmentId": "", "workerId": worker_id, "indexToRun": 0, "sequenceFile": sequence_file,
+                         "responseIndices": [], "timestamp": "2020-01-01 12:00:00", "medium": medium,
+                         "initTime": "2020-1-1 12:0:0", "finishTime": "2020-1-1 12:5:0", "numTrials": 20}
+        return {"dataReceived": data_received, "valid": 1,
+                "rows": server.get_trial_rows(data_received, server.sequence_cache.get(sequence_file))}
+
+    live = record("live", "other")
+    sandbox = record("sandbox", "mturk_sandbox")
+    committer, errors = submit_together(server.write_runs, [live, sandbox])
+
+    assert list(errors) == [id(sandbox)]
+    assert committer.stats()["batches"] == 2  # the blocking one and one with both records
+    with open(config["dataFile"], newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 20  # written once, not again when the batch was retried record by record
+    assert server.dashboard_counters.values()["numBlocksTotalSoFar"] == 1
@@ -0,0 +1,95 @@
+import os
+import collections
+from assignmentRegistry import track_name
+
+"""
+FREE TRACK POOL
+
+The code deals with handing out tracks (sequenceFiles) that haven't been assigned to any worker yet.
+
+The pool is built once from the sequence directory: all track files (of the configured format), minus the preview
+track and minus the tracks the assignment registry already knows about, in sorted order. Allocating a track pops the
+first one off the queue. Tracks that were assigned by another server process in the meantime are skipped as they come
+up, so the queue never has to be rebuilt for that. The directory is only listed again when its modification time
+changes (i.e., when tracks were added or removed). With a pack (see trackPack.py), the tracks are the ones in the pack
+and the queue is only rebuilt when the pack is replaced.
+ """
+
+
+class TrackPool:
+    """
+    Queue of unassigned tracks, kept in sync with an AssignmentRegistry.
+    """
+
+    def __init__(self, sequence_dir, preview_file, registry, extension=".json", low_water_mark=0, pack=None,
+                 ignore=()):
+        """
+        :param sequence_dir: dir containing the track files
+        :param preview_file: path to the preview track, never handed out
+        :param registry: AssignmentRegistry, used to know which tracks are already taken
+        :param extension: extension of the track files to hand out (".json" or ".trk", see trackFormats.py)
+        :param low_water_mark: print a warning when fewer tracks than this are left
+        :param pack: optional TrackPack holding the tracks, instead of separate files in sequence_dir
+        :param ignore: names of other files kept in sequence_dir that aren't tracks (e.g., the track manifest)
+        """
+        self.sequence_dir = sequence_dir
+        self.extension = extension
+        self.preview_name = track_name(preview_file)
+        self.preview_in_dir = os.path.realpath(os.path.dirname(preview_file)) == os.path.realpath(sequence_dir)
+        self.registry = registry
+        self.low_water_mark = low_water_mark
+        self.pack = pack
+        self.ignore = set(ignore)
+        self.free = collections.deque()
+        self.track_files = []  # names of all tracks that can be handed out (assigned or not)
+        self.num_tracks = 0
+        self.dir_mtime = None
+
+    def refresh(self):
+        """
+        Rebuilds the queue if the sequence directory (or pack) changed since the last time it was listed. Caller holds
+        the registry lock.
+        """
+        dir_mtime = os.stat(self.sequence_dir).st_mtime_ns if self.pack is None else self.pack.version()
+        if dir_mtime == self.dir_mtime:
+            return
+        self.dir_mtime = dir_mtime
+
+        if self.pack is None:
+            track_files = [x for x in os.listdir(self.sequence_dir) if x.endswith(self.extension) and x not in self.ignore]
+        else:
+            track_files = self.pack.names()
+        if self.preview_in_dir:
+            track_files = [x for x in track_files if track_name(x) != self.preview_name]
+        self.track_files = track_files
+        self.num_tracks = len(track_files)
+        assigned_files = self.registry.assigned_files
+        self.free = collections.deque(sorted(x for x in track_files if track_name(x) not in assigned_files))
+
+    def pop(self):
+        """
+        Takes the next unassigned track off the queue. Caller holds the registry lock (and has synced the registry).
+
+        :return: path to the track file
+        """
+        self.refresh()
+        while self.free:
+            track_file = self.free.popleft()
+            if track_name(track_file) not in self.registry.assigned_files:  # might have been taken by another process
+                if len(self.free) < self.low_water_mark:
+                    print("WARNING: only ", len(self.free), " unassigned tracks left, time to generate more")
+                return os.path.join(self.sequence_dir, track_file)
+        raise Exception("cannot assign new sequence, no unassigned tracks left in " + self.sequence_dir)
+
+    def status(self):
+        """
+        :return: dict describing the pool depth
+        """
+        with self.registry.lock:
+            self.registry.sync()
+            self.refresh()
+            available = sum(1 for x in self.free if track_name(x) not in self.registry.assigned_files)
+        return {"available": available,
+                "assigned": self.num_tracks - available,
+                "total": self.num_tracks,
+                "low": available < self.low_water_mark}
@@ -0,0 +1,212 @@
+import io
+import os
+import csv
+import json
+import sqlite3
+import argparse
+import threading
+
+"""
+TRIAL STORAGE
+
+The code deals with persisting the trial data that comes in with every finalized run. Every run adds a couple of
+hundred rows (one per trial) to the data. Rather than reading the whole data file, appending to it, and writing it back
+(which gets slower the more data has been collected), the stores below only ever write the new rows.
+
+Two backends are available (set "trialStore" in server_config.json):
+- csv: appends the rows to the data file (e.g., data.csv) directly. The file keeps the layout it always had.
+- sqlite: appends the rows to a local SQLite database in WAL mode (e.g., data.sqlite). Use the export command below to
+produce a data.csv with the usual layout for analysis.
+
+Exporting (run from the server dir):
+python trialStore.py --out ../data/data.csv
+python trialStore.py --sandbox --out ../data/data_sandbox.csv
+ """
+
+# Column layout of data.csv (the order pandas used to write it in)
+DATA_COLUMNS = ["assignmentId", "condition", "finishTime", "image", "initTime", "medium", "response", "runIndex",
+                "sequenceFile", "timestamp", "trialIndex", "workerId"]
+
+
+# region Stores
+class CsvTrialStore:
+    """
+    Appends trial rows to a csv file. Only the header line is ever read back.
+    """
+
+    def __init__(self, data_file, lock):
+        """
+        :param data_file: path to the csv file (e.g., data.csv)
+        :param lock: FileLock guarding the csv file (appends from several processes should not interleave)
+        """
+        self.data_file = data_file
+        self.lock = lock
+        self.columns = None
+
+    def get_columns(self):
+        """
+        Column order of the csv file, taken from its header line (written first if the file is empty or missing).
+
+        :return: list of column names
+        """
+        if self.columns is None:
+            if os.path.isfile(self.data_file) and os.path.getsize(self.data_file) > 0:
+                with open(self.data_file, newline="") as f:
+                    self.columns = next(csv.reader(f))
+                with open(self.data_file, "rb+") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")  # pandas leaves the last line without newline when there are no rows yet
+            else:
+                self.columns = list(DATA_COLUMNS)
+                with open(self.data_file, "w", newline="") as f:
+                    csv.writer(f).writerow(self.columns)
+        return self.columns
+
+    def append(self, rows):
+        """
+        Appends rows to the csv file and flushes them to disk. All or nothing: if writing fails, the file is cut back to
+        where it was.
+
+        :param rows: list of dicts (one per trial) with DATA_COLUMNS as keys
+        """
+        with self.lock:
+            columns = self.get_columns()
+            buffer = io.StringIO(newline="")
+            csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore").writerows(rows)
+            with open(self.data_file, "a", newline="") as f:
+                size = f.tell()
+                try:
+                    f.write(buffer.getvalue())
+                    f.flush()
+                    os.fsync(f.fileno())
+                except BaseException:
+                    f.truncate(size)
+                    raise
+
+    def iter_rows(self):
+        """
+        :return: generator of dicts, one per stored trial
+        """
+        with open(self.data_file, newline="") as f:
+            for row in csv.DictReader(f):
+                yield row
+
+
+class SqliteTrialStore:
+    """
+    Appends trial rows to a SQLite database in WAL mode. SQLite takes care of the locking between processes.
+    """
+
+    def __init__(self, db_file):
+        """
+        :param db_file: path to the database file (created if it does not exist yet)
+        """
+        self.db_file = db_file
+        self.local = threading.local()  # sqlite connections can't be shared between threads
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS trials (id INTEGER PRIMARY KEY AUTOINCREMENT, " +
+                               ", ".join(column + " TEXT" for column in DATA_COLUMNS) + ")")
+
+    def connect(self):
+        """
+        :return: sqlite3 connection for the current thread (and process)
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():  # connections must not be reused in a forked process
+            connection = sqlite3.connect(self.db_file, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def append(self, rows):
+        """
+        Inserts rows in a single transaction.
+
+        :param rows: list of dicts (one per trial) with DATA_COLUMNS as keys
+        """
+        query = "INSERT INTO trials (" + ", ".join(DATA_COLUMNS) + ") VALUES (" + \
+                ", ".join("?" for _ in DATA_COLUMNS) + ")"
+        with self.connect() as connection:
+            connection.executemany(query, [[row.get(column) for column in DATA_COLUMNS] for row in rows])
+
+    def iter_rows(self):
+        """
+        :return: generator of dicts, one per stored trial, in insertion order
+        """
+        cursor = self.connect().execute("SELECT " + ", ".join(DATA_COLUMNS) + " FROM trials ORDER BY id")
+        for values in cursor:
+            yield dict(zip(DATA_COLUMNS, values))
+
+
+# endregion
+
+# region Helper functions
+def open_trial_store(backend, data_file, db_file, lock):
+    """
+    Creates the trial store for one data file.
+
+    :param backend: "csv" or "sqlite"
+    :param data_file: path to the csv data file (e.g., data.csv)
+    :param db_file: path to the database file, only used by the sqlite backend
+    :param lock: FileLock guarding data_file, only used by the csv backend
+    :return: store with an append(rows) method
+    """
+    if backend == "csv":
+        return CsvTrialStore(data_file, lock)
+    elif backend == "sqlite":
+        return SqliteTrialStore(db_file)
+    else:
+        raise Exception("Unknown trial store backend: " + str(backend))
+
+
+def export_trials(store, out_file):
+    """
+    Writes all stored trials to a csv file with the data.csv layout.
+
+    :param store: trial store to read from
+    :param out_file: path of the csv file to write
+    :return: number of rows written
+    """
+    num_rows = 0
+    tmp_file = out_file + ".tmp"
+    with open(tmp_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=DATA_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        for row in store.iter_rows():
+            writer.writerow(row)
+            num_rows += 1
+    os.replace(tmp_file, out_file)  # analysis scripts never see a half-written file
+    return num_rows
+
+
+# endregion
+
+if __name__ == "__main__":
+    # %% Collect command line arguments ------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default="server_config.json", help='server config file')
+    parser.add_argument('--sandbox', action='store_true', help='export the sandbox data instead')
+    parser.add_argument('--out', type=str, required=True, help='csv file to write (data.csv layout)')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    # %% Export -------------------------------------------------------------------------------------------------------
+    if args.sandbox:
+        data_file, db_file = config["dataSandboxFile"], config["dataSandboxDbFile"]
+    else:
+        data_file, db_file = config["dataFile"], config["dataDbFile"]
+
+    if config["trialStore"] == "sqlite":
+        store = SqliteTrialStore(db_file)
+    else:
+        store = CsvTrialStore(data_file, lock=None)
+
+    if os.path.abspath(args.out) == os.path.abspath(data_file) and config["trialStore"] == "csv":
+        print("The csv store already writes ", data_file, ", nothing to export")
+    else:
+        print("exported ", export_trials(store, args.out), " trials to ", args.out)